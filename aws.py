@@ -10,10 +10,11 @@ class AWSHandler:
         if config is None:
             config = Config(signature_version = UNSIGNED)
 
-        self.product       = product
-        self.bucketName    = bucketName
-        self.client        = boto3.client("s3", config=config)
-        self.mostRecentKey = None
+        self.product        = product
+        self.bucketName     = bucketName
+        self.client         = boto3.client("s3", config=config)
+        self.mostRecentKey  = None
+        self.mostRecentETag = None
 
     def update_key(self):
         now = time.gmtime()
@@ -37,7 +38,8 @@ class AWSHandler:
                 mostRecent = last
 
         if mostRecent is not None:
-            self.mostRecentKey = mostRecent["Key"]
+            self.mostRecentKey  = mostRecent["Key"]
+            self.mostRecentETag = mostRecent["ETag"]
 
         return mostRecent is not None
 
@@ -51,15 +53,19 @@ class AWSHandler:
                 ExpiresIn = expires,
                 )
 
+    def get_cache_key(self):
+        return (self.bucketName, self.mostRecentKey, self.mostRecentETag)
+
 class AWSHRRRHandler:
     def __init__(self, product, bucketName = "noaa-hrrr-bdp-pds", config = None):
         if config is None:
             config = Config(signature_version = UNSIGNED)
 
-        self.product       = product
-        self.bucketName    = bucketName
-        self.client        = boto3.client("s3", config=config)
-        self.mostRecentKey = None
+        self.product        = product
+        self.bucketName     = bucketName
+        self.client         = boto3.client("s3", config=config)
+        self.mostRecentKey  = None
+        self.mostRecentETag = None
 
     def update_key(self):
         now = time.gmtime(time.time() - 3600)
@@ -94,7 +100,8 @@ class AWSHRRRHandler:
                 mostRecent = obj
 
         if mostRecent is not None:
-            self.mostRecentKey = mostRecent["Key"]
+            self.mostRecentKey  = mostRecent["Key"]
+            self.mostRecentETag = mostRecent["ETag"]
 
         return mostRecent is not None
 
@@ -113,6 +120,9 @@ class AWSHRRRHandler:
                 ExpiresIn = expires,
                 )
 
+    def get_cache_key(self):
+        return (self.bucketName, self.mostRecentKey, self.mostRecentETag)
+
 if __name__ == "__main__":
     def test():
         handler = AWSHRRRHandler({"location": "conus", "fileType": "wrfsfcf00"})
@@ -0,0 +1,433 @@
+// Times each stage of turning one GRIB message into an image on its own, and
+// prints the times as JSON. Made to be run by run.py.
+//
+//     bench_stages [--gzipped] [--download-only] [--repeat N] [--threads N]
+//                  [--message N] [--sizes WxH,WxH] [--image PATH] URL
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <string.h>
+#include <math.h>
+#include <time.h>
+
+#include "eccodes.h"
+#include "color_table.h"
+#include "download.h"
+#include "grib2pf.h"
+#include "png_writer.h"
+#include "render.h"
+
+#define MAX_SIZES 16
+#define PALETTE_ENTRIES 16
+
+static const char* MODE_NAMES[] = {
+    "Average_Data",
+    "Nearest_Data",
+    "Nearest_Fast_Data",
+    "Max_Data",
+    "Min_Data",
+};
+
+typedef struct {
+    const char* url;
+    bool gzipped;
+    bool downloadOnly;
+    size_t repeat;
+    size_t threads;
+    size_t message;
+    size_t widths[MAX_SIZES];
+    size_t heights[MAX_SIZES];
+    size_t sizeCount;
+    const char* image;
+} Options;
+
+static double now_ms(void) {
+    struct timespec ts;
+    timespec_get(&ts, TIME_UTC);
+    return ts.tv_sec * 1000.0 + ts.tv_nsec / 1000000.0;
+}
+
+static void print_times(const char* name, const double* times, size_t count,
+                        bool last) {
+    printf("\"%s\": [", name);
+    for (size_t i = 0; i < count; i++) {
+        printf("%s%.3f", i == 0 ? "" : ", ", times[i]);
+    }
+    printf("]%s", last ? "" : ", ");
+}
+
+static int parse_sizes(Options* options, const char* sizes) {
+    options->sizeCount = 0;
+    while (*sizes != '\0') {
+        if (options->sizeCount == MAX_SIZES) {
+            return 1;
+        }
+        char* end;
+        size_t width = strtoul(sizes, &end, 10);
+        if (*end != 'x') {
+            return 1;
+        }
+        size_t height = strtoul(end + 1, &end, 10);
+        if (width == 0 || height == 0 || (*end != ',' && *end != '\0')) {
+            return 1;
+        }
+        options->widths[options->sizeCount]  = width;
+        options->heights[options->sizeCount] = height;
+        options->sizeCount++;
+        sizes = *end == ',' ? end + 1 : end;
+    }
+    return options->sizeCount == 0;
+}
+
+static int parse_options(int argc, char** argv, Options* options) {
+    *options = (Options) {
+        .repeat = 5,
+        .image  = "bench_stages.png",
+    };
+    parse_sizes(options, "1920x1080");
+
+    for (int i = 1; i < argc; i++) {
+        const char* arg = argv[i];
+        bool hasValue = i + 1 < argc;
+        if (strcmp(arg, "--gzipped") == 0) {
+            options->gzipped = true;
+        } else if (strcmp(arg, "--download-only") == 0) {
+            options->downloadOnly = true;
+        } else if (strcmp(arg, "--repeat") == 0 && hasValue) {
+            options->repeat = strtoul(argv[++i], NULL, 10);
+        } else if (strcmp(arg, "--threads") == 0 && hasValue) {
+            options->threads = strtoul(argv[++i], NULL, 10);
+        } else if (strcmp(arg, "--message") == 0 && hasValue) {
+            options->message = strtoul(argv[++i], NULL, 10);
+        } else if (strcmp(arg, "--sizes") == 0 && hasValue) {
+            if (parse_sizes(options, argv[++i])) {
+                return 1;
+            }
+        } else if (strcmp(arg, "--image") == 0 && hasValue) {
+            options->image = argv[++i];
+        } else if (arg[0] != '-' && options->url == NULL) {
+            options->url = arg;
+        } else {
+            return 1;
+        }
+    }
+    if (options->repeat == 0) {
+        options->repeat = 1;
+    }
+    return options->url == NULL;
+}
+
+// Finds message number index of the file by its section 0 lengths. Returns
+// false if there are not that many.
+static bool find_message(const uint8_t* d, size_t size, size_t index,
+                         size_t* offset, size_t* length) {
+    size_t at = 0;
+    for (size_t i = 0; at + 16 <= size; i++) {
+        if (memcmp(d + at, "GRIB", 4) != 0 || d[at + 7] != 2) {
+            return false;
+        }
+        uint64_t messageLength = 0;
+        for (size_t b = 8; b < 16; b++) {
+            messageLength = (messageLength << 8) | d[at + b];
+        }
+        if (messageLength < 16 || messageLength > size - at) {
+            return false;
+        }
+        if (i == index) {
+            *offset = at;
+            *length = messageLength;
+            return true;
+        }
+        at += messageLength;
+    }
+    return false;
+}
+
+// An even spread of colors over the message's values, so each colorizes the
+// same way no matter what the data is
+static ColorTable* make_palette(const GridValues* values, double minimum) {
+    double low = INFINITY, high = -INFINITY;
+    for (size_t i = 0; i < values->size; i++) {
+        double value = grid_value(values, i);
+        if (value < minimum) {
+            continue;
+        }
+        if (value < low) {
+            low = value;
+        }
+        if (value > high) {
+            high = value;
+        }
+    }
+    if (!(high > low)) {
+        low  = 0;
+        high = 1;
+    }
+
+    ColorTable* table = calloc(1, sizeof(*table));
+    if (table == NULL) {
+        return NULL;
+    }
+    table->entries = calloc(PALETTE_ENTRIES, sizeof(*(table->entries)));
+    if (table->entries == NULL) {
+        free(table);
+        return NULL;
+    }
+    table->count = PALETTE_ENTRIES;
+    table->scale = 1;
+    for (size_t i = 0; i < PALETTE_ENTRIES; i++) {
+        ColorEntry* entry = table->entries + i;
+        double position = (double)i / (PALETTE_ENTRIES - 1);
+        entry->value = low + position * (high - low);
+        entry->red   = 255 * position;
+        entry->green = 255 * (1 - fabs(2 * position - 1));
+        entry->blue  = 255 * (1 - position);
+        entry->alpha = i == 0 ? 0 : 255;
+    }
+    return table;
+}
+
+static int bench_download(const Options* options, DownloadedData* data) {
+    DownloadSettings settings = {
+        .logName = "bench",
+        .gzipped = options->gzipped,
+        .url     = options->url,
+        .timeout = 60,
+    };
+
+    double* times = malloc(options->repeat * sizeof(*times));
+    if (times == NULL) {
+        return 1;
+    }
+    for (size_t i = 0; i < options->repeat; i++) {
+        if (i > 0) {
+            free(data->data);
+        }
+        double start = now_ms();
+        *data = download_data(&settings);
+        times[i] = now_ms() - start;
+        if (data->error) {
+            fprintf(stderr, "Could not download %s\n", options->url);
+            free(times);
+            return 1;
+        }
+    }
+
+    printf("\"download\": {\"bytes\": %zu, ", data->totalSize);
+    print_times("times", times, options->repeat, true);
+    printf("}");
+    free(times);
+    return 0;
+}
+
+static int bench_decode(const Options* options, uint8_t* d, size_t size) {
+    double* valueTimes  = malloc(options->repeat * sizeof(*valueTimes));
+    double* latLonTimes = malloc(options->repeat * sizeof(*latLonTimes));
+    if (valueTimes == NULL || latLonTimes == NULL) {
+        free(valueTimes);
+        free(latLonTimes);
+        return 1;
+    }
+
+    size_t points = 0;
+    for (size_t i = 0; i < options->repeat; i++) {
+        DecodedMessage decoded;
+        decoded_message_init(&decoded, d, size);
+        double start = now_ms();
+        const GridValues* values = decoded_message_values(&decoded, false);
+        valueTimes[i] = now_ms() - start;
+        decoded_message_free(&decoded);
+        if (values == NULL) {
+            free(valueTimes);
+            free(latLonTimes);
+            return 1;
+        }
+        points = values->size;
+
+        // latLonValues are only decoded for grids which are not regular
+        decoded_message_init(&decoded, d, size);
+        size_t latLonSize;
+        start = now_ms();
+        decoded_message_lat_lon_values(&decoded, &latLonSize);
+        latLonTimes[i] = now_ms() - start;
+        decoded_message_free(&decoded);
+    }
+
+    printf(", \"decode\": {\"points\": %zu, ", points);
+    print_times("values", valueTimes, options->repeat, false);
+    print_times("latLonValues", latLonTimes, options->repeat, true);
+    printf("}");
+    free(valueTimes);
+    free(latLonTimes);
+    return 0;
+}
+
+// Times binning, contouring, colorizing and saving one image
+static int bench_image(const Options* options, DecodedMessage* decoded,
+                       const ColorTable* table,
+                       const CompiledColorTable* palette, size_t width,
+                       size_t height, int mode, bool first) {
+    MessageSettings message = {
+        .topLeftImageFile = options->image,
+        .palette     = table,
+        .imageWidth  = width,
+        .imageHeight = height,
+        .title       = "bench",
+        .mode        = mode,
+        .minimum     = -998,
+        .png = {
+            .level    = 3,
+            .strategy = -1,
+            .filters  = 0x08, // PNG_FILTER_NONE, the library's default
+        },
+    };
+    const size_t pixels = width * height;
+    const size_t repeat = options->repeat;
+
+    double* times    = malloc(4 * repeat * sizeof(*times));
+    float* contoured = malloc(pixels * sizeof(*contoured));
+    uint8_t* buffer  = malloc(pixels * 4);
+    if (times == NULL || contoured == NULL || buffer == NULL) {
+        free(times);
+        free(contoured);
+        free(buffer);
+        return 1;
+    }
+    double* binTimes      = times;
+    double* contourTimes  = times + repeat;
+    double* colorizeTimes = times + 2 * repeat;
+    double* saveTimes     = times + 3 * repeat;
+
+    // The first binning at a size also works out where each point lands
+    ImageData imData;
+    double gridStart = now_ms();
+    imData = generate_image_data(&message, decoded, false, options->threads);
+    double gridTime = now_ms() - gridStart;
+    if (imData.error) {
+        free(times);
+        free(contoured);
+        free(buffer);
+        return 1;
+    }
+
+    size_t pngBytes = 0;
+    for (size_t i = 0; i < repeat; i++) {
+        free(imData.imageData);
+        double start = now_ms();
+        imData = generate_image_data(&message, decoded, false, options->threads);
+        binTimes[i] = now_ms() - start;
+        if (imData.error) {
+            free(times);
+            free(contoured);
+            free(buffer);
+            return 1;
+        }
+
+        memcpy(contoured, imData.imageData, pixels * sizeof(*contoured));
+        ImageData contourData = imData;
+        contourData.imageData = contoured;
+        start = now_ms();
+        contour_image_data(&message, palette, &contourData);
+        contourTimes[i] = now_ms() - start;
+
+        start = now_ms();
+        colorize_image(palette, imData.imageData, pixels, buffer);
+        colorizeTimes[i] = now_ms() - start;
+
+        start = now_ms();
+        save_image(&message, &imData, buffer, options->threads);
+        saveTimes[i] = now_ms() - start;
+
+        FILE* file = fopen(options->image, "rb");
+        if (file != NULL) {
+            fseek(file, 0, SEEK_END);
+            pngBytes = ftell(file);
+            fclose(file);
+        }
+    }
+    free(imData.imageData);
+    remove(options->image);
+
+    printf("%s{\"width\": %zu, \"height\": %zu, \"mode\": \"%s\", "
+           "\"pngBytes\": %zu, \"firstBin\": %.3f, ",
+           first ? "" : ", ", width, height, MODE_NAMES[mode], pngBytes,
+           gridTime);
+    print_times("bin", binTimes, repeat, false);
+    print_times("contour", contourTimes, repeat, false);
+    print_times("colorize", colorizeTimes, repeat, false);
+    print_times("save", saveTimes, repeat, true);
+    printf("}");
+
+    free(times);
+    free(contoured);
+    free(buffer);
+    return 0;
+}
+
+int main(int argc, char** argv) {
+    Options options;
+    if (parse_options(argc, argv, &options)) {
+        fprintf(stderr, "usage: %s [--gzipped] [--download-only] "
+                "[--repeat N] [--threads N] [--message N] [--sizes WxH,WxH] "
+                "[--image PATH] URL\n", argv[0]);
+        return 2;
+    }
+
+    printf("{\"url\": \"%s\", \"message\": %zu, ", options.url,
+           options.message);
+
+    DownloadedData data = {0};
+    if (bench_download(&options, &data)) {
+        return 1;
+    }
+    if (options.downloadOnly) {
+        printf("}\n");
+        free(data.data);
+        return 0;
+    }
+
+    size_t offset, length;
+    if (!find_message(data.gribStart, data.totalSize, options.message,
+                      &offset, &length)) {
+        fprintf(stderr, "There is no message %zu\n", options.message);
+        return 1;
+    }
+    uint8_t* d = data.gribStart + offset;
+    if (bench_decode(&options, d, length)) {
+        return 1;
+    }
+
+    DecodedMessage decoded;
+    decoded_message_init(&decoded, d, length);
+    const GridValues* values = decoded_message_values(&decoded, false);
+    ColorTable* table = values == NULL ? NULL : make_palette(values, -998);
+    CompiledColorTable* palette = table == NULL ? NULL :
+                                  color_table_compile(table, false);
+    if (palette == NULL) {
+        return 1;
+    }
+
+    printf(", \"images\": [");
+    bool first = true;
+    for (size_t size = 0; size < options.sizeCount; size++) {
+        for (int mode = 0; mode < 5; mode++) {
+            if (bench_image(&options, &decoded, table, palette,
+                            options.widths[size], options.heights[size], mode,
+                            first)) {
+                fprintf(stderr, "Could not render at %zux%zu\n",
+                        options.widths[size], options.heights[size]);
+                return 1;
+            }
+            first = false;
+        }
+    }
+    printf("]}\n");
+
+    compiled_color_table_free(palette);
+    color_table_free(table);
+    decoded_message_free(&decoded);
+    free(data.data);
+    return 0;
+}
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Synthetic GRIB2 files for the benchmarks, shaped like the products grib2pf is
+# used with. They are made the same way every time, so runs can be compared.
+
+import gzip
+import math
+import os
+from array import array
+
+import grib2
+
+MISSING = -999
+
+# MRMS CONUS is 7000x3500, at 0.01 degrees
+MRMS_SIZES = {
+    "small":  (1750, 875),
+    "medium": (3500, 1750),
+    "full":   (7000, 3500),
+}
+
+def storm_field(columns, rows, seed = 0):
+    # Cells of echo on an empty background, like radar reflectivity. About
+    # a third of the points have data.
+    columnWaves = [math.sin((x + seed * 97) * 2 * math.pi / (columns / 7))
+                   for x in range(columns)]
+    rowWaves = [math.sin((y + seed * 31) * 2 * math.pi / (rows / 4))
+                for y in range(rows)]
+
+    values = array("d")
+    for y, rowWave in enumerate(rowWaves):
+        # Cheap noise, so rows do not repeat and do not compress away
+        noise = [((x * 7919 + y * 104729) % 97) / 97 * 8 for x in range(columns)]
+        row = [75 * columnWave * rowWave + n - 10
+               for columnWave, n in zip(columnWaves, noise)]
+        values.extend(value if value > 5 else MISSING for value in row)
+    return values
+
+def smooth_field(columns, rows, seed = 0):
+    # A field which is defined everywhere, like a surface temperature in K
+    values = array("d")
+    for y in range(rows):
+        base = 300 - 40 * y / rows
+        values.extend(base + 8 * math.sin((x + seed * 53) / 40) *
+                      math.cos((y + seed * 17) / 30) for x in range(columns))
+    return values
+
+def mrms_grid(columns, rows):
+    return grib2.regular_ll_grid(columns, rows, 54.995, -129.995, 20.005,
+                                 -60.005)
+
+def hrrr_grid():
+    return grib2.lambert_grid(1799, 1059, 21.138123, -122.719528, 38.5,
+                              -97.5, 3000, 38.5, 38.5)
+
+def mrms(name):
+    columns, rows = MRMS_SIZES[name]
+    return [grib2.message(mrms_grid(columns, rows),
+                          storm_field(columns, rows), discipline = 209,
+                          category = 0, parameter = 16)]
+
+def hrrr():
+    return [grib2.message(hrrr_grid(), smooth_field(1799, 1059),
+                          category = 0, parameter = 0)]
+
+def multi():
+    # Several products in one file, as HRRR and RTMA files are. Each is
+    # a different message, so they do not share a decode.
+    columns, rows = MRMS_SIZES["small"]
+    return [
+        grib2.message(hrrr_grid(), smooth_field(1799, 1059, 0),
+                      category = 0, parameter = 0),
+        grib2.message(hrrr_grid(), smooth_field(1799, 1059, 1),
+                      category = 1, parameter = 1),
+        grib2.message(mrms_grid(columns, rows), storm_field(columns, rows, 1),
+                      discipline = 209, category = 0, parameter = 16),
+        grib2.message(mrms_grid(columns, rows), storm_field(columns, rows, 2),
+                      discipline = 209, category = 0, parameter = 16),
+    ]
+
+# Each fixture, with the function which makes its messages
+FIXTURES = {
+    "mrms_small":  lambda: mrms("small"),
+    "mrms_medium": lambda: mrms("medium"),
+    "mrms_full":   lambda: mrms("full"),
+    "hrrr":        hrrr,
+    "multi":       multi,
+}
+
+def make_fixtures(directory, names = None, log = print):
+    # Writes each fixture as name.grib2 and name.grib2.gz, unless it already
+    # exists. Returns the number of messages in each.
+    os.makedirs(directory, exist_ok = True)
+    counts = {}
+    for name in names or FIXTURES:
+        path = os.path.join(directory, name + ".grib2")
+        countPath = path + ".count"
+        if os.path.exists(path + ".gz") and os.path.exists(countPath):
+            with open(countPath) as file:
+                counts[name] = int(file.read())
+            continue
+
+        log(f"Making {name}")
+        messages = FIXTURES[name]()
+        data = b"".join(messages)
+        with open(path, "wb") as file:
+            file.write(data)
+        with open(path + ".gz", "wb") as file:
+            file.write(gzip.compress(data, 6))
+        with open(countPath, "w") as file:
+            file.write(str(len(messages)))
+        counts[name] = len(messages)
+    return counts
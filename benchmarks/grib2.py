@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Writes simple GRIB2 messages, so the benchmarks do not need any downloads.
+# Values are packed with simple packing (template 5.0) at 16 bits, without a
+# bitmap, so missing data is a value below the minimum, as with MRMS.
+
+import math
+import struct
+from array import array
+
+# Bits per packed value. 16 keeps packing to a byte swap.
+BITS = 16
+
+def signed(value, size):
+    # GRIB2 stores negative numbers with a sign bit, not two's complement
+    if value < 0:
+        return (1 << (size * 8 - 1)) | -value
+    return value
+
+def section(number, payload):
+    return struct.pack(">IB", 5 + len(payload), number) + payload
+
+def micro(degrees):
+    return signed(round(degrees * 1e6), 4)
+
+# Shape of the earth, as a sphere of radius 6371229 m, as HRRR uses
+EARTH = struct.pack(">BBIBIBI", 6, 0, 0, 0, 0, 0, 0)
+
+def regular_ll_grid(ni, nj, lat1, lon1, lat2, lon2):
+    # Scans west to east, then north to south, as MRMS does
+    di = (lon2 - lon1) / (ni - 1)
+    dj = (lat1 - lat2) / (nj - 1)
+    template = EARTH + struct.pack(">IIIIIIBIIIIB",
+            ni, nj, 0, 0xFFFFFFFF,
+            micro(lat1), micro(lon1 % 360), 0x30,
+            micro(lat2), micro(lon2 % 360),
+            round(di * 1e6), round(dj * 1e6), 0x00)
+    return ni * nj, 0, template
+
+def lambert_grid(nx, ny, lat1, lon1, lad, lov, dx, latin1, latin2):
+    # Scans west to east, then south to north, as HRRR does
+    template = EARTH + struct.pack(">IIIIBIIIIBBIIII",
+            nx, ny, micro(lat1), micro(lon1 % 360), 0x08,
+            micro(lad), micro(lov % 360),
+            round(dx * 1000), round(dx * 1000), 0, 0x40,
+            micro(latin1), micro(latin2), micro(-90), 0)
+    return nx * ny, 30, template
+
+def pack(values, decimal):
+    # Values are stored as (value * 10^decimal - reference), in BITS bits
+    scale = 10 ** decimal
+    low = min(values)
+    reference = math.floor(low * scale)
+    packed = array("H", (round(value * scale - reference) for value in values))
+    if max(packed) >= 1 << BITS:
+        raise ValueError("values do not fit in the packing")
+    if packed.itemsize != 2:
+        raise RuntimeError("array H is not 16 bits")
+    packed.byteswap()
+    return reference, packed.tobytes()
+
+def message(grid, values, discipline = 0, category = 16, parameter = 4,
+            decimal = 1, time = (2024, 5, 20, 18, 0, 0)):
+    points, templateNumber, template = grid
+    if len(values) != points:
+        raise ValueError(f"grid has {points} points, but got {len(values)} values")
+
+    year, month, day, hour, minute, second = time
+    identification = section(1, struct.pack(">HHBBBHBBBBBBB",
+            7, 0, 2, 1, 1, year, month, day, hour, minute, second, 0, 0))
+    gridDefinition = section(3, struct.pack(">BIBBH", 0, points, 0, 0,
+                                            templateNumber) + template)
+    product = section(4, struct.pack(">HH", 0, 0) + struct.pack(
+            ">BBBBBHBBIBBIBBI",
+            category, parameter, 2, 0, 0, 0, 0, 1, 0, 1, 0, 0, 255, 0, 0))
+
+    reference, data = pack(values, decimal)
+    representation = section(5, struct.pack(">IH", points, 0) +
+            struct.pack(">f", reference) +
+            struct.pack(">HHBB", 0, signed(decimal, 2), BITS, 0))
+    bitmap = section(6, struct.pack(">B", 255))
+    dataSection = section(7, data)
+
+    body = identification + gridDefinition + product + representation + \
+           bitmap + dataSection + b"7777"
+    return b"GRIB" + struct.pack(">HBBQ", 0, discipline, 2, 16 + len(body)) + body
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Runs bench_stages over the synthetic fixtures, from a file and from a local
+# HTTP server, and saves the times as JSON. Two saved runs can be compared with
+# --compare.
+
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import fixtures
+
+location = os.path.split(__file__)[0]
+
+DEFAULT_SIZES = "960x540,1920x1080,3840x2160"
+
+def find_bench(path):
+    if path is not None:
+        return path
+    for candidate in ("../build/bench_stages", "../build/bench_stages.exe",
+                      "../build/Release/bench_stages.exe"):
+        candidate = os.path.join(location, candidate)
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError("bench_stages was not found, build with -DGRIB2PF_BENCHMARKS=ON or use --bench")
+
+def start_server(directory):
+    # A stand in for the servers files are downloaded from
+    handler = functools.partial(QuietHandler, directory = directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd = location,
+                              capture_output = True, text = True,
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_bench(bench, url, args):
+    result = subprocess.run([bench] + args + [url], capture_output = True,
+                            text = True)
+    if result.returncode != 0:
+        raise RuntimeError(f"bench_stages failed for {url}: {result.stderr.strip()}")
+    return json.loads(result.stdout)
+
+def run(args):
+    bench = find_bench(args.bench)
+    directory = os.path.abspath(args.fixtures)
+    counts = fixtures.make_fixtures(directory, args.only)
+    server = start_server(directory)
+    httpBase = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    common = ["--repeat", str(args.repeat), "--threads", str(args.threads),
+              "--image", os.path.join(directory, "bench_stages.png")]
+    runs = []
+    for name, count in counts.items():
+        fileName = name + ".grib2"
+        fileURL = "file://" + os.path.join(directory, fileName).replace("\\", "/")
+        if not fileURL.startswith("file:///"):
+            fileURL = fileURL.replace("file://", "file:///", 1)
+
+        # Rendering is the same wherever the file came from, so it is only
+        # timed once for each message
+        for message in range(count):
+            print(f"{name} message {message}", file = sys.stderr)
+            result = run_bench(bench, fileURL, common + [
+                    "--message", str(message), "--sizes", args.sizes])
+            runs.append({"fixture": name, "source": "file"} | result)
+
+        for source, url, extra in (
+                ("file.gz", fileURL + ".gz", ["--gzipped"]),
+                ("http", httpBase + fileName, []),
+                ("http.gz", httpBase + fileName + ".gz", ["--gzipped"])):
+            result = run_bench(bench, url, common + extra + ["--download-only"])
+            runs.append({"fixture": name, "source": source} | result)
+    server.shutdown()
+
+    results = {
+        "time":     time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit":   git_commit(),
+        "platform": platform.platform(),
+        "cpus":     os.cpu_count(),
+        "threads":  args.threads,
+        "repeat":   args.repeat,
+        "runs":     runs,
+    }
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as file:
+        json.dump(results, file, indent = 1)
+    print(f"Saved {output}", file = sys.stderr)
+    print_summary(results)
+
+def stage_times(results):
+    # The median of each stage's times, by a name for what was timed
+    times = {}
+    for run in results["runs"]:
+        key = f"{run['fixture']} {run['source']}"
+        if run["source"] == "file":
+            key += f" #{run['message']}"
+        times[f"{key} download"] = statistics.median(run["download"]["times"])
+        if "decode" in run:
+            for stage in ("values", "latLonValues"):
+                times[f"{key} decode {stage}"] = statistics.median(run["decode"][stage])
+        for image in run.get("images", []):
+            imageKey = f"{key} {image['width']}x{image['height']} {image['mode']}"
+            times[f"{imageKey} firstBin"] = image["firstBin"]
+            for stage in ("bin", "contour", "colorize", "save"):
+                times[f"{imageKey} {stage}"] = statistics.median(image[stage])
+    return times
+
+def print_summary(results):
+    for name, value in stage_times(results).items():
+        print(f"{name:<70} {value:10.2f} ms")
+
+def compare(before, after):
+    with open(before) as file:
+        beforeTimes = stage_times(json.load(file))
+    with open(after) as file:
+        afterTimes = stage_times(json.load(file))
+
+    print(f"{'':<70} {'before':>10} {'after':>10} {'change':>8}")
+    for name, old in beforeTimes.items():
+        if name not in afterTimes:
+            continue
+        new = afterTimes[name]
+        change = f"{(new - old) / old * 100:+.1f}%" if old > 0 else ""
+        print(f"{name:<70} {old:10.2f} {new:10.2f} {change:>8}")
+
+def main():
+    p = argparse.ArgumentParser(description = "Time each stage of rendering on synthetic GRIB files")
+    p.add_argument("--bench", help = "path to bench_stages")
+    p.add_argument("--fixtures", default = os.path.join(location, "fixtures"),
+                   help = "where the GRIB files are made")
+    p.add_argument("--only", nargs = "+", choices = list(fixtures.FIXTURES),
+                   help = "fixtures to run, all of them by default")
+    p.add_argument("--sizes", default = DEFAULT_SIZES,
+                   help = "image sizes, as WxH,WxH")
+    p.add_argument("--repeat", type = int, default = 5)
+    p.add_argument("--threads", type = int, default = 0,
+                   help = "threads to render with, 0 for one per core")
+    p.add_argument("--output", help = "where to save the results")
+    p.add_argument("--compare", nargs = 2, metavar = ("BEFORE", "AFTER"),
+                   help = "compare two saved results instead of running")
+    args = p.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args)
+
+if __name__ == "__main__":
+    main()
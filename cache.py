@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import time
+
+# Partial downloads older than this are assumed to be from a crashed process
+PART_MAX_AGE = 3600
+
+class DownloadCache:
+    def __init__(self, directory, maxSize = 1024):
+        self.directory = directory
+        self.maxSize   = maxSize * (1 << 20)
+
+        os.makedirs(self.directory, exist_ok = True)
+
+    def get_path(self, *key):
+        # The key is anything which identifies the contents, such as an S3 key
+        # and its ETag, or a URL which never changes.
+        name = hashlib.sha256("\n".join(key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.directory, name)
+
+        # Mark it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return path
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+
+                if entry.name.endswith(".part"):
+                    if now - stat.st_mtime > PART_MAX_AGE:
+                        self._remove(entry.path)
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.maxSize:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
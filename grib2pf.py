@@ -2,17 +2,21 @@
 
 import requests
 import gzip
+import math
 import time
 import re
 import asyncio
 import os
 import multiprocessing
-from multiprocessing import Process
 import sys
 
 from aws import AWSHandler, AWSHRRRHandler
-from grib2pflib import Grib2PfLib, Settings, ColorTable, MRMSTypedReflSettings
+from cache import DownloadCache
+from grib2pflib import get_lib, Settings, MRMSTypedReflSettings, Validators
+from metrics import combine_metrics, write_metrics
 from nomads import rtma2p5_ru_get_url, aqm_conus_get_url
+from server import PlacefileServer
+from workers import WorkerPool
 
 location = os.path.split(__file__)[0]
 
@@ -81,62 +85,149 @@ Image: "{imageURLs[3]}"
 End:
 """
 
-class GRIBPlacefile:
-    def __init__(
-            self,
-            url,
-            imageFile,
-            placeFile,
-            gzipped = True,
-            palette = None,
-            title = "GRIB Placefile",
-            refresh = 60,
-            imageURL = None,
-            width = 1920,
-            height = 1080,
-            verbose = False,
-            timeout = 30,
-            minimum = -998,
-            contour = False,
-            mode = "Nearest_Data",
-            threshold = 0,
-            area = None):
-
-        self.url = url
-        self.imageFile = imageFile
-        self.placeFile = placeFile
-        self.gzipped = gzipped
-        if imageURL is None:
-            imageURL = imageFile
-        self.imageURL = imageURL
-        self.palette = palette
-        self.title = title
-        self.refresh = refresh
-        self.width = width
-        self.height = height
-        self.verbose = verbose
-        self.timeout = timeout
-        self.minimum = minimum
-        self.contour = contour
-        self.mode = mode
-        self.threshold = threshold
-        self.area = area
-
-        self.proc = None
+# Finds the byte offset and length of each product in a GRIB .idx file. The
+# length runs to the next message, or is 0 for the last message in the file.
+# products maps each product to the indexes of the settings which use it.
+def get_index_offsets(index, products, count, log):
+    entries = []
+    for line in index.splitlines():
+        _, offset, date, ID = line.split(":", 3)
+        entries.append((int(offset), ID))
+
+    starts = sorted(set(offset for offset, _ in entries))
+    ends = dict(zip(starts, starts[1:] + [None]))
+
+    def get_range(offset):
+        end = ends[offset]
+        return offset, 0 if end is None else end - offset
+
+    offsets = [None] * count
+    for offset, ID in entries:
+        if ID in products:
+            for i in products[ID]:
+                offsets[i] = get_range(offset)
+
+    for i in range(len(offsets)):
+        if offsets[i] is None:
+            log("Could not find a product")
+            offsets[i] = get_range(starts[0]) if len(starts) > 0 else (0, 0)
+
+    return offsets
+
+# The area covered by a Web Mercator z/x/y tile
+def get_tile_area(z, x, y):
+    tiles = 1 << z
+    def lat(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / tiles))))
+    return {
+        "lonL": round(x / tiles * 360 - 180, 3),
+        "lonR": round((x + 1) / tiles * 360 - 180, 3),
+        "latT": round(lat(y), 3),
+        "latB": round(lat(y + 1), 3),
+    }
+
+def get_tile_path(pattern, tile):
+    z, x, y = tile
+    return pattern.replace("{z}", str(z)).replace("{x}", str(x)).replace("{y}", str(y))
+
+# Writes how long each stage of making a placefile took, if it has a
+# "metricsFile"
+def write_placefile_metrics(setting, areas, title, log):
+    path = replace_location(setting.get("metricsFile", None))
+    if path is None or len(areas) == 0:
+        return
+    write_metrics(path, setting.get("metricsFormat", "prometheus"), title,
+                  combine_metrics([area["metrics"] for area in areas]), log)
+
+def get_cache(settings):
+    directory = replace_location(settings.get("cacheDirectory", None))
+    if directory is None:
+        return None
+    return DownloadCache(directory, settings.get("cacheSize", 1024))
+
+# Placefiles are generated by _generate in the worker pool. The pool and the
+# last job stay behind when one is sent to a worker.
+class PooledPlacefile:
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("pool", None)
+        state.pop("job", None)
+        return state
+
+    def _submit(self, *args, callback = None):
+        if self.job is not None and not self.job.done():
+            self._log("Stopping old job. Likely failed to update.")
+            self.job.cancel()
+        self.job = None
+
+        self.job = self.pool.submit(self._generate, *args,
+                                    callback = callback)
+
+# Placefiles made from the same GRIB file, such as one product at several
+# sizes, or with several palettes. The file is downloaded once for all of them.
+class GRIBPlaceFiles(PooledPlacefile):
+    def __init__(self, pool, settings):
+        self.settings = settings
+        self.pool     = pool
+        self.job      = None
+
+        first = settings[0]
+        self.url       = first.get("url", None)
+        self.gzipped   = replace_location(first.get("gzipped", True))
+        self.title     = first.get("title", "GRIB Placefile")
+        self.verbose   = any(setting.get("verbose", False) for setting in settings)
+        self.timeout   = min(setting.get("timeout", 30) for setting in settings)
+        self.threads   = first.get("threads", 0)
+        self.cache     = get_cache(first)
+        self.cacheFile = None
+        # The worker sends back its copy once it has updated them
+        self.validators = None
+        if first.get("conditionalRequest", not first.get("aws", False)):
+            self.validators = Validators()
+        # Of the data in each placefile's last image, so it is not rendered
+        # again
+        self.fingerprints = [0] * len(settings)
+        # The tiles last written for each placefile with tiles, so the ones
+        # which no longer have data can be removed
+        self.tiles = [[] for _ in settings]
+
+    def _image_files(self, setting, key):
+        # Large images are split into four. Tiles are named by the library.
+        imageFile = replace_location(setting.get(key, None))
+        if "tiles" in setting:
+            return [imageFile]
+        if setting.get("imageWidth", 1920) > 2048 or \
+                setting.get("imageHeight", 1080) > 2048:
+            return [
+                imageFile.replace("{}", "TopLeft"),
+                imageFile.replace("{}", "TopRight"),
+                imageFile.replace("{}", "BottomLeft"),
+                imageFile.replace("{}", "BottomRight"),
+            ]
+        return [imageFile]
 
     def _generate(self):
-        self._log(f"Generating image")
-        tiled = self.width > 2048 or self.height > 2048
+        self._log(f"Generating images")
 
-        if tiled:
-            imageFiles = [
-                self.imageFile.replace("{}", "TopLeft"),
-                self.imageFile.replace("{}", "TopRight"),
-                self.imageFile.replace("{}", "BottomLeft"),
-                self.imageFile.replace("{}", "BottomRight"),
-            ]
-        else:
-            imageFiles = [self.imageFile]
+        messages = []
+        for setting, fingerprint in zip(self.settings, self.fingerprints):
+            messages.append({
+                "imageFiles":  self._image_files(setting, "imageFile"),
+                # Parsed by the workers, which keep it for the next time
+                "palette":     replace_location(setting.get("palette", None)),
+                "imageWidth":  setting.get("imageWidth", 1920),
+                "imageHeight": setting.get("imageHeight", 1080),
+                "title":       setting.get("title", "GRIB Placefile"),
+                "mode":        setting.get("renderMode", "Average_Data"),
+                "offset":      0,
+                "minimum":     setting.get("minimum", -998),
+                "contour":     setting.get("contour", False),
+                "area":        setting.get("area", None),
+                "floatValues": setting.get("floatValues", False),
+                "png":         setting.get("png", None),
+                "fingerprint": fingerprint,
+                "tiles":       setting.get("tiles", None),
+            })
 
         settings = Settings(self.url,
                             self.gzipped,
@@ -144,91 +235,153 @@ class GRIBPlacefile:
                             self.title,
                             self.timeout,
                             False,
-                            [{
-                                "imageFiles": imageFiles,
-                                "palette": self.palette,
-                                "imageWidth": self.width,
-                                "imageHeight": self.height,
-                                "title": self.title,
-                                "mode": self.mode,
-                                "offset": 0,
-                                "minimum": self.minimum,
-                                "contour": self.contour,
-                                "area": self.area
-                            }])
-        lib = Grib2PfLib()
+                            messages,
+                            cacheFile = self.cacheFile,
+                            validators = self.validators,
+                            threads = self.threads)
+        lib = get_lib()
         err, areas = lib.generate_image(settings)
-        if err:
-            sys.exit(err)
-
-
-        self._log(f"Generating placefile {self.placeFile}")
-        if tiled:
-            imageURLs = [
-                self.imageURL.replace("{}", "TopLeft"),
-                self.imageURL.replace("{}", "TopRight"),
-                self.imageURL.replace("{}", "BottomLeft"),
-                self.imageURL.replace("{}", "BottomRight"),
-            ]
-            with open(self.placeFile, "w") as file:
-                file.write(TILED_PLACEFILE_TEMPLATE.format(
-                        title = self.title,
-                        refresh = self.refresh,
-                        imageURLs = imageURLs,
-                        areas = areas[0],
-                        threshold = self.threshold,
-                    ))
-        else:
-            area = areas[0]
-            latT = area["topLeftArea"]["latT"]
-            latB = area["topLeftArea"]["latB"]
-            lonL = area["topLeftArea"]["lonL"]
-            lonR = area["topLeftArea"]["lonR"]
+        fingerprints = [settings.messages[i].fingerprint
+                        for i in range(len(self.settings))]
+        for setting, area in zip(self.settings, areas):
+            write_placefile_metrics(setting, [area],
+                                    setting.get("title", "GRIB Placefile"),
+                                    self._log)
 
+        # No placefile is written, so each keeps its last images and its last
+        # fingerprint. The tiles written by this run are removed along with
+        # the old ones once it is rendered again.
+        if err:
+            tiles = [list(set(last) | set(area["tiles"]))
+                     for last, area in zip(self.tiles, areas)]
+            return err, self.validators, self.fingerprints, tiles
+
+        # Only messages which were rendered have new tiles
+        tiles = []
+        for i, (setting, area) in enumerate(zip(self.settings, areas)):
+            if fingerprints[i] == self.fingerprints[i]:
+                tiles.append(self.tiles[i])
+                continue
+            tiles.append(area["tiles"])
+
+            imageFile = replace_location(setting.get("imageFile", None))
+            for tile in set(self.tiles[i]) - set(area["tiles"]):
+                try:
+                    os.remove(get_tile_path(imageFile, tile))
+                except FileNotFoundError:
+                    pass
+
+        if self.validators is not None and self.validators.notModified:
+            self._log("Not modified, keeping the last images")
+            return 0, self.validators, fingerprints, tiles
+
+        for i, (setting, area) in enumerate(zip(self.settings, areas)):
+            if settings.messages[i].unchanged:
+                continue
+
+            placeFile = replace_location(setting.get("placeFile", None))
+            title     = setting.get("title", "GRIB Placefile")
+            self._log(f"Generating placefile {placeFile}", title = title)
+
+            urlKey = "imageURL" if "imageURL" in setting else "imageFile"
+            imageURLs = self._image_files(setting, urlKey)
+            if "tiles" in setting:
+                # Only the full resolution tiles, as placefiles do not pick
+                # a zoom
+                zoom = setting["tiles"]["zoom"]
+                with open(placeFile, "w") as file:
+                    file.write(PLACEFILE_HEADER_TEMPLATE.format(
+                            title = title,
+                            refresh = setting.get("refresh", 60),
+                            threshold = setting.get("threshold", 0),
+                        ))
+                    for tile in tiles[i]:
+                        if tile[0] != zoom:
+                            continue
+                        file.write(PLACEFILE_BODY_TEMPLATE.format(
+                                imageURL = get_tile_path(imageURLs[0], tile),
+                                **get_tile_area(*tile),
+                            ))
+            elif len(imageURLs) == 4:
+                with open(placeFile, "w") as file:
+                    file.write(TILED_PLACEFILE_TEMPLATE.format(
+                            title = title,
+                            refresh = setting.get("refresh", 60),
+                            imageURLs = imageURLs,
+                            areas = area,
+                            threshold = setting.get("threshold", 0),
+                        ))
+            else:
+                latT = area["topLeftArea"]["latT"]
+                latB = area["topLeftArea"]["latB"]
+                lonL = area["topLeftArea"]["lonL"]
+                lonR = area["topLeftArea"]["lonR"]
 
-            with open(self.placeFile, "w") as file:
-                file.write(PLACEFILE_TEMPLATE.format(
-                        title = self.title,
-                        refresh = self.refresh,
-                        imageURL = self.imageURL,
-                        latT = latT,
-                        latB = latB,
-                        lonL = lonL,
-                        lonR = lonR,
-                        threshold = self.threshold,
-                    ))
+                with open(placeFile, "w") as file:
+                    file.write(PLACEFILE_TEMPLATE.format(
+                            title = title,
+                            refresh = setting.get("refresh", 60),
+                            imageURL = imageURLs[0],
+                            latT = latT,
+                            latB = latB,
+                            lonL = lonL,
+                            lonR = lonR,
+                            threshold = setting.get("threshold", 0),
+                        ))
         self._log("Finished generating")
-        sys.exit(0)
-
-    def generate(self, url = None):
+        return 0, self.validators, fingerprints, tiles
+
+    def _generated(self, result):
+        err, validators, self.fingerprints, self.tiles = result
+        if self.validators is not None:
+            self.validators = validators
+            # The file has to be downloaded again to render what failed
+            if err:
+                self.validators.etag         = b""
+                self.validators.lastModified = b""
+
+    def generate(self, url = None, cacheKey = None):
         if url is not None:
             self.url = url
 
-        if self.proc is not None and self.proc.is_alive():
-            self._log("Killing old process. Likely failed to update.")
-            self.proc.kill()
-            self.proc.join()
-            self.proc.close()
-        if self.proc is not None:
-            self.proc.close()
+        self.cacheFile = None
+        if self.cache is not None and cacheKey is not None:
+            self.cache.evict()
+            self.cacheFile = self.cache.get_path(*cacheKey)
+
+        # Nothing to keep, so download and render it no matter what
+        missing = False
+        for i, setting in enumerate(self.settings):
+            if not os.path.exists(replace_location(setting.get("placeFile", ""))):
+                self.fingerprints[i] = 0
+                missing = True
+        if self.validators is not None and missing:
+            self.validators.etag         = b""
+            self.validators.lastModified = b""
 
-        self.proc = Process(target = self._generate, daemon = True)
-        self.proc.start()
+        self._submit(callback = self._generated)
 
     def _log(self, *args, **kwargs):
+        if "title" in kwargs:
+            logName = kwargs.pop("title")
+        else:
+            logName = self.title
+
         if self.verbose:
             t = time.strftime(TIME_FMT).format(format(round((time.time() % 1) * 1000), "0>3"))
-            print(t, f"[{self.title}]", *args, **kwargs)
+            print(t, f"[{logName}]", *args, **kwargs)
 
-class MRMSTypedReflectivityPlacefile:
-    def __init__(self, settings):
-        self.proc = None
+class MRMSTypedReflectivityPlacefile(PooledPlacefile):
+    def __init__(self, pool, settings):
+        self.pool = pool
+        self.job  = None
         self.aws = settings["aws"]
         if self.aws:
             self.typeAWS = AWSHandler(settings["typeProduct"])
             self.reflAWS = AWSHandler(settings["reflProduct"])
             self.typeRefreshNeeded = False
             self.reflRefreshNeeded = False
+        self.cache = get_cache(settings)
 
         self.title     = settings.get("title", None)
         self.verbose   = settings.get("verbose", False)
@@ -266,17 +419,20 @@ class MRMSTypedReflectivityPlacefile:
             "imageHeight": settings.get("imageHeight", 1080),
             "mode":        settings.get("renderMode", "Average_Data"),
             "area":        settings.get("area", None),
+            "floatValues": settings.get("floatValues", False),
+            "threads":     settings.get("threads", 0),
+            "png":         settings.get("png", None),
         }
 
     def _generate(self):
         self._log(f"Generating image")
 
         settings = MRMSTypedReflSettings(**self.settings)
-        lib = Grib2PfLib()
+        lib = get_lib()
         err, areas = lib.generate_mrms_typed_refl(settings)
         if err:
             self._log(f"Error generating image, {err}")
-            sys.exit(err)
+            return err
 
         self._log(f"Generating placefile {self.placeFile}")
 
@@ -314,7 +470,7 @@ class MRMSTypedReflectivityPlacefile:
                     ))
 
         self._log("Finished generating")
-        sys.exit(0)
+        return 0
 
     def generate(self):
         if self.aws:
@@ -325,6 +481,12 @@ class MRMSTypedReflectivityPlacefile:
                 return
             self.settings["typeUrl"] = self.typeAWS.get_url()
             self.settings["reflUrl"] = self.reflAWS.get_url()
+            if self.cache is not None:
+                self.cache.evict()
+                self.settings["typeCacheFile"] = self.cache.get_path(
+                        *self.typeAWS.get_cache_key())
+                self.settings["reflCacheFile"] = self.cache.get_path(
+                        *self.reflAWS.get_cache_key())
             self.typeRefreshNeeded = False
             self.reflRefreshNeeded = False
 
@@ -333,16 +495,7 @@ class MRMSTypedReflectivityPlacefile:
             self.typeAWS = None
             self.reflAWS = None
 
-        if self.proc is not None and self.proc.is_alive():
-            self._log("Killing old process. Likely failed to update.")
-            self.proc.kill()
-            self.proc.join()
-            self.proc.close()
-        if self.proc is not None:
-            self.proc.close()
-
-        self.proc = Process(target = self._generate, daemon = True)
-        self.proc.start()
+        self._submit()
 
         if self.aws:
             self.typeAWS = typeAWS
@@ -353,10 +506,11 @@ class MRMSTypedReflectivityPlacefile:
             t = time.strftime(TIME_FMT).format(format(round((time.time() % 1) * 1000), "0>3"))
             print(t, f"[{self.title}]", *args, **kwargs)
 
-class HRRRPlaceFiles:
-    def __init__(self, hrrrs):
+class HRRRPlaceFiles(PooledPlacefile):
+    def __init__(self, pool, hrrrs):
         self.hrrrs = hrrrs
-        self.proc  = None
+        self.pool  = pool
+        self.job   = None
 
         self.timeout = 3600
         self.logName = "HRRR " + hrrrs[0]["product"]["fileType"]
@@ -364,32 +518,29 @@ class HRRRPlaceFiles:
 
         for i, hrrr in enumerate(hrrrs):
             self.timeout = min(hrrr.get("timeout", 30), self.timeout)
-            self.products[hrrr["product"]["productId"]] = i
+            self.products.setdefault(hrrr["product"]["productId"], []).append(i)
 
         self.aws = AWSHRRRHandler(self.hrrrs[0]["product"])
         self.verbose = True
+        self.rangeRequest = hrrrs[0].get("rangeRequest", True)
+        self.stream = hrrrs[0].get("stream", True)
+        self.threads = hrrrs[0].get("threads", 0)
+        self.cache = get_cache(hrrrs[0])
+        # Of the data in each placefile's last image
+        self.fingerprints = [0] * len(hrrrs)
 
     def _get_offsets(self, indexURL):
-        offsets = [-1] * len(self.hrrrs)
         res = requests.get(indexURL, timeout = self.timeout)
-        for line in res.text.splitlines():
-            _, offset, date, ID = line.split(":", 3)
-            if ID in self.products:
-                offsets[self.products[ID]] = int(offset)
-
-        for i in range(len(offsets)):
-            if offsets[i] == -1:
-                self._log("Could not find a product")
-                offsets[i] = 0
+        return get_index_offsets(res.text, self.products, len(self.hrrrs),
+                                 self._log)
 
-        return offsets
-
-    def _generate(self, url, indexURL):
+    def _generate(self, url, indexURL, cacheFile):
         self._log(f"Generating images")
 
         offsets = self._get_offsets(indexURL)
         messages = []
-        for hrrr, offset in zip(self.hrrrs, offsets):
+        for hrrr, (offset, length), fingerprint in zip(self.hrrrs, offsets,
+                                                       self.fingerprints):
             messages.append({
                 "imageFiles":  hrrr["imageFile"],
                 "palette":     hrrr.get("palette", None),
@@ -400,7 +551,11 @@ class HRRRPlaceFiles:
                 "minimum":     hrrr.get("minimum", -998),
                 "contour":     hrrr.get("contour", False),
                 "area":        hrrr.get("area", None),
+                "floatValues": hrrr.get("floatValues", False),
+                "png":         hrrr.get("png", None),
                 "offset":      offset,
+                "length":      length,
+                "fingerprint": fingerprint,
                 })
 
         settings = Settings(
@@ -410,17 +565,30 @@ class HRRRPlaceFiles:
                 logName = self.logName,
                 verbose = True,
                 calcOffsets = False,
-                messages = messages
+                messages = messages,
+                rangeRequest = self.rangeRequest,
+                stream = self.stream,
+                cacheFile = cacheFile,
+                threads = self.threads,
             )
 
-        lib = Grib2PfLib()
+        lib = get_lib()
         err, areas = lib.generate_image(settings)
+        fingerprints = [settings.messages[i].fingerprint
+                        for i in range(len(self.hrrrs))]
+        for hrrr, area in zip(self.hrrrs, areas):
+            write_placefile_metrics(hrrr, [area], hrrr.get("title", "HRRR Data"),
+                                    self._log)
+        # The placefiles are not written, so the fingerprints are kept for
+        # the images they point at
         if err:
             self._log(f"Error generating image, {err}")
-            sys.exit(err)
+            return err, self.fingerprints
 
 
-        for hrrr, area in zip(self.hrrrs, areas):
+        for i, (hrrr, area) in enumerate(zip(self.hrrrs, areas)):
+            if settings.messages[i].unchanged:
+                continue
             self._log(f"Generating placefile {hrrr['placeFile']}", title =
                       hrrr.get("title", "HRRR Data"))
 
@@ -441,32 +609,30 @@ class HRRRPlaceFiles:
                         threshold = hrrr.get("threshold", 0),
                     ))
         self._log("Finished generating")
-        sys.exit(0)
+        return 0, fingerprints
+
+    def _generated(self, result):
+        _, self.fingerprints = result
 
     def generate(self):
         if not self.aws.update_key():
             return
 
-        if self.proc is not None and self.proc.is_alive():
-            self._log("Killing old process. Likely failed to update.")
-            self.proc.kill()
-            self.proc.join()
-            self.proc.close()
-            self.proc = None
-        elif self.proc is not None:
-            print("clossing process")
-            self.proc.close()
-            self.proc = None
+        for i, hrrr in enumerate(self.hrrrs):
+            if not os.path.exists(hrrr["placeFile"]):
+                self.fingerprints[i] = 0
 
         url      = self.aws.get_url(False)
         indexURL = self.aws.get_url(True)
+        cacheFile = None
+        if self.cache is not None:
+            self.cache.evict()
+            cacheFile = self.cache.get_path(*self.aws.get_cache_key())
 
         aws = self.aws
         self.aws = None
 
-        self.proc = Process(target = self._generate, args = (url, indexURL),
-                            daemon = True)
-        self.proc.start()
+        self._submit(url, indexURL, cacheFile, callback = self._generated)
 
         self.aws = aws
 
@@ -480,11 +646,12 @@ class HRRRPlaceFiles:
             t = time.strftime(TIME_FMT).format(format(round((time.time() % 1) * 1000), "0>3"))
             print(t, f"[{logName}]", *args, **kwargs)
 
-class NomadsTimedPlaceFiles:
-    def __init__(self, settings, getUrl, name, count):
+class NomadsTimedPlaceFiles(PooledPlacefile):
+    def __init__(self, pool, settings, getUrl, name, count):
         self.settings = settings
         self.getUrl   = getUrl
-        self.proc     = None
+        self.pool     = pool
+        self.job      = None
         self.lastUrl  = None
 
         self.timeout = 3600
@@ -493,8 +660,14 @@ class NomadsTimedPlaceFiles:
         self.verbose = True
         self.timeout = settings.get("timeout", 30)
         self.count = count
-
-    def _generate(self, url, firstTime, deltaTime):
+        self.stream = settings.get("stream", True)
+        self.threads = settings.get("threads", 0)
+        self.cache = get_cache(settings)
+        # Of the data in each of the last images, and where they were
+        self.fingerprints = [0] * count
+        self.areas = [None] * count
+
+    def _generate(self, url, firstTime, deltaTime, cacheFile):
         self._log(f"Generating images")
 
         messages = []
@@ -509,7 +682,10 @@ class NomadsTimedPlaceFiles:
                 "minimum":     self.settings.get("minimum", -998),
                 "contour":     self.settings.get("contour", False),
                 "area":        self.settings.get("area", None),
+                "floatValues": self.settings.get("floatValues", False),
+                "png":         self.settings.get("png", None),
                 "offset":      index,
+                "fingerprint": self.fingerprints[index],
                 })
 
         settings = Settings(
@@ -519,15 +695,29 @@ class NomadsTimedPlaceFiles:
                 logName = self.logName,
                 verbose = True,
                 calcOffsets = True,
-                messages = messages
+                messages = messages,
+                stream = self.stream,
+                cacheFile = cacheFile,
+                threads = self.threads,
             )
 
-        lib = Grib2PfLib()
+        lib = get_lib()
         err, areas = lib.generate_image(settings)
+        fingerprints = [settings.messages[i].fingerprint
+                        for i in range(self.count)]
+        write_placefile_metrics(self.settings, areas,
+                                self.settings.get("title", "HRRR Data"),
+                                self._log)
         if err:
             self._log(f"Error generating image, {err}")
-            sys.exit(err)
+            return err, self.fingerprints, self.areas
 
+        # Images which were kept are where they were last time. The placefile
+        # is still written, as the time ranges come from this run, and the
+        # fingerprints do not cover the times of the data.
+        unchanged = [settings.messages[i].unchanged for i in range(self.count)]
+        areas = [last if same else area
+                 for area, last, same in zip(areas, self.areas, unchanged)]
 
         self._log(f"Generating placefile {self.settings['placeFile']}", title =
                       self.settings.get("title", "HRRR Data"))
@@ -557,7 +747,10 @@ class NomadsTimedPlaceFiles:
                 currentTime = nextTime
 
         self._log("Finished generating")
-        sys.exit(0)
+        return 0, fingerprints, areas
+
+    def _generated(self, result):
+        _, self.fingerprints, self.areas = result
 
     def generate(self):
         url, firstTime, deltaTime = self.getUrl()
@@ -565,19 +758,17 @@ class NomadsTimedPlaceFiles:
             return
         self.lastUrl = url
 
-        if self.proc is not None and self.proc.is_alive():
-            self._log("Killing old process. Likely failed to update.")
-            self.proc.kill()
-            self.proc.join()
-            self.proc.close()
-            self.proc = None
-        elif self.proc is not None:
-            self.proc.close()
-            self.proc = None
+        if not os.path.exists(self.settings["placeFile"]):
+            self.fingerprints = [0] * self.count
+
+        # NOMADS file names include their time, so they never change
+        cacheFile = None
+        if self.cache is not None:
+            self.cache.evict()
+            cacheFile = self.cache.get_path(url)
 
-        self.proc = Process(target = self._generate, args = (url, firstTime, deltaTime),
-                            daemon = True)
-        self.proc.start()
+        self._submit(url, firstTime, deltaTime, cacheFile,
+                     callback = self._generated)
 
     def _log(self, *args, **kwargs):
         if "title" in kwargs:
@@ -589,11 +780,12 @@ class NomadsTimedPlaceFiles:
             t = time.strftime(TIME_FMT).format(format(round((time.time() % 1) * 1000), "0>3"))
             print(t, f"[{logName}]", *args, **kwargs)
 
-class NomadsIndexedPlaceFiles:
-    def __init__(self, settings, getUrl, name):
+class NomadsIndexedPlaceFiles(PooledPlacefile):
+    def __init__(self, pool, settings, getUrl, name):
         self.settings = settings
         self.getUrl   = getUrl
-        self.proc     = None
+        self.pool     = pool
+        self.job      = None
         self.lastUrl  = None
 
         self.timeout = 3600
@@ -603,30 +795,27 @@ class NomadsIndexedPlaceFiles:
 
         for i, setting in enumerate(settings):
             self.timeout = min(setting.get("timeout", 30), self.timeout)
-            self.products[setting["product"]] = i
+            self.products.setdefault(setting["product"], []).append(i)
+        self.rangeRequest = settings[0].get("rangeRequest", True)
+        self.stream = settings[0].get("stream", True)
+        self.threads = settings[0].get("threads", 0)
+        self.cache = get_cache(settings[0])
+        # Of the data in each placefile's last image
+        self.fingerprints = [0] * len(settings)
 
 
     def _get_offsets(self, indexURL):
-        offsets = [-1] * len(self.settings)
         res = requests.get(indexURL, timeout = self.timeout)
-        for line in res.text.splitlines():
-            _, offset, date, ID = line.split(":", 3)
-            if ID in self.products:
-                offsets[self.products[ID]] = int(offset)
-
-        for i in range(len(offsets)):
-            if offsets[i] == -1:
-                self._log("Could not find a product")
-                offsets[i] = 0
+        return get_index_offsets(res.text, self.products, len(self.settings),
+                                 self._log)
 
-        return offsets
-
-    def _generate(self, url, indexURL):
+    def _generate(self, url, indexURL, cacheFile):
         self._log(f"Generating images")
 
         offsets = self._get_offsets(indexURL)
         messages = []
-        for setting, offset in zip(self.settings, offsets):
+        for setting, (offset, length), fingerprint in zip(self.settings, offsets,
+                                                          self.fingerprints):
             messages.append({
                 "imageFiles":  setting["imageFile"],
                 "palette":     setting.get("palette", None),
@@ -637,7 +826,11 @@ class NomadsIndexedPlaceFiles:
                 "minimum":     setting.get("minimum", -998),
                 "contour":     setting.get("contour", False),
                 "area":        setting.get("area", None),
+                "floatValues": setting.get("floatValues", False),
+                "png":         setting.get("png", None),
                 "offset":      offset,
+                "length":      length,
+                "fingerprint": fingerprint,
                 })
 
         settings = Settings(
@@ -647,17 +840,31 @@ class NomadsIndexedPlaceFiles:
                 logName = self.logName,
                 verbose = True,
                 calcOffsets = False,
-                messages = messages
+                messages = messages,
+                rangeRequest = self.rangeRequest,
+                stream = self.stream,
+                cacheFile = cacheFile,
+                threads = self.threads,
             )
 
-        lib = Grib2PfLib()
+        lib = get_lib()
         err, areas = lib.generate_image(settings)
+        fingerprints = [settings.messages[i].fingerprint
+                        for i in range(len(self.settings))]
+        for setting, area in zip(self.settings, areas):
+            write_placefile_metrics(setting, [area],
+                                    setting.get("title", "HRRR Data"),
+                                    self._log)
+        # The placefiles are not written, so the fingerprints are kept for
+        # the images they point at
         if err:
             self._log(f"Error generating image, {err}")
-            sys.exit(err)
+            return err, self.fingerprints
 
 
-        for setting, area in zip(self.settings, areas):
+        for i, (setting, area) in enumerate(zip(self.settings, areas)):
+            if settings.messages[i].unchanged:
+                continue
             self._log(f"Generating placefile {setting['placeFile']}", title =
                       setting.get("title", "HRRR Data"))
 
@@ -678,7 +885,10 @@ class NomadsIndexedPlaceFiles:
                         threshold = setting.get("threshold", 0),
                     ))
         self._log("Finished generating")
-        sys.exit(0)
+        return 0, fingerprints
+
+    def _generated(self, result):
+        _, self.fingerprints = result
 
     def generate(self):
         url = self.getUrl()
@@ -687,19 +897,16 @@ class NomadsIndexedPlaceFiles:
         self.lastUrl = url
         indexURL = url + ".idx"
 
-        if self.proc is not None and self.proc.is_alive():
-            self._log("Killing old process. Likely failed to update.")
-            self.proc.kill()
-            self.proc.join()
-            self.proc.close()
-            self.proc = None
-        elif self.proc is not None:
-            self.proc.close()
-            self.proc = None
+        for i, setting in enumerate(self.settings):
+            if not os.path.exists(setting["placeFile"]):
+                self.fingerprints[i] = 0
+
+        cacheFile = None
+        if self.cache is not None:
+            self.cache.evict()
+            cacheFile = self.cache.get_path(url)
 
-        self.proc = Process(target = self._generate, args = (url, indexURL),
-                            daemon = True)
-        self.proc.start()
+        self._submit(url, indexURL, cacheFile, callback = self._generated)
 
     def _log(self, *args, **kwargs):
         if "title" in kwargs:
@@ -712,54 +919,59 @@ class NomadsIndexedPlaceFiles:
             print(t, f"[{logName}]", *args, **kwargs)
 
 
-async def run_setting(settings):
-    mainType = settings.get("mainType", "basic")
-    if mainType == "basic":
-        palette = replace_location(settings.get("palette"))
-        if not sys.platform.startswith('win'): # Windows...cant...fork?
-            palette = ColorTable(palette)
-        placefile = GRIBPlacefile(
-                settings.get("url", None),
-                replace_location(settings.get("imageFile", None)),
-                replace_location(settings.get("placeFile", None)),
-                replace_location(settings.get("gzipped", True)),
-                palette,
-                settings.get("title", "GRIB Placefile"),
-                settings.get("refresh", 60),
-                settings.get("imageURL", None),
-                settings.get("imageWidth", 1920),
-                settings.get("imageHeight", 1080),
-                settings.get("verbose", False),
-                settings.get("timeout", 30),
-                settings.get("minimum", -998),
-                settings.get("contour", False),
-                settings.get("renderMode", "Average_Data"),
-                settings.get("threshold", 0),
-                settings.get("area", None))
+# Settings with the same key are made from the same GRIB file. The settings of
+# how and when it is downloaded are part of the key, as a group takes them
+# from its first entry.
+def get_source(settings):
+    download = (
+        settings.get("pullPeriod", 10),
+        settings.get("regenerateTime", None),
+        settings.get("timeout", 30),
+        settings.get("verbose", False),
+        settings.get("threads", 0),
+        settings.get("cacheDirectory", None),
+        settings.get("cacheSize", 1024),
+        settings.get("conditionalRequest", not settings.get("aws", False)),
+    )
+    if settings.get("aws", False):
+        return ("aws", settings["product"], settings.get("gzipped", True),
+                download)
+    return ("url", settings.get("url", None), settings.get("gzipped", True),
+            download)
+
+async def run_gribs(settings, pool):
+    placefile = GRIBPlaceFiles(pool, settings)
+    first = settings[0]
+
+    if first.get("aws", False):
+        awsHandler = AWSHandler(first["product"])
 
-        if settings.get("aws", False):
-            awsHandler = AWSHandler(settings["product"])
+        while True:
+            if awsHandler.update_key():
+                placefile.generate(awsHandler.get_url(),
+                                   awsHandler.get_cache_key())
+            await asyncio.sleep(first.get("pullPeriod", 10))
+        return
 
-            while True:
-                if awsHandler.update_key():
-                    placefile.generate(awsHandler.get_url())
-                await asyncio.sleep(settings.get("pullPeriod", 10))
-            return
+    last = time.time()
+    placefile.generate()
 
-        last = time.time()
-        placefile.generate()
+    if first.get("regenerateTime", None) is not None:
+        while True:
+            now = time.time()
+            dt = first["regenerateTime"] - (now - last)
+            if dt > 0:
+                await asyncio.sleep(dt)
 
-        if settings.get("regenerateTime", None) is not None:
-            while True:
-                now = time.time()
-                dt = settings["regenerateTime"] - (now - last)
-                if dt > 0:
-                    await asyncio.sleep(dt)
+            last = time.time()
+            placefile.generate()
 
-                last = time.time()
-                placefile.generate()
+async def run_setting(settings, pool):
+    mainType = settings.get("mainType", "basic")
+    if mainType == "basic":
+        await run_gribs([settings], pool)
     elif mainType == "MRMSTypedReflectivity":
-        placefile = MRMSTypedReflectivityPlacefile(settings)
+        placefile = MRMSTypedReflectivityPlacefile(pool, settings)
 
         if settings.get("aws", False):
             while True:
@@ -780,55 +992,99 @@ async def run_setting(settings):
                 last = time.time()
                 placefile.generate()
 
-async def run_hrrrs(hrrrs):
-    placefile = HRRRPlaceFiles(hrrrs)
+async def run_hrrrs(hrrrs, pool):
+    placefile = HRRRPlaceFiles(pool, hrrrs)
     while True:
         placefile.generate()
         await asyncio.sleep(hrrrs[0].get("pullPeriod", 10))
 
-async def run_rtma2p5_rus(settings):
-    placefile = NomadsIndexedPlaceFiles(settings, rtma2p5_ru_get_url, "RTMA2p5 RU")
+async def run_rtma2p5_rus(settings, pool):
+    placefile = NomadsIndexedPlaceFiles(pool, settings, rtma2p5_ru_get_url,
+                                        "RTMA2p5 RU")
     while True:
         placefile.generate()
         await asyncio.sleep(settings[0].get("pullPeriod", 10))
 
-async def run_aqm_conus(settings):
-    placefile = NomadsTimedPlaceFiles(settings, aqm_conus_get_url, "AQM", 24)
+async def run_aqm_conus(settings, pool):
+    placefile = NomadsTimedPlaceFiles(pool, settings, aqm_conus_get_url, "AQM",
+                                      24)
     while True:
         placefile.generate()
         await asyncio.sleep(settings.get("pullPeriod", 10))
 
+def get_server(serverSettings, settings):
+    server = PlacefileServer(replace_location(serverSettings.get("root", "{_internal}")),
+                             serverSettings.get("host", ""),
+                             serverSettings.get("port", 8080),
+                             serverSettings.get("maxAge", 60),
+                             serverSettings.get("cacheSize", 256),
+                             serverSettings.get("verbose", False))
+
+    # Clients may keep a placefile's files until it could next be updated
+    for setting in settings:
+        if setting.get("regenerateTime", None) is not None:
+            maxAge = setting["regenerateTime"]
+        else:
+            maxAge = setting.get("pullPeriod", 10)
+        for key in ("placeFile", "imageFile"):
+            if isinstance(setting.get(key, None), str):
+                server.add_max_age(replace_location(setting[key]), maxAge)
+    return server
+
 async def run_settings(settings):
     if isinstance(settings, dict):
         # TODO color
         print("WARNING: The settings format you are using is depricated. Recommend switching to using a list of objects.")
-        await run_setting(settings)
+        await run_setting(settings, WorkerPool(1))
     elif isinstance(settings, list):
+        runs = []
+        gribs = {}
+        hrrrs = {}
+        rtma2p5_rus = []
+        poolSettings = {}
+        serverSettings = None
+        for setting in settings:
+            match setting.get("mainType", "basic"):
+                case "basic":
+                    gribs.setdefault(get_source(setting), [])
+                    gribs[get_source(setting)].append(setting)
+                case "HRRR":
+                    location = setting["product"]["location"]
+                    fileType = setting["product"]["fileType"]
+
+                    hrrrs.setdefault(location, {})
+                    hrrrs[location].setdefault(fileType, [])
+
+                    hrrrs[location][fileType].append(setting)
+                case "RTMA2P5_RU":
+                    rtma2p5_rus.append(setting)
+                case "AQM_CONUS":
+                    runs.append((run_aqm_conus, setting))
+                case "workerPool":
+                    poolSettings = setting
+                case "server":
+                    serverSettings = setting
+                case _:
+                    runs.append((run_setting, setting))
+        for group in gribs.values():
+            runs.append((run_gribs, group))
+        if len(hrrrs) > 0:
+            for location in hrrrs.values():
+                for fileType in location.values():
+                    runs.append((run_hrrrs, fileType))
+        if len(rtma2p5_rus) > 0:
+            runs.append((run_rtma2p5_rus, rtma2p5_rus))
+
+        # By default, every placefile can be generated at the same time
+        pool = WorkerPool(poolSettings.get("workers", max(1, len(runs))),
+                          poolSettings.get("maxJobs", 100),
+                          poolSettings.get("maxMemory", 0))
+
         async with asyncio.TaskGroup() as tg:
-            hrrrs = {}
-            rtma2p5_rus = []
-            for setting in settings:
-                match setting.get("mainType", ""):
-                    case "HRRR":
-                        location = setting["product"]["location"]
-                        fileType = setting["product"]["fileType"]
-
-                        hrrrs.setdefault(location, {})
-                        hrrrs[location].setdefault(fileType, [])
-
-                        hrrrs[location][fileType].append(setting)
-                    case "RTMA2P5_RU":
-                        rtma2p5_rus.append(setting)
-                    case "AQM_CONUS":
-                        tg.create_task(run_aqm_conus(setting))
-                    case _:
-                        tg.create_task(run_setting(setting))
-            if len(hrrrs) > 0:
-                for location in hrrrs.values():
-                    for fileType in location.values():
-                        tg.create_task(run_hrrrs(fileType))
-            if len(rtma2p5_rus) > 0:
-                tg.create_task(run_rtma2p5_rus(rtma2p5_rus))
+            if serverSettings is not None:
+                tg.create_task(get_server(serverSettings, settings).run())
+            for run, setting in runs:
+                tg.create_task(run(setting, pool))
 
 
 def main():
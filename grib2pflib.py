@@ -46,6 +46,7 @@ class ColorTable(Structure):
         ("count", c_size_t),
         ("scale", c_double),
         ("offset", c_double),
+        ("step", c_double),
     ]
 
     COMBINE_SPACES_REGEX = re.compile(r"  +")
@@ -53,7 +54,7 @@ class ColorTable(Structure):
         Structure.__init__(self)
         self.scale  = c_double(1)
         self.offset = c_double(0)
-        self.step   = None
+        self.step   = c_double(0)
         self.rf     = (0, 0, 0, 0)
 
         if filename is None:
@@ -110,7 +111,7 @@ class ColorTable(Structure):
                         elif name == "offset":
                             self.offset = c_double(float(value))
                         elif name == "step":
-                            self.step = float(value)
+                            self.step = c_double(float(value))
                         elif name == "rf":
                             self.rf = self._parse_color(value, "rf", False)
                         elif name == "color":
@@ -183,6 +184,23 @@ class ColorTable(Structure):
     def __str__(self):
         return "\n".join(str(entrie) for entrie in self.entries[0:self.count])
 
+# Parsed color tables, kept for as long as their file does not change, so a
+# worker only parses each palette once
+colorTables = {}
+
+def load_color_table(filename = None):
+    if filename is None:
+        mtime = None
+    else:
+        mtime = os.path.getmtime(filename)
+
+    if filename in colorTables and colorTables[filename][0] == mtime:
+        return colorTables[filename][1]
+
+    table = ColorTable(filename)
+    colorTables[filename] = (mtime, table)
+    return table
+
 RenderModes = {
     "Average_Data": 0,
     "Nearest_Data": 1,
@@ -191,6 +209,138 @@ RenderModes = {
     "Min_Data": 4,
 }
 
+class PngSettings(Structure):
+    _fields_ = [
+        ("level", c_int),
+        ("strategy", c_int),
+        ("filters", c_int),
+        ("indexed", c_bool),
+    ]
+
+    STRATEGIES = {
+        "default":  0,
+        "filtered": 1,
+        "huffman":  2,
+        "rle":      3,
+        "fixed":    4,
+    }
+
+    FILTERS = {
+        "none":  0x08,
+        "sub":   0x10,
+        "up":    0x20,
+        "avg":   0x40,
+        "paeth": 0x80,
+    }
+
+    # Several times faster than libpng's defaults, and usually gives smaller
+    # files for our images. See "Image Compression" in the README.
+    DEFAULT = {
+        "level":    3,
+        "strategy": None,
+        "filters":  "none",
+        "indexed":  False,
+    }
+
+    def __init__(self, settings = None):
+        Structure.__init__(self)
+        if settings is None:
+            settings = {}
+        settings = self.DEFAULT | settings
+
+        # None keeps libpng's default
+        level    = settings["level"]
+        strategy = settings["strategy"]
+        filters  = settings["filters"]
+
+        self.level = c_int(-1 if level is None else level)
+
+        if strategy is None:
+            self.strategy = c_int(-1)
+        else:
+            self.strategy = c_int(self.STRATEGIES[strategy])
+
+        if filters is None:
+            self.filters = c_int(-1)
+        else:
+            if isinstance(filters, str):
+                filters = [filters]
+            flags = 0
+            for name in filters:
+                if name == "all":
+                    flags |= sum(self.FILTERS.values())
+                else:
+                    flags |= self.FILTERS[name]
+            self.filters = c_int(flags)
+
+        self.indexed = c_bool(settings["indexed"])
+
+class TilePyramidSettings(Structure):
+    _fields_ = [
+        ("enabled", c_bool),
+        ("zoom", c_int),
+        ("minZoom", c_int),
+    ]
+
+    def __init__(self, settings = None):
+        Structure.__init__(self)
+        # None writes one image instead
+        if settings is None:
+            self.enabled = c_bool(False)
+            return
+
+        zoom = settings["zoom"]
+        self.enabled = c_bool(True)
+        self.zoom    = c_int(zoom)
+        self.minZoom = c_int(settings.get("minZoom", zoom))
+
+class TileIndex(Structure):
+    _fields_ = [
+        ("z", c_int),
+        ("x", c_int),
+        ("y", c_int),
+    ]
+
+# How long each stage of rendering a message took, in milliseconds
+class MessageMetrics(Structure):
+    _fields_ = [
+        ("decodeTime", c_double),
+        ("gridTime", c_double),
+        ("points", c_size_t),
+        ("binTime", c_double),
+        ("contourTime", c_double),
+        ("colorizeTime", c_double),
+        ("encodeTime", c_double),
+        ("outputBytes", c_size_t),
+    ]
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name, _ in self._fields_}
+
+# How long the download took, in milliseconds, and how much it was
+class DownloadMetrics(Structure):
+    _fields_ = [
+        ("received", c_size_t),
+        ("bytes", c_size_t),
+        ("time", c_double),
+        ("inflateTime", c_double),
+    ]
+
+    def as_dict(self):
+        return {
+            "downloadReceived": self.received,
+            "downloadBytes":    self.bytes,
+            "downloadTime":     self.time,
+            "inflateTime":      self.inflateTime,
+        }
+
+class Validators(Structure):
+    _fields_ = [
+        ("etag", c_char * 256),
+        ("lastModified", c_char * 64),
+        ("notModified", c_bool),
+    ]
+
 class MessageSettings(Structure):
     _fields_ = [
         ("tiled", c_bool),
@@ -206,17 +356,30 @@ class MessageSettings(Structure):
         ("mode", c_int),
         ("minimum", c_double),
         ("contour", c_bool),
+        ("floatValues", c_bool),
 
         ("customArea", c_bool),
         ("area", ImageArea),
 
         ("offset", c_size_t),
+        ("length", c_size_t),
+
+        ("png", PngSettings),
+        ("pyramid", TilePyramidSettings),
+
+        ("fingerprint", c_uint64),
+        ("unchanged", c_bool),
 
         ("output", OutputImageAreas),
+        ("metrics", MessageMetrics),
+        ("tiles", POINTER(TileIndex)),
+        ("tileCount", c_size_t),
     ]
 
     def set(self, imageFiles, palette, imageWidth, imageHeight, title,
-                 mode, offset, minimum, contour, area = None):
+                 mode, offset, minimum, contour, area = None, length = 0,
+                 floatValues = False, png = None, fingerprint = 0,
+                 tiles = None):
 
         if isinstance(mode, str):
             mode = RenderModes[mode]
@@ -224,7 +387,7 @@ class MessageSettings(Structure):
         if isinstance(palette, ColorTable):
             self.palette_ = palette
         else:
-            self.palette_ = ColorTable(palette)
+            self.palette_ = load_color_table(palette)
 
         if isinstance(imageFiles, str):
             self.tiled = c_bool(False)
@@ -247,8 +410,10 @@ class MessageSettings(Structure):
         self.title       = c_char_p(title.encode("utf-8"))
         self.mode        = c_int(mode)
         self.offset      = c_size_t(offset)
+        self.length      = c_size_t(length)
         self.minimum     = c_double(minimum)
         self.contour     = c_bool(contour)
+        self.floatValues = c_bool(floatValues)
         if area is None:
             self.customArea = c_bool(False)
             self.area       = ImageArea()
@@ -260,7 +425,10 @@ class MessageSettings(Structure):
             self.area.lonL  = area["left"]
             self.area.lonR  = area["right"]
 
-        self.output = OutputImageAreas()
+        self.png         = PngSettings(png)
+        self.pyramid     = TilePyramidSettings(tiles)
+        self.fingerprint = c_uint64(fingerprint)
+        self.output      = OutputImageAreas()
 
 
 class Settings(Structure):
@@ -271,12 +439,20 @@ class Settings(Structure):
         ("logName", c_char_p),
         ("verbose", c_bool),
         ("calcOffsets", c_bool),
+        ("rangeRequest", c_bool),
+        ("stream", c_bool),
+        ("cacheFile", c_char_p),
+        ("validators", POINTER(Validators)),
+        ("metrics", POINTER(DownloadMetrics)),
+        ("threads", c_size_t),
 
         ("messageCount", c_size_t),
         ("messages", POINTER(MessageSettings)),
     ]
 
-    def __init__(self, url, gzipped, verbose, logName, timeout, calcOffsets, messages):
+    def __init__(self, url, gzipped, verbose, logName, timeout, calcOffsets,
+                 messages, rangeRequest = False, stream = False,
+                 cacheFile = None, validators = None, threads = 0):
         Structure.__init__(self)
 
         self.messages_ = (MessageSettings * len(messages))()
@@ -288,6 +464,16 @@ class Settings(Structure):
         self.verbose      = c_bool(verbose)
         self.timeout      = c_ulonglong(timeout)
         self.calcOffsets  = c_bool(calcOffsets)
+        self.rangeRequest = c_bool(rangeRequest)
+        self.stream       = c_bool(stream)
+        if cacheFile is not None:
+            self.cacheFile = c_char_p(cacheFile.encode("utf-8"))
+        if validators is not None:
+            self.validators_ = validators
+            self.validators  = pointer(validators)
+        self.metrics_     = DownloadMetrics()
+        self.metrics      = pointer(self.metrics_)
+        self.threads      = c_size_t(threads)
         self.logName      = c_char_p(logName.encode("utf-8"))
         self.messageCount = c_size_t(len(messages))
         self.messages     = cast(self.messages_, POINTER(MessageSettings))
@@ -296,6 +482,8 @@ class MRMSTypedReflSettings(Structure):
     _fields_ = [
         ("typeUrl", c_char_p),
         ("reflUrl", c_char_p),
+        ("typeCacheFile", c_char_p),
+        ("reflCacheFile", c_char_p),
         ("timeout", c_ulonglong),
         ("title", c_char_p),
         ("verbose", c_bool),
@@ -314,9 +502,13 @@ class MRMSTypedReflSettings(Structure):
         ("imageWidth", c_size_t),
         ("imageHeight", c_size_t),
         ("mode", c_int),
+        ("floatValues", c_bool),
+        ("threads", c_size_t),
 
         ("customArea", c_bool),
         ("area", ImageArea),
+
+        ("png", PngSettings),
     ]
 
     def __init__(self,
@@ -334,7 +526,12 @@ class MRMSTypedReflSettings(Structure):
                  imageWidth,
                  imageHeight,
                  mode,
-                 area):
+                 area,
+                 typeCacheFile = None,
+                 reflCacheFile = None,
+                 floatValues = False,
+                 threads = 0,
+                 png = None):
         Structure.__init__(self)
 
         if isinstance(imageFiles, str):
@@ -358,20 +555,24 @@ class MRMSTypedReflSettings(Structure):
         if isinstance(rainPalette, ColorTable):
             self.rainPalette_ = rainPalette
         else:
-            self.rainPalette_ = ColorTable(rainPalette)
+            self.rainPalette_ = load_color_table(rainPalette)
 
         if isinstance(snowPalette, ColorTable):
             self.snowPalette_ = snowPalette
         else:
-            self.snowPalette_ = ColorTable(snowPalette)
+            self.snowPalette_ = load_color_table(snowPalette)
 
         if isinstance(hailPalette, ColorTable):
             self.hailPalette_ = hailPalette
         else:
-            self.hailPalette_ = ColorTable(hailPalette)
+            self.hailPalette_ = load_color_table(hailPalette)
 
         self.typeUrl     = c_char_p(typeUrl.encode("utf-8"))
         self.reflUrl     = c_char_p(reflUrl.encode("utf-8"))
+        if typeCacheFile is not None:
+            self.typeCacheFile = c_char_p(typeCacheFile.encode("utf-8"))
+        if reflCacheFile is not None:
+            self.reflCacheFile = c_char_p(reflCacheFile.encode("utf-8"))
         self.timeout     = c_ulonglong(timeout)
         self.title       = c_char_p(title.encode("utf-8"))
         self.gzipped     = c_bool(gzipped)
@@ -384,6 +585,8 @@ class MRMSTypedReflSettings(Structure):
         self.imageWidth  = c_size_t(imageWidth)
         self.imageHeight = c_size_t(imageHeight)
         self.mode        = c_int(mode)
+        self.floatValues = c_bool(floatValues)
+        self.threads     = c_size_t(threads)
 
         if area is None:
             self.customArea = c_bool(False)
@@ -396,6 +599,8 @@ class MRMSTypedReflSettings(Structure):
             self.area.lonL  = area["left"]
             self.area.lonR  = area["right"]
 
+        self.png = PngSettings(png)
+
     def set_url(self, typeUrl, reflUrl):
         self.typeUrl = c_char_p(typeUrl.encode("utf-8"))
         self.reflUrl = c_char_p(reflUrl.encode("utf-8"))
@@ -459,7 +664,14 @@ class Grib2PfLib:
                     "latT": round(settings.messages[i].output.bottomRightArea.latT, 3),
                     "latB": round(settings.messages[i].output.bottomRightArea.latB, 3),
                 },
+                "tiles": [(tile.z, tile.x, tile.y) for tile in
+                          settings.messages[i].tiles[:settings.messages[i].tileCount]],
+                # The download is shared by every message
+                "metrics": settings.metrics_.as_dict() |
+                           settings.messages[i].metrics.as_dict() |
+                           {"unchanged": settings.messages[i].unchanged},
             })
+            self.lib.free_tile_list(byref(settings.messages[i]))
 
         return err, areas
 
@@ -500,7 +712,14 @@ class Grib2PfLib:
 
         return err, areas
 
+# The library, loaded once for each process
+sharedLib = None
 
+def get_lib():
+    global sharedLib
+    if sharedLib is None:
+        sharedLib = Grib2PfLib()
+    return sharedLib
 
 if __name__ == "__main__":
     c = ColorTable()
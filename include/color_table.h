@@ -25,12 +25,87 @@ typedef struct {
 
     double scale;
     double offset;
+    double step; // Spacing of the bins values are put in, 0 for none
 } ColorTable;
 
+// Limits on the number of bins in a compiled color table
+#define COMPILED_COLOR_TABLE_MIN_SIZE (1 << 12)
+#define COMPILED_COLOR_TABLE_MAX_SIZE (1 << 16)
+
+// A color table sampled into evenly sized bins, so finding a color does not
+// need a search. Colors are at most one off in each channel, as long as the
+// table did not need more than COMPILED_COLOR_TABLE_MAX_SIZE bins.
+// Stepped tables use the table's step as the bins instead, and every value in
+// a bin gets the color at its start.
+typedef struct {
+    const ColorTable* table;
+    double start;      // Scaled value at the start of the first bin
+    double resolution; // Width of each bin, in scaled values
+    double binsPerValue;
+    size_t size;       // Number of bins, 0 if every value is out of range
+
+    uint8_t* colors;  // RGBA for each bin
+    int16_t* indexes; // Table index for each bin
+    bool* exact;      // Bins which an entry falls in, which use the table
+} CompiledColorTable;
+
 void color_table_print(const ColorTable* self);
 ColorTable* color_table_read(FILE* file);
 void color_table_get(const ColorTable* self, double value, uint8_t* color);
+void color_table_get_scaled(const ColorTable* self, double value,
+                            uint8_t* color);
 ssize_t color_table_get_index(const ColorTable* self, double value);
+ssize_t color_table_get_index_scaled(const ColorTable* self, double value);
 void color_table_free(ColorTable* self);
 
+// When stepped, values are put in the table's step bins, if it has a step
+CompiledColorTable* color_table_compile(const ColorTable* self, bool stepped);
+void compiled_color_table_free(CompiledColorTable* self);
+
+// Finds the bin for a scaled value. -1 if it is outside of the bins.
+static inline ssize_t compiled_color_table_position(
+        const CompiledColorTable* self, double value) {
+    double position = (value - self->start) * self->binsPerValue;
+    if (!(position >= 0 && position < self->size)) {
+        return -1;
+    }
+    return position;
+}
+
+// Finds the bin for a scaled value. -1 if it is outside of the bins, or if the
+// table needs to be used.
+static inline ssize_t compiled_color_table_bin(const CompiledColorTable* self,
+                                               double value) {
+    ssize_t bin = compiled_color_table_position(self, value);
+    if (bin < 0 || self->exact[bin]) {
+        return -1;
+    }
+    return bin;
+}
+
+static inline void compiled_color_table_get(const CompiledColorTable* self,
+                                            double value, uint8_t* color) {
+    value = value * self->table->scale + self->table->offset;
+    ssize_t bin = compiled_color_table_bin(self, value);
+    if (bin < 0) {
+        color_table_get_scaled(self->table, value, color);
+        return;
+    }
+    const uint8_t* binColor = self->colors + bin * 4;
+    color[0] = binColor[0];
+    color[1] = binColor[1];
+    color[2] = binColor[2];
+    color[3] = binColor[3];
+}
+
+static inline ssize_t compiled_color_table_get_index(
+        const CompiledColorTable* self, double value) {
+    value = value * self->table->scale + self->table->offset;
+    ssize_t bin = compiled_color_table_bin(self, value);
+    if (bin < 0) {
+        return color_table_get_index_scaled(self->table, value);
+    }
+    return self->indexes[bin];
+}
+
 #endif
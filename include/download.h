@@ -0,0 +1,94 @@
+#ifndef DOWNLOAD_H
+#define DOWNLOAD_H
+
+#include <stdint.h>
+#include <stddef.h>
+#include <stdbool.h>
+
+typedef struct {
+    size_t start;
+    size_t end; // exclusive, SIZE_MAX to read to the end of the file
+    size_t bufferStart;
+} ByteRange;
+
+// A complete GRIB message taken from a streaming download. offset is where it
+// starts in the file, and index is its position among the file's messages.
+typedef struct {
+    uint8_t* data;
+    size_t size;
+    size_t offset;
+    size_t index;
+} GribMessage;
+
+// Validators from the last response, used to make conditional requests so an
+// unchanged file is not downloaded again. Empty strings if unknown.
+typedef struct {
+    char etag[256];
+    char lastModified[64];
+    bool notModified; // set when the server said the file has not changed
+} Validators;
+
+// Decides, from the engine's thread, if a streamed message should be kept.
+typedef bool (*KeepMessage)(void* userp, size_t offset, size_t index);
+
+typedef struct {
+    bool verbose;
+    const char* logName;
+    bool gzipped;
+    const char* url;
+    uint64_t timeout;
+
+    ByteRange* ranges;
+    size_t rangeCount;
+
+    // Split the data into GRIB messages as it arrives, instead of keeping the
+    // whole file. Messages are read with download_next_message.
+    bool stream;
+    KeepMessage keepMessage; // NULL to keep every message
+    void* keepMessageData;
+
+    // The file is read from here if it exists, otherwise whole file downloads
+    // are saved here. NULL to not cache.
+    const char* cacheFile;
+
+    // NULL to always download the file. Updated after each download.
+    Validators* validators;
+} DownloadSettings;
+
+typedef struct {
+    size_t totalSize;
+    uint8_t* gribStart;
+    uint8_t* data;
+    bool ranged; // false if the server ignored the ranges and sent the whole file
+    bool notModified; // nothing was downloaded, as the file has not changed
+    int error;
+
+    // How often the download buffers had to grow after the first allocation
+    size_t reallocs;
+    size_t moved;
+
+    // Bytes which came from the server, before inflating, 0 if the file was
+    // read from the cache. inflateTime is in milliseconds.
+    size_t received;
+    double inflateTime;
+} DownloadedData;
+
+// A download which has been handed to the download engine, but may not have
+// finished yet.
+typedef struct Download Download;
+
+size_t merge_byte_ranges(ByteRange* ranges, size_t count);
+
+// Starts downloading in the background. settings must outlive the download.
+Download* download_start(const DownloadSettings* settings);
+// Waits for the next complete message of a streaming download. Returns false
+// once the download is over, the message must be freed by the caller.
+bool download_next_message(Download* download, GribMessage* message);
+// Stops a streaming download at the next message boundary.
+void download_cancel(Download* download);
+// Waits for the download to finish, and frees it.
+DownloadedData download_finish(Download* download);
+
+DownloadedData download_data(const DownloadSettings* settings);
+
+#endif
@@ -2,6 +2,8 @@
 #define GRIB2PF_H
 
 #include "color_table.h"
+#include "download.h"
+#include "png_writer.h"
 #include <stdbool.h>
 
 typedef struct {
@@ -23,6 +25,44 @@ typedef struct {
     ImageArea bottomRightArea;
 } OutputImageAreas;
 
+// How long the download took, in milliseconds, and how much it was. Streamed
+// downloads are rendered as they arrive, so their time includes rendering,
+// and their bytes only count the messages which were kept.
+typedef struct {
+    size_t received;    // Bytes from the server, 0 if read from the cache
+    size_t bytes;       // Bytes after inflating
+    double time;        // Including inflating
+    double inflateTime;
+} DownloadMetrics;
+
+// Writes a Web Mercator z/x/y tile pyramid instead of one image. Tiles are
+// named from topLeftImageFile, with {z}, {x} and {y} replaced. The data is
+// binned once at zoom, and each lower zoom down to minZoom is downsampled
+// from the one above it. Tiles without any data are not written.
+typedef struct {
+    bool enabled;
+    int zoom;
+    int minZoom;
+} TilePyramidSettings;
+
+typedef struct {
+    int z, x, y;
+} TileIndex;
+
+// How long each stage of rendering a message took, in milliseconds. Stages
+// which did not run are 0. Messages with the same offset share one decode, so
+// only the first of them to be rendered has a decode time.
+typedef struct {
+    double decodeTime;   // Reading the message and its values
+    double gridTime;     // Finding where each point lands, when not cached
+    size_t points;       // Points with data which landed in the image
+    double binTime;      // Including downsampling each zoom of a pyramid
+    double contourTime;
+    double colorizeTime;
+    double encodeTime;   // Compressing and writing the PNGs
+    size_t outputBytes;  // Size of the PNGs
+} MessageMetrics;
+
 typedef struct {
     bool tiled;
     const char* topLeftImageFile;
@@ -37,13 +77,29 @@ typedef struct {
     /*RenderMode*/int mode;
     double minimum;
     bool contour;
+    bool floatValues; // Decode values as floats, which uses half the memory
 
     bool customArea;
     ImageArea area;
 
     size_t offset;
+    size_t length; // Length of the message at offset, 0 if unknown
+
+    PngSettings png;
+    TilePyramidSettings pyramid;
+
+    // Hash of the message's grid and data. When it is the same as the last
+    // one, the message is not rendered again, and unchanged is set. 0 if there
+    // was not a last one.
+    uint64_t fingerprint;
+    bool unchanged;
 
     OutputImageAreas output;
+    MessageMetrics metrics;
+    // Each tile written for a pyramid, from the highest zoom to the lowest.
+    // Freed with free_tile_list.
+    TileIndex* tiles;
+    size_t tileCount;
 } MessageSettings;
 
 typedef struct {
@@ -53,6 +109,12 @@ typedef struct {
     const char* logName;
     bool verbose;
     bool calcOffsets; // Offsets are given as an index, not an offset. It will need to be calculated and replaced
+    bool rangeRequest; // Only download the byte ranges given by each message's offset and length
+    bool stream; // Render each message as soon as it has downloaded
+    const char* cacheFile; // Where the file is cached, NULL to not cache
+    Validators* validators; // NULL to always download the file
+    DownloadMetrics* metrics; // NULL to not measure the download
+    size_t threads; // Threads to render with, 0 for one per core
 
     size_t messageCount;
     MessageSettings* messages;
@@ -61,6 +123,8 @@ typedef struct {
 typedef struct {
     const char* typeUrl;
     const char* reflUrl;
+    const char* typeCacheFile; // NULL to not cache
+    const char* reflCacheFile; // NULL to not cache
     uint64_t timeout;
     const char* title;
     bool verbose;
@@ -79,9 +143,13 @@ typedef struct {
     size_t imageWidth;
     size_t imageHeight;
     /*RenderMode*/int mode;
+    bool floatValues;
+    size_t threads; // 0 for one per core
 
     bool customArea;
     ImageArea area;
+
+    PngSettings png;
 } MRMSTypedReflSettings;
 
 #if defined(GRIB2PF_LIBRARY) && defined(_WIN32)
@@ -91,6 +159,7 @@ typedef struct {
 #endif
 
 GRIB2PF_LIB int generate_image(const Settings* settings);
+GRIB2PF_LIB void free_tile_list(MessageSettings* message);
 
 GRIB2PF_LIB int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                              OutputImageAreas* output);
@@ -0,0 +1,62 @@
+#ifndef GRID_CACHE_H
+#define GRID_CACHE_H
+
+#include <stdint.h>
+#include <stddef.h>
+#include <stdbool.h>
+
+#include "grib2pf.h"
+
+// Everything which decides where a grid's points land in an image
+typedef struct {
+    char grid[33]; // md5 of the grid definition section, empty if unknown
+    size_t imageWidth;
+    size_t imageHeight;
+    bool customArea;
+    ImageArea area;
+} GridKey;
+
+// Where each point of a grid lands in an image, in image coordinates.
+// Separable maps are for grids where every row has the same x positions and
+// every column the same y positions. They keep one x per column and one y per
+// row. Otherwise there is one of each per point, as a single row.
+typedef struct GridMap {
+    GridKey key;
+    ImageArea coords;
+
+    size_t count;
+    bool separable;
+    size_t rows;
+    size_t columns;
+    double* x;
+    double* y;
+
+    size_t users;
+    bool cached;
+    struct GridMap* next;
+} GridMap;
+
+GridMap* grid_map_new(const GridKey* key, size_t rows, size_t columns,
+                      bool separable);
+
+// Where the point at index (row * columns + column) lands
+static inline void grid_map_position(const GridMap* map, size_t row,
+                                     size_t column, size_t index,
+                                     double* x, double* y) {
+    if (map->separable) {
+        *x = map->x[column];
+        *y = map->y[row];
+    } else {
+        *x = map->x[index];
+        *y = map->y[index];
+    }
+}
+
+// Finds a map and marks it as used. NULL if there is not one.
+GridMap* grid_cache_get(const GridKey* key);
+// Offers a new map to the cache. It is still in use by the caller.
+void grid_cache_add(GridMap* map);
+// Stops using a map. It is freed if it is not in the cache.
+void grid_cache_release(GridMap* map);
+
+#endif
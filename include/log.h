@@ -0,0 +1,17 @@
+#ifndef LOG_H
+#define LOG_H
+
+#include <stdbool.h>
+
+typedef struct {
+    bool verbose;
+    const char* logName;
+} LogSettings;
+
+void _log(const LogSettings* settings, char* message);
+
+// Milliseconds from a clock which never goes backwards, for timing how long
+// something takes. Only the difference between two readings means anything.
+double clock_ms(void);
+
+#endif
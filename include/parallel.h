@@ -0,0 +1,16 @@
+#ifndef PARALLEL_H
+#define PARALLEL_H
+
+#include <stddef.h>
+
+// Runs one piece of a job. Pieces may run at the same time, on any thread.
+typedef void (*ParallelTask)(void* data, size_t index);
+
+// The number of threads to use when 0 is asked for, one per core
+size_t parallel_default_threads(void);
+
+// Runs task for every index in [0, count), on up to threads threads. The
+// calling thread does its share of the work. Returns once all of them are done.
+void parallel_run(size_t threads, size_t count, ParallelTask task, void* data);
+
+#endif
@@ -0,0 +1,24 @@
+#ifndef PNG_WRITER_H
+#define PNG_WRITER_H
+
+#include <stddef.h>
+#include <stdint.h>
+#include <stdbool.h>
+
+// How hard zlib works on an image. -1 in any field keeps libpng's default.
+typedef struct {
+    int level;    // zlib compression level, 0 to 9
+    int strategy; // zlib strategy, such as Z_RLE
+    int filters;  // PNG_FILTER_* flags to choose between for each row
+    bool indexed; // Write images with 256 colors or less with a palette
+} PngSettings;
+
+// Writes RGBA data to a file. Rows start stride bytes apart, so part of a
+// larger image can be written. Returns non zero on an error. The size of the
+// file is put in size, unless it is NULL.
+// Indexed images which need more than 256 colors are written as RGBA.
+int write_png(const char* path, const uint8_t* data, size_t width,
+              size_t height, size_t stride, const PngSettings* settings,
+              size_t* size);
+
+#endif
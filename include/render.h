@@ -0,0 +1,77 @@
+#ifndef RENDER_H
+#define RENDER_H
+
+#include <stdint.h>
+#include <stddef.h>
+#include <stdbool.h>
+
+#include "eccodes.h"
+#include "color_table.h"
+#include "grib2pf.h"
+
+// The stages a message goes through to become an image. They are only used by
+// generate_image and generate_mrms_typed_refl, and by the benchmarks, which
+// time each of them on its own.
+
+typedef struct {
+    ImageArea coords;
+    float* imageData; // NAN where there is no data
+    int error;
+} ImageData;
+
+// A message's values, as doubles or as floats
+typedef struct {
+    double* d;
+    float* f;
+    size_t size;
+} GridValues;
+
+static inline double grid_value(const GridValues* values, size_t i) {
+    if (values->f != NULL) {
+        return values->f[i];
+    }
+    return values->d[i];
+}
+
+// A message which every image from it is rendered from, so it is only decoded
+// once. Each part is read the first time an image needs it.
+typedef struct {
+    uint8_t* d;
+    size_t size;
+    codes_handle* h;
+    bool unreadable;
+
+    double* latLonValues;
+    size_t latLonValuesSize;
+    GridValues doubles;
+    GridValues floats;
+} DecodedMessage;
+
+void decoded_message_init(DecodedMessage* self, uint8_t* d, size_t size);
+void decoded_message_free(DecodedMessage* self);
+// NULL if the message could not be read
+codes_handle* decoded_message_handle(DecodedMessage* self);
+// The latitude, longitude and value of each point. NULL on an error.
+const double* decoded_message_lat_lon_values(DecodedMessage* self,
+                                             size_t* size);
+// NULL on an error
+const GridValues* decoded_message_values(DecodedMessage* self,
+                                         bool floatValues);
+
+// Bins the message's values into pixels
+ImageData generate_image_data(MessageSettings* message,
+                              DecodedMessage* decoded, bool verbose,
+                              size_t threads);
+// Returns non zero on an error
+int contour_image_data(MessageSettings* message,
+                       const CompiledColorTable* palette, ImageData* input);
+void colorize_image(const CompiledColorTable* palette, const float* imageData,
+                    size_t pixels, uint8_t* imageBuffer);
+// Writes the image, split into four if the message is tiled. Returns non zero
+// on an error.
+int save_image(MessageSettings* message,
+               ImageData* imData,
+               uint8_t* imageBuffer,
+               size_t threads);
+
+#endif
@@ -0,0 +1,48 @@
+#ifndef TILE_PYRAMID_H
+#define TILE_PYRAMID_H
+
+#include <stddef.h>
+#include <stdbool.h>
+
+#include "grib2pf.h"
+
+// Width and height of a Web Mercator tile, in pixels
+#define TILE_SIZE 256
+// The furthest north or south Web Mercator goes
+#define TILE_MAX_LAT 85.0511287798066
+
+// A block of tiles at one zoom, as one image. Values are NAN where there is no
+// data.
+typedef struct {
+    int z;
+    size_t x, y;          // The top left tile
+    size_t columns, rows; // Tiles across and down
+    float* data;
+} TileLevel;
+
+static inline size_t tile_level_width(const TileLevel* level) {
+    return level->columns * TILE_SIZE;
+}
+
+static inline size_t tile_level_height(const TileLevel* level) {
+    return level->rows * TILE_SIZE;
+}
+
+// Finds the tiles at zoom z which cover area, without allocating data.
+// Returns false if none do.
+bool tile_level_cover(int z, const ImageArea* area, TileLevel* level);
+// The area covered by the tiles from (x, y) for columns by rows tiles
+void tile_area(int z, size_t x, size_t y, size_t columns, size_t rows,
+               ImageArea* area);
+// Makes the level one zoom lower, with each value made from the four above
+// it as mode would bin them. Returns non zero if out of memory.
+int tile_level_downsample(const TileLevel* level, int mode, TileLevel* lower);
+
+// Fills in {z}, {x} and {y} of pattern. Returns false if it does not fit.
+bool tile_path(char* path, size_t size, const char* pattern, int z, size_t x,
+               size_t y);
+// Creates the directories path is in, where they are missing. Returns non zero
+// on an error.
+int make_parent_directories(const char* path);
+
+#endif
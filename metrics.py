@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+
+# The metrics of each message, from the library in milliseconds and bytes, and
+# what they are called in a Prometheus text file. Times are given in seconds
+# there, as Prometheus expects.
+PROMETHEUS_METRICS = [
+    ("downloadReceived", "grib2pf_download_received_bytes", 1,
+     "Bytes received from the server, 0 if read from the cache"),
+    ("downloadBytes", "grib2pf_download_bytes", 1,
+     "Bytes of GRIB data, after inflating"),
+    ("downloadTime", "grib2pf_download_seconds", 1e-3,
+     "Time taken by the download, including inflating"),
+    ("inflateTime", "grib2pf_inflate_seconds", 1e-3,
+     "Time taken inflating the download"),
+    ("decodeTime", "grib2pf_decode_seconds", 1e-3,
+     "Time taken decoding the message"),
+    ("gridTime", "grib2pf_grid_seconds", 1e-3,
+     "Time taken finding where each point lands"),
+    ("points", "grib2pf_points_binned", 1,
+     "Points with data which landed in the image"),
+    ("binTime", "grib2pf_bin_seconds", 1e-3,
+     "Time taken binning points into pixels"),
+    ("contourTime", "grib2pf_contour_seconds", 1e-3,
+     "Time taken contouring the image"),
+    ("colorizeTime", "grib2pf_colorize_seconds", 1e-3,
+     "Time taken coloring the image"),
+    ("encodeTime", "grib2pf_encode_seconds", 1e-3,
+     "Time taken compressing and writing the PNGs"),
+    ("outputBytes", "grib2pf_output_bytes", 1,
+     "Size of the PNGs written"),
+    ("unchanged", "grib2pf_unchanged", 1,
+     "1 if the data had not changed, so nothing was rendered"),
+]
+
+# Download metrics, which are the same for every message of a download
+DOWNLOAD_METRICS = {"downloadReceived", "downloadBytes", "downloadTime",
+                    "inflateTime"}
+
+# The metrics of a placefile made from several messages, such as one for each
+# forecast hour. They share one download, and the rest is added up.
+def combine_metrics(metricsList):
+    combined = dict(metricsList[0])
+    for metrics in metricsList[1:]:
+        for key, value in metrics.items():
+            if key == "unchanged":
+                combined[key] = combined[key] and value
+            elif key not in DOWNLOAD_METRICS:
+                combined[key] += value
+    return combined
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_prometheus(title, metrics, timestamp):
+    label = f'{{title="{escape_label(title)}"}}'
+    lines = []
+    for key, name, scale, description in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        if scale == 1:
+            value = int(metrics[key])
+        else:
+            value = f"{metrics[key] * scale:.6f}"
+        lines.append(f"{name}{label} {value}")
+    lines.append("# HELP grib2pf_last_run_timestamp_seconds When the placefile was last generated")
+    lines.append("# TYPE grib2pf_last_run_timestamp_seconds gauge")
+    lines.append(f"grib2pf_last_run_timestamp_seconds{label} {timestamp:.3f}")
+    return "\n".join(lines) + "\n"
+
+# Writes the metrics from generating a placefile to path, as a Prometheus text
+# file or as JSON lines. Text files are replaced each time, so a node exporter
+# never reads half of one. JSON lines are added to the end.
+def write_metrics(path, metricsFormat, title, metrics, log = print):
+    timestamp = time.time()
+    try:
+        if metricsFormat == "jsonl":
+            with open(path, "a") as file:
+                file.write(json.dumps({
+                    "time":  round(timestamp, 3),
+                    "title": title,
+                } | metrics) + "\n")
+        else:
+            part = f"{path}.{os.getpid()}.part"
+            with open(part, "w") as file:
+                file.write(format_prometheus(title, metrics, timestamp))
+            os.replace(part, path)
+    except OSError as e:
+        log(f"Could not write metrics to {path}: {e}")
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import asyncio
+import email.utils
+import fnmatch
+import gzip
+import hashlib
+import os
+import re
+import stat
+import time
+import urllib.parse
+from collections import OrderedDict
+
+# Requests with more header than this are dropped
+MAX_HEADER_SIZE = 16384
+# Connections without a request for this long are closed
+IDLE_TIMEOUT = 60
+# Tries at reading a file which is being written
+READ_TRIES = 3
+
+TIME_FMT = "[%Y-%m-%d %H:%M:%S.{}]"
+
+CONTENT_TYPES = {
+    ".png":  "image/png",
+    ".txt":  "text/plain; charset=utf-8",
+    ".json": "application/json",
+}
+
+REASONS = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+# A file as it was last read, with what is needed to send it
+class ServedFile:
+    def __init__(self, path, info, body):
+        self.key  = (info.st_mtime_ns, info.st_size)
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size = 16).hexdigest() + '"'
+        self.lastModified = email.utils.formatdate(info.st_mtime, usegmt = True)
+
+        extension = os.path.splitext(path)[1].lower()
+        self.contentType = CONTENT_TYPES.get(extension, "application/octet-stream")
+
+        # Placefiles are text, and shrink a lot. Images are already compressed.
+        self.gzipped     = None
+        self.gzippedEtag = None
+        if not self.contentType.startswith("image/"):
+            self.gzipped     = gzip.compress(body, 6, mtime = 0)
+            self.gzippedEtag = self.etag[:-1] + '-gzip"'
+
+    def size(self):
+        return len(self.body) + (0 if self.gzipped is None else len(self.gzipped))
+
+def accepts_gzip(acceptEncoding):
+    for coding in acceptEncoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        params = params.strip().replace(" ", "")
+        return params not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+def etag_matches(ifNoneMatch, etag):
+    if ifNoneMatch.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    for tag in ifNoneMatch.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+# Serves placefiles and images from a directory. Files are kept in memory and
+# only read again once they change on disk, so clients which refresh often
+# mostly get 304 responses.
+class PlacefileServer:
+    def __init__(self, root, host = "", port = 8080, maxAge = 60,
+                 cacheSize = 256, verbose = False):
+        self.root      = os.path.realpath(root)
+        self.host      = host if host else None
+        self.port      = port
+        self.maxAge    = maxAge
+        self.cacheSize = cacheSize * (1 << 20)
+        self.verbose   = verbose
+
+        # How long clients may keep files matching each pattern
+        self.maxAges = []
+        # Most recently used last
+        self.files     = OrderedDict()
+        self.filesSize = 0
+
+    def add_max_age(self, path, maxAge):
+        # Placeholders such as {} and {z} match anything
+        pattern = re.sub(r"\{[^}]*\}", "*", os.path.realpath(path))
+        self.maxAges.append((pattern, maxAge))
+
+    def _max_age(self, path):
+        for pattern, maxAge in self.maxAges:
+            if fnmatch.fnmatchcase(path, pattern):
+                return maxAge
+        return self.maxAge
+
+    def _resolve(self, target):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        path = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def _load(self, path):
+        # A file can be read while it is being written. It is only kept if it
+        # did not change while it was read.
+        for _ in range(READ_TRIES):
+            try:
+                before = os.stat(path)
+                with open(path, "rb") as file:
+                    body = file.read()
+                after = os.stat(path)
+            except OSError:
+                return None, False
+            if (before.st_mtime_ns, before.st_size) == \
+                    (after.st_mtime_ns, after.st_size) and \
+                    len(body) == after.st_size:
+                return ServedFile(path, after, body), True
+        return ServedFile(path, after, body), False
+
+    async def _get(self, path):
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(info.st_mode):
+            return None
+
+        served = self.files.get(path, None)
+        if served is not None and served.key == (info.st_mtime_ns, info.st_size):
+            self.files.move_to_end(path)
+            return served
+
+        loop = asyncio.get_running_loop()
+        served, complete = await loop.run_in_executor(None, self._load, path)
+        if served is None or not complete:
+            return served
+
+        old = self.files.pop(path, None)
+        if old is not None:
+            self.filesSize -= old.size()
+        self.files[path] = served
+        self.filesSize += served.size()
+        while self.filesSize > self.cacheSize and len(self.files) > 1:
+            _, evicted = self.files.popitem(last = False)
+            self.filesSize -= evicted.size()
+        return served
+
+    def _write(self, writer, status, headers, body = b""):
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+        lines.append("Date: " + email.utils.formatdate(usegmt = True))
+        for name, value in headers.items():
+            lines.append(f"{name}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+    def _error(self, writer, status, keepAlive, headers = None):
+        body = f"{status} {REASONS[status]}\n".encode("utf-8")
+        headers = (headers or {}) | {
+            "Content-Type":   "text/plain; charset=utf-8",
+            "Content-Length": len(body),
+            "Connection":     "keep-alive" if keepAlive else "close",
+        }
+        self._write(writer, status, headers, body)
+        return keepAlive
+
+    # Returns whether the connection can be used for another request
+    async def _respond(self, head, writer):
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            return self._error(writer, 400, False)
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keepAlive = connection != "close"
+        else:
+            keepAlive = connection == "keep-alive"
+        # Request bodies are not read, so the connection can not be reused
+        if headers.get("content-length", "0") != "0" or \
+                "transfer-encoding" in headers:
+            keepAlive = False
+
+        if method not in ("GET", "HEAD"):
+            return self._error(writer, 405, keepAlive, {"Allow": "GET, HEAD"})
+
+        path = self._resolve(target)
+        served = None if path is None else await self._get(path)
+        if served is None:
+            return self._error(writer, 404, keepAlive)
+
+        body = served.body
+        etag = served.etag
+        response = {
+            "Content-Type":  served.contentType,
+            "Cache-Control": f"max-age={self._max_age(path)}",
+            "Last-Modified": served.lastModified,
+        }
+        if served.gzipped is not None:
+            response["Vary"] = "Accept-Encoding"
+            if accepts_gzip(headers.get("accept-encoding", "")):
+                body = served.gzipped
+                etag = served.gzippedEtag
+                response["Content-Encoding"] = "gzip"
+        response["ETag"] = etag
+        response["Connection"] = "keep-alive" if keepAlive else "close"
+
+        if etag_matches(headers.get("if-none-match", ""), etag):
+            response.pop("Content-Type")
+            response.pop("Content-Encoding", None)
+            self._write(writer, 304, response)
+            return keepAlive
+
+        response["Content-Length"] = len(body)
+        self._write(writer, 200, response, b"" if method == "HEAD" else body)
+        return keepAlive
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                                  IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    break
+
+                keepAlive = await self._respond(head, writer)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def run(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port,
+                                            limit = MAX_HEADER_SIZE)
+        self._log(f"Serving {self.root} on port {self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def _log(self, *args):
+        if self.verbose:
+            t = time.strftime(TIME_FMT).format(format(round((time.time() % 1) * 1000), "0>3"))
+            print(t, "[Server]", *args)
@@ -5,6 +5,7 @@
 #include <string.h>
 #include <ctype.h>
 #include <errno.h>
+#include <math.h>
 
 #include "color_table.h"
 
@@ -20,8 +21,11 @@ void color_table_print(const ColorTable* self) {
 }
 
 void color_table_get(const ColorTable* self, double value, uint8_t* color) {
-    value = value * self->scale + self->offset;
+    color_table_get_scaled(self, value * self->scale + self->offset, color);
+}
 
+void color_table_get_scaled(const ColorTable* self, double value,
+                            uint8_t* color) {
     if (self->count == 0 ||
         value < self->entries[0].value) {
         color[0] = 0;
@@ -77,8 +81,12 @@ void color_table_get(const ColorTable* self, double value, uint8_t* color) {
 
 ssize_t color_table_get_index(const ColorTable* self, double value)
 {
-    value = value * self->scale + self->offset;
+    return color_table_get_index_scaled(self,
+                                        value * self->scale + self->offset);
+}
 
+ssize_t color_table_get_index_scaled(const ColorTable* self, double value)
+{
     if (self->count == 0 ||
         value < self->entries[0].value) {
         return -1;
@@ -101,3 +109,159 @@ void color_table_free(ColorTable* self) {
     free(self);
 }
 
+// The most any channel changes per unit of value, between two entries
+double color_entry_slope(const ColorEntry* lower, const ColorEntry* upper) {
+    double width = upper->value - lower->value;
+    if (width <= 0) {
+        return 0;
+    }
+
+    int channels[4];
+    if (lower->has2) {
+        channels[0] = lower->red2   - lower->red;
+        channels[1] = lower->green2 - lower->green;
+        channels[2] = lower->blue2  - lower->blue;
+        channels[3] = lower->alpha2 - lower->alpha;
+    } else {
+        channels[0] = upper->red   - lower->red;
+        channels[1] = upper->green - lower->green;
+        channels[2] = upper->blue  - lower->blue;
+        channels[3] = upper->alpha - lower->alpha;
+    }
+
+    int most = 0;
+    for (size_t i = 0; i < 4; i++) {
+        if (abs(channels[i]) > most) {
+            most = abs(channels[i]);
+        }
+    }
+    return most / width;
+}
+
+// Fills in each bin from the value at its start. Returns false if out of
+// memory.
+bool color_table_compile_bins(const ColorTable* self,
+                              CompiledColorTable* compiled) {
+    compiled->colors  = malloc(compiled->size * 4 * sizeof(*(compiled->colors)));
+    compiled->indexes = malloc(compiled->size * sizeof(*(compiled->indexes)));
+    compiled->exact   = calloc(compiled->size, sizeof(*(compiled->exact)));
+    if (compiled->colors == NULL || compiled->indexes == NULL ||
+            compiled->exact == NULL) {
+        return false;
+    }
+
+    for (size_t bin = 0; bin < compiled->size; bin++) {
+        double value = compiled->start + bin * compiled->resolution;
+        color_table_get_scaled(self, value, compiled->colors + bin * 4);
+        compiled->indexes[bin] = color_table_get_index_scaled(self, value);
+    }
+    return true;
+}
+
+// Uses the table's step as the bins. Returns false if it does not have a
+// usable step.
+bool color_table_compile_steps(const ColorTable* self,
+                               CompiledColorTable* compiled) {
+    if (!(self->step > 0)) {
+        return false;
+    }
+    double first = floor(self->entries[0].value / self->step);
+    double last  = floor(self->entries[self->count - 1].value / self->step);
+    if (last - first + 1 > COMPILED_COLOR_TABLE_MAX_SIZE) {
+        return false;
+    }
+
+    compiled->start        = first * self->step;
+    compiled->resolution   = self->step;
+    compiled->binsPerValue = 1 / self->step;
+    compiled->size         = last - first + 1;
+    return true;
+}
+
+CompiledColorTable* color_table_compile(const ColorTable* self, bool stepped) {
+    CompiledColorTable* compiled = calloc(1, sizeof(*compiled));
+    if (compiled == NULL) {
+        return NULL;
+    }
+    compiled->table = self;
+    if (self->count < 2) {
+        return compiled;
+    }
+
+    if (stepped && color_table_compile_steps(self, compiled)) {
+        // Every value in a bin has the same color, except in the first bin
+        // when it starts below the table. It would be clear from its start,
+        // so values in it are looked up in the table.
+        if (!color_table_compile_bins(self, compiled)) {
+            compiled_color_table_free(compiled);
+            return NULL;
+        }
+        if (compiled->start < self->entries[0].value) {
+            compiled->exact[0] = true;
+        }
+        return compiled;
+    }
+
+    compiled->start = self->entries[0].value;
+    double range = self->entries[self->count - 1].value - compiled->start;
+    if (range <= 0) {
+        return compiled;
+    }
+
+    // Small enough that no channel changes by more than one between the
+    // start of a bin and any value in it, unless that needs too many bins.
+    // There are at least COMPILED_COLOR_TABLE_MIN_SIZE bins, so few of them
+    // have an entry in them.
+    double slope = 0;
+    for (size_t i = 1; i < self->count; i++) {
+        double entrySlope = color_entry_slope(self->entries + i - 1,
+                                              self->entries + i);
+        if (entrySlope > slope) {
+            slope = entrySlope;
+        }
+    }
+    compiled->resolution = range / COMPILED_COLOR_TABLE_MIN_SIZE;
+    if (slope > 0 && 1 / slope < compiled->resolution) {
+        compiled->resolution = 1 / slope;
+    }
+    if (range / compiled->resolution > COMPILED_COLOR_TABLE_MAX_SIZE) {
+        compiled->resolution = range / COMPILED_COLOR_TABLE_MAX_SIZE;
+    }
+    compiled->binsPerValue = 1 / compiled->resolution;
+    compiled->size = ceil(range * compiled->binsPerValue);
+    if (compiled->size < 1) {
+        compiled->size = 1;
+    }
+
+    if (!color_table_compile_bins(self, compiled)) {
+        compiled_color_table_free(compiled);
+        return NULL;
+    }
+
+    // A bin with an entry in it has two different colors, so it is looked up
+    // in the table. An entry on the edge of a bin could round either way, so
+    // both bins are.
+    const double edge = compiled->resolution / 1000;
+    for (size_t i = 0; i < self->count; i++) {
+        for (int side = -1; side <= 1; side++) {
+            ssize_t bin = compiled_color_table_position(compiled,
+                    self->entries[i].value + side * edge);
+            if (bin >= 0) {
+                compiled->exact[bin] = true;
+            }
+        }
+    }
+
+    return compiled;
+}
+
+void compiled_color_table_free(CompiledColorTable* self) {
+    if (self == NULL) {
+        return;
+    }
+    free(self->colors);
+    free(self->indexes);
+    free(self->exact);
+    free(self);
+}
+
@@ -0,0 +1,1251 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <stdbool.h>
+#include <string.h>
+#include <ctype.h>
+#include <threads.h>
+
+#ifdef _WIN32
+#include <process.h>
+#define getpid _getpid
+#else
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#endif
+
+#include "zlib.h"
+#include "curl/curl.h"
+#include "download.h"
+#include "log.h"
+
+#define CHUNCK_SIZE (4 * (1<<20))
+#define CHUNCK_PAD  1024
+#define STREAM_CHUNCK_SIZE (256 * (1<<10))
+#define GRIB_HEADER_SIZE 16
+
+#define GZIP_TRAILER_SIZE 4
+
+typedef struct {
+    size_t size;
+    size_t current;
+    uint8_t* data;
+
+    size_t expected; // final size if known ahead of time, otherwise 0
+    size_t reallocs;
+    size_t moved; // bytes which may have been copied by realloc
+} DataBuffer;
+
+typedef struct {
+    z_stream strm;
+    DataBuffer out;
+    bool gzipped;
+    bool finished;
+
+    size_t received; // bytes from the server, before inflating
+    double inflateTime;
+} DownloadingData;
+
+typedef struct QueuedMessage {
+    GribMessage message;
+    struct QueuedMessage* next;
+} QueuedMessage;
+
+// Splits a stream of bytes into GRIB messages, using the total length in
+// section 0.
+typedef struct {
+    size_t position; // offset in the file of the next byte
+    size_t index;
+
+    uint8_t header[GRIB_HEADER_SIZE];
+    size_t headerSize;
+
+    uint8_t* message; // NULL if the message is being skipped
+    size_t messageSize; // 0 until the header has been read
+    size_t messageCurrent;
+    size_t messageOffset;
+
+    uint8_t* chunk; // inflated data for gzipped streams
+} MessageStream;
+
+typedef struct Transfer {
+    CURL* curl;
+    struct Download* download;
+    DownloadingData data;
+    MessageStream stream;
+    char range[64];
+    bool started;
+    bool wholeFileIsError; // for all but the first range of a download
+
+    // Probes only fetch the gzip trailer, to learn the inflated size
+    bool probe;
+    uint8_t trailer[GZIP_TRAILER_SIZE];
+    size_t trailerSize;
+
+    // The whole file is copied here as it arrives, to be moved into the cache
+    FILE* cacheOut;
+    char* cachePart;
+    // What is left to read of a cached file, when streaming
+    size_t cacheStart;
+    size_t cacheEnd;
+
+    Validators validators; // from the response
+    struct curl_slist* headers;
+
+    bool done;
+    CURLcode result;
+    long code;
+    struct Transfer* next;
+} Transfer;
+
+struct Download {
+    const DownloadSettings* settings;
+    size_t transferCount;
+    Transfer* transfers;
+    Transfer* probe; // NULL if not probing for the size
+    bool cached; // read from the cache instead of downloaded
+    // A cached file which is streamed. It is read as messages are asked for,
+    // so only the messages in use are held, as when downloading.
+    uint8_t* cacheData;
+    size_t cacheSize;
+
+    // Streamed messages, protected by the engine lock
+    QueuedMessage* first;
+    QueuedMessage* last;
+    bool cancelled;
+};
+
+// The engine lives for as long as the library is loaded. All transfers go
+// through one multi handle on one thread, so connections (and HTTP/2
+// multiplexing) are reused between downloads, and the share keeps DNS and TLS
+// sessions around.
+typedef struct {
+    bool ok;
+    CURLM* multi;
+    CURLSH* share;
+    mtx_t shareLocks[CURL_LOCK_DATA_LAST];
+
+    mtx_t lock;
+    cnd_t done;
+    Transfer* pending;
+    thrd_t thread;
+} DownloadEngine;
+
+static DownloadEngine engine;
+static once_flag engineOnce = ONCE_FLAG_INIT;
+
+uint64_t grib_message_length(const uint8_t* header) {
+    uint64_t length = 0;
+    if (header[7] == 1) {
+        for (size_t i = 4; i < 7; i++) {
+            length = (length << 8) | header[i];
+        }
+    } else {
+        for (size_t i = 8; i < 16; i++) {
+            length = (length << 8) | header[i];
+        }
+    }
+    return length;
+}
+
+// Returns false if the download should stop
+bool stream_message_done(Transfer* transfer) {
+    MessageStream* stream = &(transfer->stream);
+    Download* download = transfer->download;
+    bool cancelled;
+
+    QueuedMessage* queued = NULL;
+    if (stream->message != NULL) {
+        queued = malloc(sizeof(*queued));
+        if (queued == NULL) {
+            fprintf(stderr, "Could not allocate buffer\n");
+            free(stream->message);
+            stream->message = NULL;
+            return false;
+        }
+        queued->message.data   = stream->message;
+        queued->message.size   = stream->messageSize;
+        queued->message.offset = stream->messageOffset;
+        queued->message.index  = stream->index;
+        queued->next           = NULL;
+    }
+
+    mtx_lock(&(engine.lock));
+    cancelled = download->cancelled;
+    if (queued != NULL && !cancelled) {
+        if (download->last == NULL) {
+            download->first = queued;
+        } else {
+            download->last->next = queued;
+        }
+        download->last = queued;
+        cnd_broadcast(&(engine.done));
+    }
+    mtx_unlock(&(engine.lock));
+
+    if (queued != NULL && cancelled) {
+        free(queued->message.data);
+        free(queued);
+    }
+
+    stream->message        = NULL;
+    stream->messageSize    = 0;
+    stream->messageCurrent = 0;
+    stream->headerSize     = 0;
+    stream->index++;
+
+    return !cancelled;
+}
+
+// Returns false if the download should stop
+bool stream_data(Transfer* transfer, const uint8_t* input, size_t size) {
+    MessageStream* stream = &(transfer->stream);
+    const DownloadSettings* settings = transfer->download->settings;
+
+    while (size > 0) {
+        if (stream->messageSize == 0) {
+            // Find and read in the header
+            stream->header[stream->headerSize] = *input;
+            stream->headerSize++;
+            stream->position++;
+            input++;
+            size--;
+
+            if (stream->headerSize <= 4 &&
+                    memcmp(stream->header, "GRIB", stream->headerSize) != 0) {
+                // Not at a message yet, so shift the header along by one
+                memmove(stream->header, stream->header + 1,
+                        stream->headerSize - 1);
+                stream->headerSize--;
+                continue;
+            }
+            if (stream->headerSize < GRIB_HEADER_SIZE) {
+                continue;
+            }
+
+            uint64_t length = grib_message_length(stream->header);
+            if (length < GRIB_HEADER_SIZE) {
+                fprintf(stderr, "Got a GRIB message with an invalid length\n");
+                return false;
+            }
+            stream->messageSize    = length;
+            stream->messageCurrent = GRIB_HEADER_SIZE;
+            stream->messageOffset  = stream->position - GRIB_HEADER_SIZE;
+
+            if (settings->keepMessage == NULL ||
+                    settings->keepMessage(settings->keepMessageData,
+                                          stream->messageOffset,
+                                          stream->index)) {
+                stream->message = malloc(length);
+                if (stream->message == NULL) {
+                    fprintf(stderr, "Could not allocate buffer\n");
+                    return false;
+                }
+                memcpy(stream->message, stream->header, GRIB_HEADER_SIZE);
+            }
+        } else {
+            size_t count = stream->messageSize - stream->messageCurrent;
+            if (count > size) {
+                count = size;
+            }
+            if (stream->message != NULL) {
+                memcpy(stream->message + stream->messageCurrent, input, count);
+            }
+            stream->messageCurrent += count;
+            stream->position       += count;
+            input += count;
+            size  -= count;
+        }
+
+        if (stream->messageSize != 0 &&
+                stream->messageCurrent == stream->messageSize) {
+            if (!stream_message_done(transfer)) {
+                return false;
+            }
+        }
+    }
+    return true;
+}
+
+// Makes room for needed more bytes after used. The buffer goes straight to the
+// expected size when it is known, and doubles otherwise.
+bool buffer_reserve(DataBuffer* buffer, size_t used, size_t needed) {
+    if (buffer->size - used >= needed) {
+        return true;
+    }
+
+    size_t newSize;
+    if (buffer->expected >= used + needed && buffer->expected > buffer->size) {
+        newSize = buffer->expected;
+    } else if (buffer->size == 0) {
+        newSize = CHUNCK_SIZE;
+    } else {
+        newSize = buffer->size * 2;
+    }
+    if (newSize < used + needed) {
+        newSize = used + needed;
+    }
+
+    uint8_t* ptr = realloc(buffer->data, newSize);
+    if (ptr == NULL) {
+        fprintf(stderr, "Could not allocate buffer\n");
+        return false;
+    }
+    if (buffer->data != NULL) {
+        buffer->reallocs++;
+        buffer->moved += used;
+    }
+    buffer->data = ptr;
+    buffer->size = newSize;
+    return true;
+}
+
+size_t trailer_from_server(Transfer* transfer, void* contents, size_t inputSize) {
+    if (!transfer->started) {
+        transfer->started = true;
+        long code = 0;
+        curl_easy_getinfo(transfer->curl, CURLINFO_RESPONSE_CODE, &code);
+        if (code != 206) {
+            // Not a range, so this would be the whole file
+            return CURL_WRITEFUNC_ERROR;
+        }
+    }
+
+    size_t count = GZIP_TRAILER_SIZE - transfer->trailerSize;
+    if (count > inputSize) {
+        count = inputSize;
+    }
+    memcpy(transfer->trailer + transfer->trailerSize, contents, count);
+    transfer->trailerSize += count;
+
+    if (transfer->trailerSize == GZIP_TRAILER_SIZE) {
+        // ISIZE is the inflated size modulo 2^32, little endian
+        size_t isize = 0;
+        for (size_t i = GZIP_TRAILER_SIZE; i > 0; i--) {
+            isize = (isize << 8) | transfer->trailer[i - 1];
+        }
+        DataBuffer* out = &(transfer->download->transfers[0].data.out);
+        if (isize > 0) {
+            // Leave room so inflate never runs short before the end
+            out->expected = isize + CHUNCK_PAD;
+        }
+    }
+    return inputSize;
+}
+
+// Returns false if the download should stop
+bool transfer_data(Transfer* transfer, uint8_t* contents, size_t inputSize) {
+    DownloadingData* data = &(transfer->data);
+
+    if (data->finished) {
+        fprintf(stderr, "Got more data after finished inflating\n");
+    }
+
+    if (transfer->download->settings->stream) {
+        if (data->gzipped) {
+            data->strm.next_in  = contents;
+            data->strm.avail_in = inputSize;
+
+            while (data->strm.avail_in > 0 && !data->finished) {
+                data->strm.next_out  = transfer->stream.chunk;
+                data->strm.avail_out = STREAM_CHUNCK_SIZE;
+
+                double start = clock_ms();
+                int err = inflate(&(data->strm), Z_NO_FLUSH);
+                data->inflateTime += clock_ms() - start;
+                switch(err) {
+                case Z_OK:
+                case Z_BUF_ERROR:
+                    break;
+                case Z_STREAM_END:
+                    data->finished = true;
+                    break;
+
+                default:
+                    fprintf(stderr, "Got %s while inflating\n%s\n", zError(err),
+                            data->strm.msg == NULL ? "" : data->strm.msg);
+                    return false;
+                }
+
+                if (!stream_data(transfer, transfer->stream.chunk,
+                                 STREAM_CHUNCK_SIZE - data->strm.avail_out)) {
+                    return false;
+                }
+            }
+        } else if (!stream_data(transfer, contents, inputSize)) {
+            return false;
+        }
+    } else if (data->gzipped) {
+        data->strm.next_in  = contents;
+        data->strm.avail_in = inputSize;
+
+        while (data->strm.avail_in > 0) {
+            if (data->strm.avail_out < CHUNCK_PAD) {
+                size_t used = data->strm.total_out;
+                if (!buffer_reserve(&(data->out), used, CHUNCK_PAD)) {
+                    return false;
+                }
+                data->strm.next_out  = data->out.data + used;
+                data->strm.avail_out = data->out.size - used;
+            }
+
+            double start = clock_ms();
+            int err = inflate(&(data->strm), Z_NO_FLUSH);
+            data->inflateTime += clock_ms() - start;
+            switch(err) {
+            case Z_OK:
+                break;
+            case Z_STREAM_END:
+                data->finished = true;
+                break;
+
+            default:
+                fprintf(stderr, "Got %s while inflating\n%s\n", zError(err),
+                        data->strm.msg == NULL ? "" : data->strm.msg);
+                return false;
+            }
+        }
+    } else {
+        if (!buffer_reserve(&(data->out), data->out.current, inputSize)) {
+            return false;
+        }
+        memcpy(data->out.data + data->out.current, contents, inputSize);
+        data->out.current += inputSize;
+    }
+
+    return true;
+}
+
+// Starts copying the download into the cache, under a temporary name until it
+// has finished.
+void cache_open(Transfer* transfer) {
+    const DownloadSettings* settings = transfer->download->settings;
+    if (settings->cacheFile == NULL || transfer->cacheOut != NULL) {
+        return;
+    }
+
+    size_t size = strlen(settings->cacheFile) + 32;
+    transfer->cachePart = malloc(size);
+    if (transfer->cachePart == NULL) {
+        return;
+    }
+    snprintf(transfer->cachePart, size, "%s.%d.part", settings->cacheFile,
+             (int) getpid());
+    transfer->cacheOut = fopen(transfer->cachePart, "wb");
+    if (transfer->cacheOut == NULL) {
+        fprintf(stderr, "Could not open %s for the download cache\n",
+                transfer->cachePart);
+        free(transfer->cachePart);
+        transfer->cachePart = NULL;
+    }
+}
+
+// Moves the copy into the cache if keep is set, otherwise removes it
+void cache_close(Transfer* transfer, bool keep) {
+    if (transfer->cacheOut == NULL) {
+        return;
+    }
+    const char* cacheFile = transfer->download->settings->cacheFile;
+
+    keep = fclose(transfer->cacheOut) == 0 && keep;
+    transfer->cacheOut = NULL;
+    if (!keep || rename(transfer->cachePart, cacheFile) != 0) {
+        // Another process may have cached it first
+        remove(transfer->cachePart);
+    }
+    free(transfer->cachePart);
+    transfer->cachePart = NULL;
+}
+
+size_t chunk_from_server(void *contents, size_t size, size_t nmemb, void *userp) {
+    Transfer* transfer = userp;
+    DownloadingData* data = &(transfer->data);
+    size_t inputSize = size * nmemb;
+
+    if (inputSize == 0) {
+        fprintf(stderr, "Got empty response from the server\n");
+        return 0;
+    }
+
+    if (transfer->probe) {
+        return trailer_from_server(transfer, contents, inputSize);
+    }
+
+    if (!transfer->started) {
+        transfer->started = true;
+        long code = 0;
+        curl_easy_getinfo(transfer->curl, CURLINFO_RESPONSE_CODE, &code);
+
+        curl_off_t length = -1;
+        curl_easy_getinfo(transfer->curl, CURLINFO_CONTENT_LENGTH_DOWNLOAD_T,
+                          &length);
+        if (!data->gzipped && length > 0) {
+            data->out.expected = length;
+        }
+
+        if (code == 200 && transfer->wholeFileIsError) {
+            // The server is sending the whole file for every range. The
+            // first range will get all of it, so stop this one.
+            return CURL_WRITEFUNC_ERROR;
+        }
+        if (code == 200) {
+            transfer->stream.position = 0;
+            cache_open(transfer);
+        }
+    }
+
+    data->received += inputSize;
+    if (transfer->cacheOut != NULL &&
+            fwrite(contents, 1, inputSize, transfer->cacheOut) != inputSize) {
+        fprintf(stderr, "Could not write to the download cache\n");
+        cache_close(transfer, false);
+    }
+
+    if (!transfer_data(transfer, contents, inputSize)) {
+        return CURL_WRITEFUNC_ERROR;
+    }
+    return inputSize;
+}
+
+// Copies the value of the header into value if it has the given name
+void header_value(const char* header, size_t length, const char* name,
+                  char* value, size_t valueSize) {
+    size_t nameLength = strlen(name);
+    if (length <= nameLength) {
+        return;
+    }
+    for (size_t i = 0; i < nameLength; i++) {
+        if (tolower((unsigned char) header[i]) != tolower((unsigned char) name[i])) {
+            return;
+        }
+    }
+
+    header += nameLength;
+    length -= nameLength;
+    while (length > 0 && (*header == ' ' || *header == '\t')) {
+        header++;
+        length--;
+    }
+    while (length > 0 && isspace((unsigned char) header[length - 1])) {
+        length--;
+    }
+    if (length >= valueSize) {
+        // Too long to send back, so act as if there was none
+        return;
+    }
+    memcpy(value, header, length);
+    value[length] = '\0';
+}
+
+size_t header_from_server(char* buffer, size_t size, size_t nitems, void* userp) {
+    Transfer* transfer = userp;
+    Validators* validators = &(transfer->validators);
+    size_t length = size * nitems;
+
+    if (length >= 5 && strncmp(buffer, "HTTP/", 5) == 0) {
+        // The start of a new response, such as after a redirect
+        validators->etag[0]         = '\0';
+        validators->lastModified[0] = '\0';
+    } else {
+        header_value(buffer, length, "ETag:", validators->etag,
+                     sizeof(validators->etag));
+        header_value(buffer, length, "Last-Modified:", validators->lastModified,
+                     sizeof(validators->lastModified));
+    }
+    return length;
+}
+
+// Asks the server to only send the file if it has changed since it was last
+// downloaded.
+int transfer_conditional(Transfer* transfer, const Validators* validators) {
+    char header[sizeof(validators->etag) + 32];
+
+    curl_easy_setopt(transfer->curl, CURLOPT_HEADERFUNCTION, header_from_server);
+    curl_easy_setopt(transfer->curl, CURLOPT_HEADERDATA, transfer);
+
+    if (validators->etag[0] != '\0') {
+        snprintf(header, sizeof(header), "If-None-Match: %s", validators->etag);
+        struct curl_slist* headers = curl_slist_append(transfer->headers, header);
+        if (headers == NULL) {
+            return 1;
+        }
+        transfer->headers = headers;
+    }
+    if (validators->lastModified[0] != '\0') {
+        snprintf(header, sizeof(header), "If-Modified-Since: %s",
+                 validators->lastModified);
+        struct curl_slist* headers = curl_slist_append(transfer->headers, header);
+        if (headers == NULL) {
+            return 1;
+        }
+        transfer->headers = headers;
+    }
+    curl_easy_setopt(transfer->curl, CURLOPT_HTTPHEADER, transfer->headers);
+    return 0;
+}
+
+void share_lock(CURL* handle, curl_lock_data data, curl_lock_access access,
+                void* userp) {
+    (void) handle;
+    (void) access;
+    (void) userp;
+    mtx_lock(engine.shareLocks + data);
+}
+
+void share_unlock(CURL* handle, curl_lock_data data, void* userp) {
+    (void) handle;
+    (void) userp;
+    mtx_unlock(engine.shareLocks + data);
+}
+
+int engine_run(void* arg) {
+    (void) arg;
+    while (true) {
+        mtx_lock(&(engine.lock));
+        while (engine.pending != NULL) {
+            Transfer* transfer = engine.pending;
+            engine.pending = transfer->next;
+            transfer->next = NULL;
+            curl_multi_add_handle(engine.multi, transfer->curl);
+        }
+        mtx_unlock(&(engine.lock));
+
+        int running;
+        curl_multi_perform(engine.multi, &running);
+
+        CURLMsg* msg;
+        int left;
+        while ((msg = curl_multi_info_read(engine.multi, &left)) != NULL) {
+            if (msg->msg != CURLMSG_DONE) {
+                continue;
+            }
+            CURL* curl = msg->easy_handle;
+            CURLcode result = msg->data.result;
+            Transfer* transfer;
+            curl_easy_getinfo(curl, CURLINFO_PRIVATE, (char**) &transfer);
+            curl_multi_remove_handle(engine.multi, curl);
+
+            mtx_lock(&(engine.lock));
+            transfer->result = result;
+            curl_easy_getinfo(curl, CURLINFO_RESPONSE_CODE, &(transfer->code));
+            transfer->done = true;
+            cnd_broadcast(&(engine.done));
+            mtx_unlock(&(engine.lock));
+        }
+
+        curl_multi_poll(engine.multi, NULL, 0, 1000, NULL);
+    }
+    return 0;
+}
+
+void engine_init(void) {
+    engine.ok = false;
+    if (curl_global_init(CURL_GLOBAL_DEFAULT) != CURLE_OK) {
+        fprintf(stderr, "Could not initialize curl\n");
+        return;
+    }
+
+    for (size_t i = 0; i < CURL_LOCK_DATA_LAST; i++) {
+        mtx_init(engine.shareLocks + i, mtx_plain);
+    }
+    engine.share = curl_share_init();
+    if (engine.share == NULL) {
+        fprintf(stderr, "Could not initialize curl share\n");
+        return;
+    }
+    curl_share_setopt(engine.share, CURLSHOPT_LOCKFUNC, share_lock);
+    curl_share_setopt(engine.share, CURLSHOPT_UNLOCKFUNC, share_unlock);
+    curl_share_setopt(engine.share, CURLSHOPT_SHARE, CURL_LOCK_DATA_DNS);
+    curl_share_setopt(engine.share, CURLSHOPT_SHARE, CURL_LOCK_DATA_SSL_SESSION);
+
+    // The connection cache belongs to the multi handle
+    engine.multi = curl_multi_init();
+    if (engine.multi == NULL) {
+        fprintf(stderr, "Could not initialize curl multi\n");
+        return;
+    }
+    curl_multi_setopt(engine.multi, CURLMOPT_PIPELINING, CURLPIPE_MULTIPLEX);
+
+    engine.pending = NULL;
+    if (mtx_init(&(engine.lock), mtx_plain) != thrd_success ||
+        cnd_init(&(engine.done)) != thrd_success) {
+        fprintf(stderr, "Could not initialize download engine locks\n");
+        return;
+    }
+    if (thrd_create(&(engine.thread), engine_run, NULL) != thrd_success) {
+        fprintf(stderr, "Could not start download engine\n");
+        return;
+    }
+    thrd_detach(engine.thread);
+
+    engine.ok = true;
+}
+
+#ifdef _WIN32
+uint8_t* cache_map(const char* filename, size_t* size) {
+    FILE* file = fopen(filename, "rb");
+    if (file == NULL) {
+        return NULL;
+    }
+    _fseeki64(file, 0, SEEK_END);
+    int64_t length = _ftelli64(file);
+    _fseeki64(file, 0, SEEK_SET);
+
+    uint8_t* data = NULL;
+    if (length > 0) {
+        data = malloc(length);
+    }
+    if (data != NULL && fread(data, 1, length, file) != (size_t) length) {
+        free(data);
+        data = NULL;
+    }
+    fclose(file);
+
+    *size = length;
+    return data;
+}
+
+void cache_unmap(uint8_t* data, size_t size) {
+    (void) size;
+    free(data);
+}
+#else
+uint8_t* cache_map(const char* filename, size_t* size) {
+    int fd = open(filename, O_RDONLY);
+    if (fd < 0) {
+        return NULL;
+    }
+    struct stat st;
+    if (fstat(fd, &st) != 0 || st.st_size == 0) {
+        close(fd);
+        return NULL;
+    }
+
+    void* data = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED) {
+        return NULL;
+    }
+    madvise(data, st.st_size, MADV_SEQUENTIAL);
+
+    *size = st.st_size;
+    return data;
+}
+
+void cache_unmap(uint8_t* data, size_t size) {
+    munmap(data, size);
+}
+#endif
+
+// Reads the file from the cache instead of downloading it. Returns false if it
+// is not in the cache.
+bool download_from_cache(Download* download) {
+    const DownloadSettings* settings = download->settings;
+    if (settings->cacheFile == NULL) {
+        return false;
+    }
+
+    size_t size;
+    uint8_t* file = cache_map(settings->cacheFile, &size);
+    if (file == NULL) {
+        return false;
+    }
+
+    for (size_t i = 0; i < download->transferCount; i++) {
+        Transfer* transfer = download->transfers + i;
+        size_t start = 0;
+        size_t end   = size;
+        if (settings->rangeCount > 0) {
+            ByteRange* range = settings->ranges + i;
+            start = range->start < size ? range->start : size;
+            end   = range->end   < size ? range->end   : size;
+        }
+
+        transfer->started = true;
+        transfer->code    = settings->rangeCount > 0 ? 206 : 200;
+        if (settings->stream) {
+            transfer->cacheStart = start;
+            transfer->cacheEnd   = end;
+            transfer->result     = CURLE_OK;
+            continue;
+        }
+
+        if (!transfer->data.gzipped) {
+            transfer->data.out.expected = end - start;
+        }
+        if (transfer_data(transfer, file + start, end - start)) {
+            transfer->result = CURLE_OK;
+        } else {
+            transfer->result = CURLE_WRITE_ERROR;
+        }
+        transfer->done = true;
+    }
+
+    if (settings->stream) {
+        download->cacheData = file;
+        download->cacheSize = size;
+    } else {
+        cache_unmap(file, size);
+    }
+    download->cached = true;
+    return true;
+}
+
+// Passes the next chunk of a streamed cached file through, as if it had come
+// from the server. Returns false once all of it has been read.
+bool cache_stream_chunk(Download* download) {
+    for (size_t i = 0; i < download->transferCount; i++) {
+        Transfer* transfer = download->transfers + i;
+        if (transfer->done) {
+            continue;
+        }
+
+        size_t size = transfer->cacheEnd - transfer->cacheStart;
+        if (size > STREAM_CHUNCK_SIZE) {
+            size = STREAM_CHUNCK_SIZE;
+        }
+        if (transfer_data(transfer, download->cacheData + transfer->cacheStart,
+                          size)) {
+            transfer->cacheStart += size;
+        } else {
+            transfer->result     = CURLE_WRITE_ERROR;
+            transfer->cacheStart = transfer->cacheEnd;
+        }
+
+        if (transfer->cacheStart == transfer->cacheEnd) {
+            mtx_lock(&(engine.lock));
+            transfer->done = true;
+            mtx_unlock(&(engine.lock));
+        }
+        return true;
+    }
+    return false;
+}
+
+int byte_range_compare(const void* a, const void* b) {
+    const ByteRange* ra = a;
+    const ByteRange* rb = b;
+    if (ra->start < rb->start) return -1;
+    if (ra->start > rb->start) return 1;
+    return 0;
+}
+
+// Sorts the ranges and merges any that overlap or touch. Returns the new count
+size_t merge_byte_ranges(ByteRange* ranges, size_t count) {
+    if (count == 0) {
+        return 0;
+    }
+    qsort(ranges, count, sizeof(*ranges), byte_range_compare);
+
+    size_t merged = 0;
+    for (size_t i = 1; i < count; i++) {
+        if (ranges[i].start <= ranges[merged].end) {
+            if (ranges[i].end > ranges[merged].end) {
+                ranges[merged].end = ranges[i].end;
+            }
+        } else {
+            merged++;
+            ranges[merged] = ranges[i];
+        }
+    }
+    return merged + 1;
+}
+
+void transfer_free(Transfer* transfer) {
+    cache_close(transfer, false);
+    if (transfer->curl != NULL) {
+        curl_easy_cleanup(transfer->curl);
+    }
+    curl_slist_free_all(transfer->headers);
+    inflateEnd(&(transfer->data.strm));
+    free(transfer->data.out.data);
+    free(transfer->stream.message);
+    free(transfer->stream.chunk);
+}
+
+int transfer_init(Transfer* transfer, Download* download) {
+    const DownloadSettings* settings = download->settings;
+    memset(transfer, 0, sizeof(*transfer));
+    transfer->download = download;
+
+    if (settings->stream && settings->gzipped) {
+        transfer->stream.chunk = malloc(STREAM_CHUNCK_SIZE);
+        if (transfer->stream.chunk == NULL) {
+            return 1;
+        }
+    }
+
+    transfer->data.gzipped = settings->gzipped;
+    transfer->data.strm.zalloc = Z_NULL;
+    transfer->data.strm.zfree  = Z_NULL;
+    transfer->data.strm.opaque = Z_NULL;
+    if (inflateInit2(&(transfer->data.strm), 15 + 16) != Z_OK) {
+        fprintf(stderr, "Could not initialize zlib stream\n");
+        return 1;
+    }
+
+    CURL* curl = curl_easy_init();
+    if (curl == NULL) {
+        fprintf(stderr, "Could not initialize curl\n");
+        return 1;
+    }
+    transfer->curl = curl;
+    curl_easy_setopt(curl, CURLOPT_URL, settings->url);
+    curl_easy_setopt(curl, CURLOPT_TIMEOUT, settings->timeout);
+    curl_easy_setopt(curl, CURLOPT_WRITEFUNCTION, chunk_from_server);
+    curl_easy_setopt(curl, CURLOPT_FOLLOWLOCATION, true);
+    curl_easy_setopt(curl, CURLOPT_WRITEDATA, transfer);
+    curl_easy_setopt(curl, CURLOPT_PRIVATE, transfer);
+    curl_easy_setopt(curl, CURLOPT_SHARE, engine.share);
+    curl_easy_setopt(curl, CURLOPT_HTTP_VERSION, CURL_HTTP_VERSION_2TLS);
+    // Waiting to multiplex is only worth it when TLS can tell us quickly
+    // whether the server speaks HTTP/2. Otherwise it serializes transfers.
+    if (strncmp(settings->url, "https://", 8) == 0) {
+        curl_easy_setopt(curl, CURLOPT_PIPEWAIT, 1L);
+    }
+    curl_easy_setopt(curl, CURLOPT_TCP_KEEPALIVE, 1L);
+
+    if (settings->validators != NULL &&
+            transfer_conditional(transfer, settings->validators)) {
+        fprintf(stderr, "Could not set conditional request headers\n");
+        return 1;
+    }
+
+    return 0;
+}
+
+void download_free(Download* download) {
+    for (size_t i = 0; i < download->transferCount; i++) {
+        transfer_free(download->transfers + i);
+    }
+    free(download->transfers);
+    if (download->probe != NULL) {
+        transfer_free(download->probe);
+        free(download->probe);
+    }
+    if (download->cacheData != NULL) {
+        cache_unmap(download->cacheData, download->cacheSize);
+    }
+    free(download);
+}
+
+// Asks for the last bytes of a gzipped file, so the output buffer can be
+// allocated once. Only worth it over HTTP, where the server says if it honoured
+// the range.
+void download_probe(Download* download) {
+    const DownloadSettings* settings = download->settings;
+    if (!settings->gzipped || settings->stream || settings->rangeCount > 0 ||
+            strncmp(settings->url, "http", 4) != 0) {
+        return;
+    }
+
+    Transfer* probe = malloc(sizeof(*probe));
+    if (probe == NULL) {
+        return;
+    }
+    if (transfer_init(probe, download)) {
+        transfer_free(probe);
+        free(probe);
+        return;
+    }
+    probe->probe = true;
+    snprintf(probe->range, sizeof(probe->range), "-%d", GZIP_TRAILER_SIZE);
+    curl_easy_setopt(probe->curl, CURLOPT_RANGE, probe->range);
+    download->probe = probe;
+}
+
+Download* download_start(const DownloadSettings* settings) {
+    LogSettings logS = {
+        .verbose = settings->verbose,
+        .logName = settings->logName,
+    };
+
+    call_once(&engineOnce, engine_init);
+    if (!engine.ok) {
+        return NULL;
+    }
+
+    Download* download = malloc(sizeof(*download));
+    if (download == NULL) {
+        return NULL;
+    }
+    download->settings      = settings;
+    download->first         = NULL;
+    download->last          = NULL;
+    download->cancelled     = false;
+    download->probe         = NULL;
+    download->cached        = false;
+    download->cacheData     = NULL;
+    download->cacheSize     = 0;
+    download->transferCount = settings->rangeCount == 0 ? 1 : settings->rangeCount;
+    download->transfers     = calloc(download->transferCount,
+                                     sizeof(*(download->transfers)));
+    if (download->transfers == NULL) {
+        free(download);
+        return NULL;
+    }
+
+    for (size_t i = 0; i < download->transferCount; i++) {
+        Transfer* transfer = download->transfers + i;
+        if (transfer_init(transfer, download)) {
+            download->transferCount = i + 1;
+            download_free(download);
+            return NULL;
+        }
+
+        // Ranges are only supported for data which is not compressed, as the
+        // offsets are into the decompressed data.
+        if (settings->rangeCount > 0) {
+            ByteRange* range = settings->ranges + i;
+            if (range->end == SIZE_MAX) {
+                snprintf(transfer->range, sizeof(transfer->range), "%zu-",
+                         range->start);
+            } else {
+                snprintf(transfer->range, sizeof(transfer->range), "%zu-%zu",
+                         range->start, range->end - 1);
+            }
+            curl_easy_setopt(transfer->curl, CURLOPT_RANGE, transfer->range);
+            transfer->wholeFileIsError = i != 0;
+            transfer->stream.position  = range->start;
+        }
+    }
+
+    if (download_from_cache(download)) {
+        _log(&logS, "Read from the download cache");
+        return download;
+    }
+
+    download_probe(download);
+
+    _log(&logS, "Downloading");
+
+    mtx_lock(&(engine.lock));
+    if (download->probe != NULL) {
+        download->probe->next = engine.pending;
+        engine.pending = download->probe;
+    }
+    for (size_t i = download->transferCount; i > 0; i--) {
+        Transfer* transfer = download->transfers + (i - 1);
+        transfer->next = engine.pending;
+        engine.pending = transfer;
+    }
+    mtx_unlock(&(engine.lock));
+    curl_multi_wakeup(engine.multi);
+
+    return download;
+}
+
+bool download_next_message(Download* download, GribMessage* message) {
+    if (download == NULL) {
+        return false;
+    }
+
+    // Cached files are read on this thread, so nothing else adds to the queue
+    if (download->cacheData != NULL) {
+        while (download->first == NULL && cache_stream_chunk(download)) {
+        }
+    }
+
+    bool found = false;
+    mtx_lock(&(engine.lock));
+    while (true) {
+        if (download->first != NULL) {
+            QueuedMessage* queued = download->first;
+            download->first = queued->next;
+            if (download->first == NULL) {
+                download->last = NULL;
+            }
+            *message = queued->message;
+            free(queued);
+            found = true;
+            break;
+        }
+
+        bool done = true;
+        for (size_t i = 0; i < download->transferCount; i++) {
+            done = done && download->transfers[i].done;
+        }
+        if (done) {
+            break;
+        }
+        cnd_wait(&(engine.done), &(engine.lock));
+    }
+    mtx_unlock(&(engine.lock));
+
+    return found;
+}
+
+void download_cancel(Download* download) {
+    if (download == NULL) {
+        return;
+    }
+    mtx_lock(&(engine.lock));
+    download->cancelled = true;
+    mtx_unlock(&(engine.lock));
+}
+
+DownloadedData download_finish(Download* download) {
+    DownloadedData output;
+    memset(&output, 0, sizeof(output));
+    if (download == NULL) {
+        output.error = 1;
+        return output;
+    }
+
+    const DownloadSettings* settings = download->settings;
+    LogSettings logS = {
+        .verbose = settings->verbose,
+        .logName = settings->logName,
+    };
+
+    // The rest of a cached stream is read, as a download would be. If it was
+    // cancelled, that stops at the next message.
+    if (download->cacheData != NULL) {
+        while (cache_stream_chunk(download)) {
+        }
+    }
+
+    mtx_lock(&(engine.lock));
+    for (size_t i = 0; i < download->transferCount; i++) {
+        while (!download->transfers[i].done) {
+            cnd_wait(&(engine.done), &(engine.lock));
+        }
+    }
+    while (download->probe != NULL && !download->probe->done) {
+        cnd_wait(&(engine.done), &(engine.lock));
+    }
+    mtx_unlock(&(engine.lock));
+
+    while (download->first != NULL) {
+        QueuedMessage* queued = download->first;
+        download->first = queued->next;
+        free(queued->message.data);
+        free(queued);
+    }
+
+    output.ranged = settings->rangeCount > 0;
+    Transfer* first = download->transfers;
+    if (settings->validators != NULL) {
+        settings->validators->notModified = false;
+    }
+    if (first->result == CURLE_OK && first->code == 304) {
+        _log(&logS, "Not modified since the last download");
+        output.notModified = true;
+        if (settings->validators != NULL) {
+            settings->validators->notModified = true;
+        }
+    } else if (output.ranged && first->result == CURLE_OK && first->code == 200) {
+        // The server ignored the range, so we got the whole file.
+        _log(&logS, "Server does not support ranges, got whole file");
+        output.ranged = false;
+    } else {
+        for (size_t i = 0; i < download->transferCount; i++) {
+            Transfer* transfer = download->transfers + i;
+            if (transfer->result != CURLE_OK && !download->cancelled) {
+                fprintf(stderr, "Failed to get URL %s%s%s with: %s\n",
+                        settings->url,
+                        output.ranged ? " range " : "", transfer->range,
+                        curl_easy_strerror(transfer->result));
+                output.error = 1;
+            }
+        }
+    }
+
+    size_t totalSize = 0;
+    uint8_t* data = NULL;
+    if (output.notModified) {
+        // Nothing was sent
+    } else if (settings->stream) {
+        // The data was handed out as messages
+        for (size_t i = 0; i < download->transferCount; i++) {
+            Transfer* transfer = download->transfers + i;
+            if (transfer->stream.messageSize != 0 && !download->cancelled &&
+                    transfer->result == CURLE_OK) {
+                fprintf(stderr, "Download of %s ended part way through a message\n",
+                        settings->url);
+                output.error = 1;
+            }
+        }
+    } else if (!output.error && output.ranged) {
+        for (size_t i = 0; i < download->transferCount; i++) {
+            totalSize += download->transfers[i].data.out.current;
+        }
+        data = malloc(totalSize);
+        if (data == NULL) {
+            output.error = 1;
+        } else {
+            size_t current = 0;
+            for (size_t i = 0; i < download->transferCount; i++) {
+                DataBuffer* out = &(download->transfers[i].data.out);
+                settings->ranges[i].bufferStart = current;
+                memcpy(data + current, out->data, out->current);
+                current += out->current;
+            }
+        }
+    } else if (!output.error) {
+        if (settings->gzipped) {
+            totalSize = first->data.strm.total_out;
+        } else {
+            totalSize = first->data.out.current;
+        }
+        data = first->data.out.data;
+        first->data.out.data = NULL;
+    }
+
+    cache_close(first, !output.error && !download->cancelled &&
+                       first->result == CURLE_OK);
+
+    if (settings->validators != NULL && !download->cached &&
+            !output.notModified && !output.error && !download->cancelled) {
+        strcpy(settings->validators->etag, first->validators.etag);
+        strcpy(settings->validators->lastModified,
+               first->validators.lastModified);
+    }
+
+    for (size_t i = 0; i < download->transferCount; i++) {
+        const DownloadingData* transferData = &(download->transfers[i].data);
+        output.reallocs    += transferData->out.reallocs;
+        output.moved       += transferData->out.moved;
+        output.received    += transferData->received;
+        output.inflateTime += transferData->inflateTime;
+    }
+    if (!settings->stream && !download->cached) {
+        char message[128];
+        snprintf(message, sizeof(message),
+                 "Resized download buffer %zu times, moving up to %zu bytes",
+                 output.reallocs, output.moved);
+        _log(&logS, message);
+    }
+
+    download_free(download);
+
+    if (output.error) {
+        free(data);
+        return output;
+    }
+
+    uint8_t* d = data;
+    if (!output.ranged && data != NULL) {
+        size_t i = 4;
+        while (i < totalSize) {
+            if (memcmp(d, "GRIB", 4) == 0) {
+                break;
+            }
+            d++;
+            i++;
+        }
+        totalSize = totalSize + 4 - i;
+    }
+
+    output.totalSize = totalSize;
+    output.gribStart = d;
+    output.data      = data;
+
+    return output;
+}
+
+DownloadedData download_data(const DownloadSettings* settings) {
+    return download_finish(download_start(settings));
+}
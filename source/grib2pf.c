@@ -8,14 +8,18 @@
 #include <stdbool.h>
 #include <string.h>
 #include <time.h>
+#include <stdatomic.h>
 
 #include "png.h"
 #include "eccodes.h"
-#include "zlib.h"
-#include "curl/curl.h"
 #include "color_table.h"
-
-#define TIMEFMT "%Y-%m-%d %H:%M:%S"
+#include "download.h"
+#include "grid_cache.h"
+#include "log.h"
+#include "parallel.h"
+#include "png_writer.h"
+#include "render.h"
+#include "tile_pyramid.h"
 
 const double MERCADER_COEF = M_PI / 360;
 const double MERCADER_OFFS = M_PI / 4;
@@ -24,765 +28,1574 @@ const double MERCADER_OFFS = M_PI / 4;
 
 #define ARRAY_INIT 10
 
-typedef struct {
-    size_t size;
-    size_t current;
-    uint8_t* data;
-} DataBuffer;
+void print_keys(codes_handle* h) {
+    codes_keys_iterator* keys = codes_keys_iterator_new(h, 0, "");
+    while (codes_keys_iterator_next(keys)) {
+        printf("%s\n", codes_keys_iterator_get_name(keys));
+    }
+}
 
-typedef struct {
-    z_stream strm;
-    DataBuffer out;
-    bool gzipped;
-    bool finished;
-} DownloadingData;
+// Returns non zero on an error
+int read_grid_values(codes_handle* h, bool floatValues, GridValues* values) {
+    CODES_CHECK(codes_get_size(h, "values", &(values->size)), 0);
+    if (floatValues) {
+        values->f = malloc(values->size * sizeof(*(values->f)));
+        if (values->f == NULL) {
+            return 1;
+        }
+        CODES_CHECK(codes_get_float_array(h, "values", values->f,
+                                          &(values->size)), 0);
+    } else {
+        values->d = malloc(values->size * sizeof(*(values->d)));
+        if (values->d == NULL) {
+            return 1;
+        }
+        CODES_CHECK(codes_get_double_array(h, "values", values->d,
+                                           &(values->size)), 0);
+    }
+    return 0;
+}
 
-typedef struct {
-    bool verbose;
-    const char* logName;
-} LogSettings;
-
-#ifdef _WIN32
-#include <sys\timeb.h>
-void _log(const LogSettings* settings, char* message) {
-    if (!settings->verbose) {
-        return;
+void grid_values_free(GridValues* values) {
+    free(values->d);
+    free(values->f);
+}
+
+void decoded_message_init(DecodedMessage* self, uint8_t* d, size_t size) {
+    memset(self, 0, sizeof(*self));
+    self->d    = d;
+    self->size = size;
+}
+
+void decoded_message_free(DecodedMessage* self) {
+    if (self->h != NULL) {
+        codes_handle_delete(self->h);
     }
-    struct __timeb64 ts;
-    _ftime64(&ts);
-    time_t tm = time(NULL);
-    int32_t frac = ts.millitm;
+    free(self->latLonValues);
+    grid_values_free(&(self->doubles));
+    grid_values_free(&(self->floats));
+}
 
-    char buffer[24];
-    if(strftime(buffer, sizeof(buffer), TIMEFMT, localtime(&tm)) == 0) {
-        buffer[0] = '\0';
+// NULL if the message could not be read
+codes_handle* decoded_message_handle(DecodedMessage* self) {
+    if (self->h == NULL && !self->unreadable) {
+        self->h = codes_handle_new_from_message(NULL, self->d, self->size);
+        if (self->h == NULL) {
+            fprintf(stderr, "Could not read in product\n");
+            self->unreadable = true;
+        }
     }
+    return self->h;
+}
 
-    printf("[%s.%03d] [%s] %s\n", buffer, frac, settings->logName, message);
+// The latitude, longitude and value of each point. NULL on an error.
+const double* decoded_message_lat_lon_values(DecodedMessage* self,
+                                             size_t* size) {
+    if (self->latLonValues == NULL) {
+        codes_handle* h = decoded_message_handle(self);
+        if (h == NULL) {
+            return NULL;
+        }
+        CODES_CHECK(codes_get_size(h, "latLonValues",
+                                   &(self->latLonValuesSize)), 0);
+        self->latLonValues = malloc(self->latLonValuesSize * sizeof(double));
+        if (self->latLonValues == NULL) {
+            return NULL;
+        }
+        CODES_CHECK(codes_get_double_array(h, "latLonValues",
+                    self->latLonValues, &(self->latLonValuesSize)), 0);
+    }
+    *size = self->latLonValuesSize;
+    return self->latLonValues;
 }
-#else
-void _log(const LogSettings* settings, char* message) {
-    if (!settings->verbose) {
-        return;
+
+// NULL on an error
+const GridValues* decoded_message_values(DecodedMessage* self,
+                                         bool floatValues) {
+    GridValues* values = floatValues ? &(self->floats) : &(self->doubles);
+    if (values->d != NULL || values->f != NULL) {
+        return values;
     }
-    struct timespec ts;
-    clock_gettime(CLOCK_REALTIME, &ts);
-    time_t tm = time(NULL);
-    int32_t frac = ts.tv_nsec / 1000000;
 
-    char buffer[24];
-    if(strftime(buffer, sizeof(buffer), TIMEFMT, localtime(&tm)) == 0) {
-        buffer[0] = '\0';
+    if (self->latLonValues != NULL) {
+        // The values came with the latitudes and longitudes, so they do not
+        // need decoding again
+        size_t count = self->latLonValuesSize / 3;
+        if (floatValues) {
+            values->f = malloc(count * sizeof(*(values->f)));
+        } else {
+            values->d = malloc(count * sizeof(*(values->d)));
+        }
+        if (values->d == NULL && values->f == NULL) {
+            return NULL;
+        }
+        for (size_t i = 0; i < count; i++) {
+            if (floatValues) {
+                values->f[i] = self->latLonValues[i * 3 + 2];
+            } else {
+                values->d[i] = self->latLonValues[i * 3 + 2];
+            }
+        }
+        values->size = count;
+        return values;
     }
 
-    printf("[%s.%03d] [%s] %s\n", buffer, frac, settings->logName, message);
+    codes_handle* h = decoded_message_handle(self);
+    if (h == NULL || read_grid_values(h, floatValues, values)) {
+        grid_values_free(values);
+        values->d = NULL;
+        values->f = NULL;
+        return NULL;
+    }
+    return values;
 }
-#endif
 
-#define CHUNCK_SIZE (4 * (1<<20))
-#define CHUNCK_PAD  1024
+double correct_alias(double a, double b) {
+    // Find the "alias number" for a and b
+    double Na = floor((a - 180) / 360) + 1;
+    double Nb = floor((b - 180) / 360) + 1;
 
-void print_keys(codes_handle* h) {
-    codes_keys_iterator* keys = codes_keys_iterator_new(h, 0, "");
-    while (codes_keys_iterator_next(keys)) {
-        printf("%s\n", codes_keys_iterator_get_name(keys));
+    // make b be on the same alias as a
+    return b + (Na - Nb) * 360;
+}
+
+// Sets the area an image covers, from the bounds of the grid
+void set_grid_map_area(GridMap* map, const MessageSettings* message,
+                       double lonL, double lonR, double latT, double latB) {
+    if (message->customArea) {
+        // correct aliasing. Includes logic for crossing the anti-meridian
+        double lonRL = correct_alias(lonL, message->area.lonR);
+        double lonRR = correct_alias(lonR, message->area.lonR);
+        double newLonR;
+        if (lonL < lonRL && lonRL < lonR) {
+            newLonR = lonRL;
+        } else {
+            newLonR = lonRR;
+        }
+
+        double lonLL = correct_alias(lonL, message->area.lonL);
+        double lonLR = correct_alias(lonR, message->area.lonL);
+        double newLonL;
+        if (lonL < lonLR && lonRL < lonR) {
+            newLonL = lonLR;
+        } else {
+            newLonL = lonLL;
+        }
+
+        lonR = newLonR;
+        lonL = newLonL;
+        latT = message->area.latT;
+        latB = message->area.latB;
     }
+
+    map->coords.lonL = lonL;
+    map->coords.lonR = lonR;
+    map->coords.latT = latT;
+    map->coords.latB = latB;
 }
 
-size_t chunk_from_server(void *contents, size_t size, size_t nmemb, void *userp) {
-    DownloadingData* data = userp;
-    size_t inputSize = size * nmemb;
+// Works out where each point of a regular lat/lon grid lands in the image,
+// from its first and last points and increments. This is the same as eccodes
+// would give in latLonValues, without needing three doubles per point. NULL
+// if the grid is not regular, or is scanned in an order this does not handle.
+GridMap* build_regular_grid_map(codes_handle* h, const MessageSettings* message,
+                                const GridKey* key) {
+    char gridType[64];
+    size_t length = sizeof(gridType);
+    if (codes_get_string(h, "gridType", gridType, &length) != 0 ||
+            strcmp(gridType, "regular_ll") != 0) {
+        return NULL;
+    }
 
-    LogSettings log = {.verbose = true, .logName = "test" };
+    long Ni, Nj, iScansNegatively, jScansPositively, jPointsAreConsecutive;
+    long alternativeRowScanning, ijDirectionIncrementGiven;
+    double lon1, lon2, lat1, lat2, jIncrement;
+    if (codes_get_long(h, "Ni", &Ni) != 0 ||
+            codes_get_long(h, "Nj", &Nj) != 0 ||
+            codes_get_long(h, "iScansNegatively", &iScansNegatively) != 0 ||
+            codes_get_long(h, "jScansPositively", &jScansPositively) != 0 ||
+            codes_get_long(h, "jPointsAreConsecutive", &jPointsAreConsecutive) != 0 ||
+            codes_get_long(h, "alternativeRowScanning", &alternativeRowScanning) != 0 ||
+            codes_get_long(h, "ijDirectionIncrementGiven", &ijDirectionIncrementGiven) != 0 ||
+            codes_get_double(h, "longitudeOfFirstGridPointInDegrees", &lon1) != 0 ||
+            codes_get_double(h, "longitudeOfLastGridPointInDegrees", &lon2) != 0 ||
+            codes_get_double(h, "latitudeOfFirstGridPointInDegrees", &lat1) != 0 ||
+            codes_get_double(h, "latitudeOfLastGridPointInDegrees", &lat2) != 0 ||
+            codes_get_double(h, "jDirectionIncrementInDegrees", &jIncrement) != 0) {
+        return NULL;
+    }
+    if (Ni < 2 || Nj < 2 || jPointsAreConsecutive || alternativeRowScanning ||
+            !ijDirectionIncrementGiven) {
+        return NULL;
+    }
 
-    if (inputSize == 0) {
-        fprintf(stderr, "Got empty response from the server\n");
-        return 0;
+    GridMap* map = grid_map_new(key, Nj, Ni, true);
+    if (map == NULL) {
+        return NULL;
+    }
+
+    // The longitude increment comes from the span, so the last column lands
+    // on the last point. Latitudes use the stated increment.
+    double lonIncrement;
+    if (iScansNegatively) {
+        lonIncrement = -(lon1 > lon2 ? lon1 - lon2 : lon1 + 360 - lon2) / (Ni - 1);
+    } else {
+        if (lon1 > lon2) {
+            lon1 -= 360;
+        }
+        lonIncrement = (lon2 - lon1) / (Ni - 1);
+    }
+    if (!jScansPositively) {
+        jIncrement = -jIncrement;
+    }
+
+    double lonL, lonR, latT, latB;
+    lonL = 1000;
+    lonR = -1000;
+    latB = 1000;
+    latT = -1000;
+
+    // Positions are worked out as lat/lon first, then scaled in place
+    double lon = lon1;
+    for (size_t column = 0; column < map->columns; column++) {
+        if (column == map->columns - 1) {
+            lon = lon2;
+        }
+        map->x[column] = lon;
+        if (lon > lonR)
+            lonR = lon;
+        if (lon < lonL)
+            lonL = lon;
+        lon += lonIncrement;
     }
 
-    if (data->finished) {
-        fprintf(stderr, "Got more data after finished inflating\n");
+    double lat = lat1;
+    for (size_t row = 0; row < map->rows; row++) {
+        if (row == map->rows - 1) {
+            lat = lat2;
+        }
+        map->y[row] = lat;
+        if (lat > latT)
+            latT = lat;
+        if (lat < latB)
+            latB = lat;
+        lat += jIncrement;
+    }
+
+    set_grid_map_area(map, message, lonL, lonR, latT, latB);
+    lonL = map->coords.lonL;
+    lonR = map->coords.lonR;
+    latT = map->coords.latT;
+    latB = map->coords.latB;
+
+    const double xM = (message->imageWidth - 0.01)  / (lonR - lonL);
+    const double yM = (message->imageHeight - 0.01) / (PROJECT_LAT_Y(latB) - PROJECT_LAT_Y(latT));
+    const double yB = PROJECT_LAT_Y(latT);
+
+    for (size_t column = 0; column < map->columns; column++) {
+        map->x[column] = (map->x[column] - lonL) * xM;
+    }
+    for (size_t row = 0; row < map->rows; row++) {
+        map->y[row] = (PROJECT_LAT_Y(map->y[row]) - yB) * yM;
     }
 
-    if (data->gzipped) {
-        data->strm.next_in  = contents;
-        data->strm.avail_in = inputSize;
+    return map;
+}
 
-        while (data->strm.avail_in > 0) {
-            if (data->strm.avail_out < CHUNCK_PAD) {
-                uint8_t* ptr = realloc(data->out.data, data->out.size + CHUNCK_SIZE);
-                if (ptr == NULL) {
-                    fprintf(stderr, "Could not allocate buffer\n");
-                    return CURL_WRITEFUNC_ERROR;
+// Works out where each point of the grid lands in the image, from the
+// latitudes and longitudes eccodes gives for each point.
+GridMap* build_grid_map(DecodedMessage* decoded, const MessageSettings* message,
+                        const GridKey* key) {
+    size_t latLonValuesSize;
+    const double* latLonValues = decoded_message_lat_lon_values(
+            decoded, &latLonValuesSize);
+    if (latLonValues == NULL) {
+        return NULL;
+    }
 
+    size_t count = latLonValuesSize / 3;
+    GridMap* map = grid_map_new(key, 1, count, false);
+    if (map == NULL) {
+        return NULL;
+    }
+
+    double lonL, lonR, latT, latB;
+    lonL = 1000;
+    lonR = -1000;
+    latB = 1000;
+    latT = -1000;
+
+    for (size_t i = 0; i < latLonValuesSize; i += 3) {
+        const double lat = latLonValues[i + 0];
+        const double lon = latLonValues[i + 1];
+        if (lon > lonR)
+            lonR = lon;
+        if (lon < lonL)
+            lonL = lon;
+        if (lat > latT)
+            latT = lat;
+        if (lat < latB)
+            latB = lat;
+    }
+
+    set_grid_map_area(map, message, lonL, lonR, latT, latB);
+    lonL = map->coords.lonL;
+    lonR = map->coords.lonR;
+    latT = map->coords.latT;
+    latB = map->coords.latB;
+
+    const double xM = (message->imageWidth - 0.01)  / (lonR - lonL);
+    const double yM = (message->imageHeight - 0.01) / (PROJECT_LAT_Y(latB) - PROJECT_LAT_Y(latT));
+    const double yB = PROJECT_LAT_Y(latT);
+
+    double lastLat = -10000;
+    double lastY   = 0;
+
+    for (size_t i = 0; i < count; i++) {
+        double lat = latLonValues[i * 3 + 0];
+        double lon = latLonValues[i * 3 + 1];
+
+        map->x[i] = (lon - lonL) * xM;
+        if (lat == lastLat) {
+            map->y[i] = lastY;
+        } else {
+            map->y[i] = (PROJECT_LAT_Y(lat) - yB) * yM;
+            lastLat = lat;
+            lastY   = map->y[i];
+        }
+    }
+
+    return map;
+}
+
+void grid_key_init(GridKey* key, codes_handle* h,
+                   const MessageSettings* message) {
+    memset(key, 0, sizeof(*key));
+    size_t length = sizeof(key->grid);
+    if (codes_get_string(h, "md5GridSection", key->grid, &length) != 0) {
+        key->grid[0] = '\0';
+    }
+
+    // A map is only useful if the points from latLonValues are in the same
+    // order as "values". Most grid iterators reorder the points to +i and +j
+    // scanning, but regular lat/lon grids are walked in their scanning order.
+    char gridType[64];
+    length = sizeof(gridType);
+    if (codes_get_string(h, "gridType", gridType, &length) != 0) {
+        gridType[0] = '\0';
+    }
+    long iScansNegatively = 1, jScansPositively = 0;
+    long jPointsAreConsecutive = 1, alternativeRowScanning = 1;
+    codes_get_long(h, "iScansNegatively", &iScansNegatively);
+    codes_get_long(h, "jScansPositively", &jScansPositively);
+    codes_get_long(h, "jPointsAreConsecutive", &jPointsAreConsecutive);
+    codes_get_long(h, "alternativeRowScanning", &alternativeRowScanning);
+    if (strcmp(gridType, "regular_ll") != 0 &&
+            (iScansNegatively || !jScansPositively || jPointsAreConsecutive ||
+             alternativeRowScanning)) {
+        key->grid[0] = '\0';
+    }
+    key->imageWidth  = message->imageWidth;
+    key->imageHeight = message->imageHeight;
+    key->customArea  = message->customArea;
+    if (message->customArea) {
+        key->area = message->area;
+    }
+}
+
+// Everything needed to bin the points of one message into an image
+typedef struct {
+    const MessageSettings* message;
+    const GridMap* map;
+    const GridValues* values;
+    float* imageData;
+    double* sums;
+    uint32_t* counts;
+    float* nearestDist;
+    size_t bandHeight;
+    atomic_size_t points; // Points which landed in the image
+} Binning;
+
+// Bins the points which land in one band of image rows. Each band only writes
+// to its own rows, and takes points in the same order as it would if there
+// was just one band, so the result does not depend on how many bands run.
+void bin_band(void* data, size_t band) {
+    Binning* binning = data;
+    const MessageSettings* message = binning->message;
+    const GridMap* map             = binning->map;
+    const GridValues* values       = binning->values;
+    float* imageData               = binning->imageData;
+    double* sums                   = binning->sums;
+    uint32_t* counts               = binning->counts;
+    float* nearestDist             = binning->nearestDist;
+
+    size_t yStart = band * binning->bandHeight;
+    size_t yEnd   = yStart + binning->bandHeight;
+    if (yStart > message->imageHeight) {
+        yStart = message->imageHeight;
+    }
+    if (yEnd > message->imageHeight) {
+        yEnd = message->imageHeight;
+    }
+    const size_t bandPixels    = yStart * message->imageWidth;
+    const size_t bandPixelsEnd = yEnd * message->imageWidth;
+    size_t points = 0;
+
+    if (message->mode != Average_Data) {
+        for (size_t i = bandPixels; i < bandPixelsEnd; i++) {
+            imageData[i] = NAN;
+        }
+    }
+
+    // Nearest_Data also fills the pixels around a point, so points in the
+    // rows next to the band are needed as well
+    size_t pointStart = yStart;
+    size_t pointEnd   = yEnd;
+    if (message->mode == Nearest_Data) {
+        if (pointStart > 0) {
+            pointStart--;
+        }
+        if (pointEnd < message->imageHeight) {
+            pointEnd++;
+        }
+    }
+
+    switch (message->mode) {
+    case Average_Data: {
+        for (size_t row = 0; row < map->rows; row++) {
+            if (map->separable &&
+                    (map->y[row] < pointStart || map->y[row] >= pointEnd)) {
+                continue;
+            }
+            for (size_t column = 0; column < map->columns; column++) {
+                size_t i = row * map->columns + column;
+                double value = grid_value(values, i);
+
+                if (value < message->minimum) {
+                    continue;
+                }
+
+                double x, y;
+                grid_map_position(map, row, column, i, &x, &y);
+
+                if (x < 0 || y < pointStart ||
+                        x >= message->imageWidth || y >= pointEnd) {
+                    continue;
                 }
-                data->out.data       = ptr;
-                data->out.size       += CHUNCK_SIZE;
-                data->strm.next_out  = ptr + data->strm.total_out;
-                data->strm.avail_out += CHUNCK_SIZE;
+                size_t iX = (size_t) x;
+                size_t iY = (size_t) y;
+                points++;
+                size_t index = iX + iY * message->imageWidth;
+
+                sums[index]   += value;
+                counts[index] += 1;
             }
+        }
+        for (size_t i = bandPixels; i < bandPixelsEnd; i++) {
+            imageData[i] = counts[i] == 0 ? NAN : sums[i] / counts[i];
+        }
+        break; }
+    case Nearest_Data: {
+        for (size_t i = bandPixels; i < bandPixelsEnd; i++) {
+            nearestDist[i] = 1000000;
+        }
+        for (size_t row = 0; row < map->rows; row++) {
+            if (map->separable &&
+                    (map->y[row] < pointStart || map->y[row] >= pointEnd)) {
+                continue;
+            }
+            for (size_t column = 0; column < map->columns; column++) {
+                size_t i = row * map->columns + column;
+                double value = grid_value(values, i);
 
-            int err = inflate(&(data->strm), Z_NO_FLUSH);
-            switch(err) {
-            case Z_OK:
-                break;
-            case Z_STREAM_END:
-                data->finished = true;
-                break;
+                if (value < message->minimum) {
+                    continue;
+                }
 
-            default:
-                fprintf(stderr, "Got %s while inflating\n%s\n", zError(err),
-                        data->strm.msg == NULL ? "" : data->strm.msg);
-                return CURL_WRITEFUNC_ERROR;
+                double x, y;
+                grid_map_position(map, row, column, i, &x, &y);
+
+                if (x < 0 || y < pointStart ||
+                        x >= message->imageWidth || y >= pointEnd) {
+                    continue;
+                }
+                size_t iX = (size_t) x;
+                size_t iY = (size_t) y;
+                // Points in the rows next to the band are counted by their own band
+                if (yStart <= iY && iY < yEnd) {
+                    points++;
+                }
+
+                size_t index;
+                double dx;
+                double dy;
+                double dist;
+
+                #define DO_NEAREST_FOR_POINT(DX, DY) {                      \
+                    if (yStart <= iY + DY && iY + DY < yEnd) {              \
+                        index = iX + DX + (iY + DY) * message->imageWidth;  \
+                        dx = (x - (iX + DX + 0.5));                         \
+                        dy = (y - (iY + DY + 0.5));                         \
+                        dist = dx * dx + dy * dy;                           \
+                        if (nearestDist[index] > dist) {                    \
+                            imageData[index]   = value;                     \
+                            nearestDist[index] = dist;                      \
+                        }                                                   \
+                    }}
+
+                DO_NEAREST_FOR_POINT(0, 0);
+                if (iX >= 1) DO_NEAREST_FOR_POINT(-1, 0);
+                if (iY >= 1) DO_NEAREST_FOR_POINT(0, -1);
+                if (iX >= 1 && iY >= 1) DO_NEAREST_FOR_POINT(-1, -1);
+                if (iX < message->imageWidth - 1) DO_NEAREST_FOR_POINT(1, 0);
+                if (iY < message->imageHeight - 1) DO_NEAREST_FOR_POINT(0, 1);
+                if (iX < message->imageWidth - 1 && iY < message->imageHeight - 1)
+                    DO_NEAREST_FOR_POINT(1, 1);
+                if (iX >= 1 && iY < message->imageHeight - 1)
+                    DO_NEAREST_FOR_POINT(-1, 1);
+                if (iX < message->imageWidth - 1 && iY >= 1)
+                    DO_NEAREST_FOR_POINT(1, -1);
             }
         }
-    } else {
-        while (data->out.size - data->out.current < inputSize) {
-            size_t newSize;
-            if (data->out.size == 0) {
-                newSize = CHUNCK_SIZE;
-            } else {
-                newSize = data->out.size * 2;
+        break; }
+    case Nearest_Fast_Data: {
+        for (size_t i = bandPixels; i < bandPixelsEnd; i++) {
+            nearestDist[i] = 3; // distances should be <= 2
+        }
+        for (size_t row = 0; row < map->rows; row++) {
+            if (map->separable &&
+                    (map->y[row] < pointStart || map->y[row] >= pointEnd)) {
+                continue;
             }
-            uint8_t* ptr = realloc(data->out.data, newSize);
-            if (ptr == NULL) {
-                fprintf(stderr, "Could not allocate buffer\n");
-                return CURL_WRITEFUNC_ERROR;
+            for (size_t column = 0; column < map->columns; column++) {
+                size_t i = row * map->columns + column;
+                double value = grid_value(values, i);
 
+                if (value < message->minimum) {
+                    continue;
+                }
+
+                double x, y;
+                grid_map_position(map, row, column, i, &x, &y);
+
+                if (x < 0 || y < pointStart ||
+                        x >= message->imageWidth || y >= pointEnd) {
+                    continue;
+                }
+                size_t iX = (size_t) x;
+                size_t iY = (size_t) y;
+                points++;
+                size_t index = iX + iY * message->imageWidth;
+
+                double dx = (x - (iX + 0.5));
+                double dy = (y - (iY + 0.5));
+                double dist = dx * dx + dy * dy;
+
+                if (nearestDist[index] > dist) {
+                    imageData[index]   = value;
+                    nearestDist[index] = dist;
+                }
             }
-            data->out.data = ptr;
-            data->out.size = newSize;
         }
-        memcpy(data->out.data + data->out.current, contents, inputSize);
-        data->out.current += inputSize;
-    }
+        break; }
+    case Max_Data: {
+        for (size_t row = 0; row < map->rows; row++) {
+            if (map->separable &&
+                    (map->y[row] < pointStart || map->y[row] >= pointEnd)) {
+                continue;
+            }
+            for (size_t column = 0; column < map->columns; column++) {
+                size_t i = row * map->columns + column;
+                double value = grid_value(values, i);
+
+                if (value < message->minimum) {
+                    continue;
+                }
+
+                double x, y;
+                grid_map_position(map, row, column, i, &x, &y);
+
+                if (x < 0 || y < pointStart ||
+                        x >= message->imageWidth || y >= pointEnd) {
+                    continue;
+                }
+                size_t iX = (size_t) x;
+                size_t iY = (size_t) y;
+                points++;
+                size_t index = iX + iY * message->imageWidth;
+
+                if (imageData[index] < value || isnan(imageData[index])) {
+                    imageData[index] = value;
+                }
+            }
+        }
+
+        break; }
+    case Min_Data: {
+        for (size_t row = 0; row < map->rows; row++) {
+            if (map->separable &&
+                    (map->y[row] < pointStart || map->y[row] >= pointEnd)) {
+                continue;
+            }
+            for (size_t column = 0; column < map->columns; column++) {
+                size_t i = row * map->columns + column;
+                double value = grid_value(values, i);
+
+                if (value < message->minimum) {
+                    continue;
+                }
+
+                double x, y;
+                grid_map_position(map, row, column, i, &x, &y);
+
+                if (x < 0 || y < pointStart ||
+                        x >= message->imageWidth || y >= pointEnd) {
+                    continue;
+                }
+                size_t iX = (size_t) x;
+                size_t iY = (size_t) y;
+                points++;
+                size_t index = iX + iY * message->imageWidth;
 
+                if (imageData[index] > value || isnan(imageData[index])) {
+                    imageData[index] = value;
+                }
+            }
+        }
+
+        break; }
+    }
 
-    return inputSize;
+    atomic_fetch_add(&(binning->points), points);
 }
 
-typedef struct {
-    bool verbose;
-    const char* logName;
-    bool gzipped;
-    const char* url;
-    uint64_t timeout;
-} DownloadSettings;
+// Finds where each point of the message lands in its image. Grids are usually
+// the same from one message to the next, so this is kept, and only the values
+// are read. NULL on an error, otherwise released with grid_cache_release.
+GridMap* get_grid_map(DecodedMessage* decoded, codes_handle* h,
+                      const MessageSettings* message,
+                      const LogSettings* logS) {
+    GridKey key;
+    grid_key_init(&key, h, message);
+
+    GridMap* map = grid_cache_get(&key);
+    if (map != NULL) {
+        _log(logS, "Using cached grid");
+        return map;
+    }
+    map = build_regular_grid_map(h, message, &key);
+    if (map == NULL) {
+        map = build_grid_map(decoded, message, &key);
+    }
+    if (map != NULL) {
+        grid_cache_add(map);
+    }
+    return map;
+}
 
-typedef struct {
-    size_t totalSize;
-    uint8_t* gribStart;
-    uint8_t* data;
-    int error;
-} DownloadedData;
-
-DownloadedData download_data(const DownloadSettings* settings) {
-    DownloadedData output;
+ImageData generate_image_data(MessageSettings* message,
+                              DecodedMessage* decoded, bool verbose,
+                              size_t threads) {
+    ImageData output;
     output.error = 0;
 
-    int err;
-    size_t totalSize;
     LogSettings logS = {
-        .verbose = settings->verbose,
-        .logName = settings->logName,
+        .verbose = verbose,
+        .logName = message->title,
     };
-    CURL* curl = NULL;
-    CURLcode res;
-
-    DownloadingData data;
-    data.finished = false;
-
-    data.out.size = 0;
-    data.out.data = NULL;
-    data.out.current = 0;
-
-    data.strm.zalloc    = Z_NULL;
-    data.strm.zfree     = Z_NULL;
-    data.strm.opaque    = Z_NULL;
-    data.strm.next_in   = NULL;
-    data.strm.avail_in  = 0;
-    data.strm.next_out  = NULL;
-    data.strm.avail_out = 0;
-
-    data.gzipped = settings->gzipped;
-
-    _log(&logS, "Downloading");
-    err = inflateInit2(&(data.strm), 15 + 16);
-    if (err != Z_OK) {
-        fprintf(stderr, "Could not initialize zlib stream\n");
+
+    MessageMetrics* metrics = &(message->metrics);
+    double start = clock_ms();
+    codes_handle* h = decoded_message_handle(decoded);
+    metrics->decodeTime += clock_ms() - start;
+    if (h == NULL) {
         output.error = 1;
         return output;
     }
 
-    curl = curl_easy_init();
-    if (curl == NULL) {
-        fprintf(stderr, "Could not initialize curl\n");
+    _log(&logS, "Preparing Data");
+
+    start = clock_ms();
+    GridMap* map = get_grid_map(decoded, h, message, &logS);
+    metrics->gridTime += clock_ms() - start;
+    if (map == NULL) {
         output.error = 1;
         return output;
     }
-    curl_easy_setopt(curl, CURLOPT_URL, settings->url);
-    curl_easy_setopt(curl, CURLOPT_TIMEOUT, settings->timeout);
-    curl_easy_setopt(curl, CURLOPT_WRITEFUNCTION, chunk_from_server);
-    curl_easy_setopt(curl, CURLOPT_FOLLOWLOCATION, true);
-    curl_easy_setopt(curl, CURLOPT_WRITEDATA, &data);
 
-    res = curl_easy_perform(curl);
-    if (res != CURLE_OK) {
-        fprintf(stderr, "Failed to get URL %s with: %s\n", settings->url,
-                curl_easy_strerror(res));
+    start = clock_ms();
+    const GridValues* values = decoded_message_values(decoded,
+                                                      message->floatValues);
+    metrics->decodeTime += clock_ms() - start;
+    if (values == NULL) {
+        grid_cache_release(map);
         output.error = 1;
         return output;
     }
-    curl_easy_cleanup(curl);
-    if (settings->gzipped) {
-        totalSize = data.strm.total_out;
-    } else {
-        totalSize = data.out.current;
+
+    if (values->size != map->count) {
+        fprintf(stderr, "Grid has %zu points, but got %zu values\n",
+                map->count, values->size);
+        grid_cache_release(map);
+        output.error = 1;
+        return output;
+    }
+
+    output.coords = map->coords;
+
+    start = clock_ms();
+
+    // Only averaging needs a sum and a count per pixel. The sums are kept as
+    // doubles, as adding up many points in a float loses precision. The other
+    // modes mark pixels without data as NAN.
+    const size_t pixels = message->imageWidth * message->imageHeight;
+    float* imageData  = malloc(pixels * sizeof(*imageData));
+    double* sums      = NULL;
+    uint32_t* counts  = NULL;
+    float* nearestDist = NULL;
+    if (message->mode == Average_Data) {
+        sums   = calloc(pixels, sizeof(*sums));
+        counts = calloc(pixels, sizeof(*counts));
+    } else if (message->mode == Nearest_Data ||
+               message->mode == Nearest_Fast_Data) {
+        nearestDist = malloc(pixels * sizeof(*nearestDist));
+    }
+    if (imageData == NULL ||
+            (message->mode == Average_Data && (sums == NULL || counts == NULL)) ||
+            ((message->mode == Nearest_Data || message->mode == Nearest_Fast_Data)
+             && nearestDist == NULL)) {
+        free(imageData);
+        free(sums);
+        free(counts);
+        free(nearestDist);
+        grid_cache_release(map);
+        output.error = 1;
+        return output;
     }
-    inflateEnd(&(data.strm));
 
+    output.imageData = imageData;
 
-    uint8_t* d = data.out.data;
-    {
-        size_t i = 4;
-        while (i < totalSize) {
-            if (memcmp(d, "GRIB", 4) == 0) {
-                break;
-            }
-            d++;
-            i++;
-        }
-        totalSize = totalSize + 4 - i;
+    // The image is split into bands of rows, which are binned at the same
+    // time. Every band looks at each point of a grid which is not separable,
+    // so those get one band per thread. Separable grids skip whole rows, so
+    // they get more bands to even out the work.
+    if (threads == 0) {
+        threads = parallel_default_threads();
     }
+    size_t bands = map->separable ? threads * 4 : threads;
+    if (bands > message->imageHeight) {
+        bands = message->imageHeight;
+    }
+    if (bands == 0) {
+        bands = 1;
+    }
+    Binning binning = {
+        .message     = message,
+        .map         = map,
+        .values      = values,
+        .imageData   = imageData,
+        .sums        = sums,
+        .counts      = counts,
+        .nearestDist = nearestDist,
+        .bandHeight  = (message->imageHeight + bands - 1) / bands,
+    };
+    atomic_init(&(binning.points), 0);
+    parallel_run(threads, bands, bin_band, &binning);
 
-    output.totalSize = totalSize;
-    output.gribStart = d;
-    output.data      = data.out.data;
+    free(sums);
+    free(counts);
+    free(nearestDist);
+    grid_cache_release(map);
+    metrics->points  += atomic_load(&(binning.points));
+    metrics->binTime += clock_ms() - start;
 
     return output;
 }
 
-typedef struct {
-    ImageArea coords;
-    double* imageData;
-    uint32_t* counts;
-    int error;
-} ImageData;
+// Returns non zero on an error
+int contour_image_data(MessageSettings* message,
+                       const CompiledColorTable* palette, ImageData* input) {
+    const size_t width  = message->imageWidth;
+    const size_t height = message->imageHeight;
+    float* imageData    = input->imageData;
+
+    // Each pixel's palette index is found once, -1 if it has no color. Indexes
+    // always fit, as compiled color tables keep them as int16_t too.
+    int16_t* indexes = malloc(width * height * sizeof(*indexes));
+    if (indexes == NULL) {
+        return 1;
+    }
+    for (size_t i = 0; i < width * height; i++) {
+        if (isnan(imageData[i])) {
+            indexes[i] = -1;
+        } else {
+            indexes[i] = compiled_color_table_get_index(palette, imageData[i]);
+        }
+    }
 
-double correct_alias(double a, double b) {
-    // Find the "alias number" for a and b
-    double Na = floor((a - 180) / 360) + 1;
-    double Nb = floor((b - 180) / 360) + 1;
+    // A pixel is only kept if it, the pixel to its right, and the two below
+    // them do not all have the same index
+    for (size_t y = 0; y + 1 < height; y++) {
+        const int16_t* row  = indexes + y * width;
+        const int16_t* next = row + width;
+        for (size_t x = 0; x + 1 < width; x++) {
+            if (row[x] == row[x + 1] &&
+                row[x] == next[x] &&
+                row[x] == next[x + 1]) {
+                imageData[x + y * width] = NAN;
+            }
+        }
+    }
+    free(indexes);
 
-    // make b be on the same alias as a
-    return b + (Na - Nb) * 360;
+    for (size_t x = 0; x < width; x++) {
+        size_t i = x + (height - 1) * width;
+        imageData[i] = NAN;
+    }
+    for (size_t y = 0; y < height; y++) {
+        size_t i = (width - 1) + (y) * width;
+        imageData[i] = NAN;
+    }
+    return 0;
 }
 
-ImageData generate_image_data(MessageSettings* message, uint8_t* d, size_t size,
-                            bool verbose, size_t* offsets, size_t offsetsSize) {
-    ImageData output;
-    output.error = 0;
 
-    LogSettings logS = {
-        .verbose = verbose,
-        .logName = message->title,
-    };
-    size_t offset = message->offset;
-    if (offsetsSize > 0 && offsets != NULL) {
-        if (offsetsSize <= offset) {
-            output.error = 1;
-            return output;
+// One part of an image, written to its own file
+typedef struct {
+    const char* path;
+    size_t x, y;
+    size_t width, height;
+} ImageTile;
+
+typedef struct {
+    const MessageSettings* message;
+    const uint8_t* imageBuffer;
+    const ImageTile* tiles;
+    atomic_size_t bytes;
+    atomic_bool failed;
+} TileWriting;
+
+void write_tile(void* data, size_t index) {
+    TileWriting* writing           = data;
+    const MessageSettings* message = writing->message;
+    const ImageTile* tile          = writing->tiles + index;
+
+    // Tiles are written straight out of the image, so each only needs its
+    // own libpng and zlib state
+    size_t size;
+    if (write_png(tile->path,
+                  writing->imageBuffer +
+                        (tile->y * message->imageWidth + tile->x) * 4,
+                  tile->width,
+                  tile->height,
+                  message->imageWidth * 4,
+                  &(message->png),
+                  &size)) {
+        fprintf(stderr, "Did not write image\n");
+        atomic_store(&(writing->failed), true);
+        return;
+    }
+    atomic_fetch_add(&(writing->bytes), size);
+}
+
+int save_image(MessageSettings* message,
+               ImageData* imData,
+               uint8_t* imageBuffer,
+               size_t threads) {
+    if (message->tiled) {
+        size_t leftWidth    = message->imageWidth / 2;
+        size_t rightWidth   = message->imageWidth - leftWidth;
+        size_t topHeight    = message->imageHeight / 2;
+        size_t bottomHeight = message->imageHeight - topHeight;
+
+        const ImageTile tiles[] = {
+            {message->topLeftImageFile,     0,         0,         leftWidth,  topHeight},
+            {message->topRightImageFile,    leftWidth, 0,         rightWidth, topHeight},
+            {message->bottomLeftImageFile,  0,         topHeight, leftWidth,  bottomHeight},
+            {message->bottomRightImageFile, leftWidth, topHeight, rightWidth, bottomHeight},
+        };
+        TileWriting writing = {
+            .message     = message,
+            .imageBuffer = imageBuffer,
+            .tiles       = tiles,
+        };
+        atomic_init(&(writing.bytes), 0);
+        atomic_init(&(writing.failed), false);
+        parallel_run(threads, sizeof(tiles) / sizeof(*tiles), write_tile,
+                     &writing);
+        message->metrics.outputBytes += atomic_load(&(writing.bytes));
+        if (atomic_load(&(writing.failed))) {
+            return 1;
         }
-        offset = offsets[offset];
+
+        // find middle coords
+        double coef;
+        double cordDiff;
+
+        coef     = ((double)leftWidth) / ((double)message->imageWidth);
+        cordDiff = imData->coords.lonR - imData->coords.lonL;
+        double middleLon = imData->coords.lonL + coef * cordDiff;
+
+        const double yM = (message->imageHeight - 0.01) / (PROJECT_LAT_Y(imData->coords.latB) - PROJECT_LAT_Y(imData->coords.latT));
+        const double yB = PROJECT_LAT_Y(imData->coords.latT);
+        double dy = ((double)topHeight) / yM + yB;
+        double middleLat = (atan(exp(dy)) - MERCADER_OFFS) / MERCADER_COEF;
+
+        message->output.topLeftArea.latT = imData->coords.latT;
+        message->output.topLeftArea.latB = middleLat;
+        message->output.topLeftArea.lonL = imData->coords.lonL;
+        message->output.topLeftArea.lonR = middleLon;
+
+        message->output.topRightArea.latT = imData->coords.latT;
+        message->output.topRightArea.latB = middleLat;
+        message->output.topRightArea.lonL = middleLon;
+        message->output.topRightArea.lonR = imData->coords.lonR;
+
+        message->output.bottomLeftArea.latT = middleLat;
+        message->output.bottomLeftArea.latB = imData->coords.latB;
+        message->output.bottomLeftArea.lonL = imData->coords.lonL;
+        message->output.bottomLeftArea.lonR = middleLon;
+
+        message->output.bottomRightArea.latT = middleLat;
+        message->output.bottomRightArea.latB = imData->coords.latB;
+        message->output.bottomRightArea.lonL = middleLon;
+        message->output.bottomRightArea.lonR = imData->coords.lonR;
+
+        return 0;
+    } else {
+        size_t size;
+        if (write_png(message->topLeftImageFile,
+                      imageBuffer,
+                      message->imageWidth,
+                      message->imageHeight,
+                      message->imageWidth * 4,
+                      &(message->png),
+                      &size)) {
+            return 1;
+        }
+        message->metrics.outputBytes += size;
+
+        message->output.topLeftArea.latT = imData->coords.latT;
+        message->output.topLeftArea.latB = imData->coords.latB;
+        message->output.topLeftArea.lonL = imData->coords.lonL;
+        message->output.topLeftArea.lonR = imData->coords.lonR;
+
+        return 0;
     }
+}
 
-    codes_handle* h = codes_handle_new_from_message(NULL, d + offset,
-            size - offset);
-    if (h == NULL) {
-        fprintf(stderr, "Could not read in product\n");
-        output.error = 1;
-        return output;
+// Colors each pixel from its value, and leaves pixels without data clear
+void colorize_image(const CompiledColorTable* palette, const float* imageData,
+                    size_t pixels, uint8_t* imageBuffer) {
+    for (size_t i = 0; i < pixels; i++) {
+        if (isnan(imageData[i])) {
+            imageBuffer[i * 4 + 0] = 0;
+            imageBuffer[i * 4 + 1] = 0;
+            imageBuffer[i * 4 + 2] = 0;
+            imageBuffer[i * 4 + 3] = 0;
+        } else {
+            compiled_color_table_get(palette, imageData[i], imageBuffer + i * 4);
+        }
     }
+}
 
-    _log(&logS, "Preparing Data");
+// Finds the area the message's image covers, without binning it. Returns non
+// zero on an error.
+int message_image_area(DecodedMessage* decoded,
+                       const MessageSettings* message,
+                       const LogSettings* logS, ImageArea* area) {
+    if (message->customArea) {
+        *area = message->area;
+        return 0;
+    }
 
-    size_t latLonValuesSize;
-    double* latLonValues;
-    CODES_CHECK(codes_get_size(h, "latLonValues", &latLonValuesSize), 0);
-    latLonValues = malloc(latLonValuesSize * sizeof(double));
-    if (latLonValues == NULL) {
-        output.error = 1;
-        return output;
+    codes_handle* h = decoded_message_handle(decoded);
+    if (h == NULL) {
+        return 1;
     }
-    CODES_CHECK(codes_get_double_array(h, "latLonValues",
-                latLonValues, &latLonValuesSize), 0);
-    codes_handle_delete(h);
 
-    double lonL, lonR, latT, latB;
-    lonL = 1000;
-    lonR = -1000;
-    latB = 1000;
-    latT = -1000;
+    // The map is only needed for its bounds, but is cached like any other,
+    // so the next message on the same grid does not build it again
+    GridMap* map = get_grid_map(decoded, h, message, logS);
+    if (map == NULL) {
+        return 1;
+    }
+    *area = map->coords;
+    grid_cache_release(map);
+    return 0;
+}
 
-    for (size_t i = 0; i < latLonValuesSize; i += 3) {
-        const double lat = latLonValues[i + 0];
-        const double lon = latLonValues[i + 1];
-        if (lon > lonR)
-            lonR = lon;
-        if (lon < lonL)
-            lonL = lon;
-        if (lat > latT)
-            latT = lat;
-        if (lat < latB)
-            latB = lat;
+// One zoom of a pyramid, colored and ready to be split into tiles
+typedef struct {
+    const MessageSettings* message;
+    const TileLevel* level;
+    const uint8_t* imageBuffer;
+    bool* written;
+    atomic_bool failed;
+    atomic_size_t bytes;
+} PyramidWriting;
+
+void write_pyramid_tile(void* data, size_t index) {
+    PyramidWriting* writing        = data;
+    const MessageSettings* message = writing->message;
+    const TileLevel* level         = writing->level;
+    const size_t column = index % level->columns;
+    const size_t row    = index / level->columns;
+    const size_t stride = tile_level_width(level) * 4;
+    const uint8_t* tile = writing->imageBuffer +
+                          row * TILE_SIZE * stride + column * TILE_SIZE * 4;
+
+    writing->written[index] = false;
+    bool empty = true;
+    for (size_t y = 0; y < TILE_SIZE && empty; y++) {
+        const uint8_t* pixels = tile + y * stride;
+        for (size_t x = 0; x < TILE_SIZE; x++) {
+            if (pixels[x * 4 + 3] != 0) {
+                empty = false;
+                break;
+            }
+        }
+    }
+    if (empty) {
+        return;
     }
 
-    if (message->customArea) {
-        // correct aliasing. Includes logic for crossing the anti-meridian
-        double lonRL = correct_alias(lonL, message->area.lonR);
-        double lonRR = correct_alias(lonR, message->area.lonR);
-        double newLonR;
-        if (lonL < lonRL && lonRL < lonR) {
-            newLonR = lonRL;
-        } else {
-            newLonR = lonRR;
+    char path[4096];
+    size_t size;
+    if (!tile_path(path, sizeof(path), message->topLeftImageFile, level->z,
+                   level->x + column, level->y + row) ||
+            make_parent_directories(path) ||
+            write_png(path, tile, TILE_SIZE, TILE_SIZE, stride,
+                      &(message->png), &size)) {
+        fprintf(stderr, "Did not write image\n");
+        atomic_store(&(writing->failed), true);
+        return;
+    }
+    atomic_fetch_add(&(writing->bytes), size);
+    writing->written[index] = true;
+}
+
+// Colors one zoom of a pyramid and writes its tiles which have data, adding
+// them to tiles, and the time taken to metrics. Returns non zero on an error.
+int write_pyramid_level(const MessageSettings* message,
+                        const CompiledColorTable* palette, TileLevel* level,
+                        TileIndex** tiles, size_t* tileCount,
+                        MessageMetrics* metrics, size_t threads) {
+    const size_t width  = tile_level_width(level);
+    const size_t height = tile_level_height(level);
+    const size_t count  = level->columns * level->rows;
+
+    // Contouring clears pixels, and the level is still needed for the one
+    // below it
+    const float* imageData = level->data;
+    float* contoured = NULL;
+    if (message->contour) {
+        double start = clock_ms();
+        contoured = malloc(width * height * sizeof(*contoured));
+        if (contoured == NULL) {
+            return 1;
         }
+        memcpy(contoured, level->data, width * height * sizeof(*contoured));
+
+        MessageSettings levelMessage = *message;
+        levelMessage.imageWidth  = width;
+        levelMessage.imageHeight = height;
+        ImageData contourData = {
+            .imageData = contoured,
+        };
+        if (contour_image_data(&levelMessage, palette, &contourData)) {
+            free(contoured);
+            return 1;
+        }
+        imageData = contoured;
+        metrics->contourTime += clock_ms() - start;
+    }
 
-        double lonLL = correct_alias(lonL, message->area.lonL);
-        double lonLR = correct_alias(lonR, message->area.lonL);
-        double newLonL;
-        if (lonL < lonLR && lonRL < lonR) {
-            newLonL = lonLR;
-        } else {
-            newLonL = lonLL;
+    uint8_t* imageBuffer = malloc(width * height * 4);
+    bool* written = malloc(count * sizeof(*written));
+    TileIndex* grown = realloc(*tiles, (*tileCount + count) * sizeof(**tiles));
+    if (grown != NULL) {
+        *tiles = grown;
+    }
+    if (imageBuffer == NULL || written == NULL || grown == NULL) {
+        free(contoured);
+        free(imageBuffer);
+        free(written);
+        return 1;
+    }
+    double start = clock_ms();
+    colorize_image(palette, imageData, width * height, imageBuffer);
+    metrics->colorizeTime += clock_ms() - start;
+    free(contoured);
+
+    PyramidWriting writing = {
+        .message     = message,
+        .level       = level,
+        .imageBuffer = imageBuffer,
+        .written     = written,
+    };
+    atomic_init(&(writing.failed), false);
+    atomic_init(&(writing.bytes), 0);
+    start = clock_ms();
+    parallel_run(threads, count, write_pyramid_tile, &writing);
+    metrics->encodeTime  += clock_ms() - start;
+    metrics->outputBytes += atomic_load(&(writing.bytes));
+
+    for (size_t i = 0; i < count; i++) {
+        if (written[i]) {
+            TileIndex* tile = *tiles + *tileCount;
+            tile->z = level->z;
+            tile->x = level->x + i % level->columns;
+            tile->y = level->y + i / level->columns;
+            (*tileCount)++;
         }
+    }
 
-        lonR = newLonR;
-        lonL = newLonL;
-        latT = message->area.latT;
-        latB = message->area.latB;
+    free(imageBuffer);
+    free(written);
+    return atomic_load(&(writing.failed));
+}
+
+// Bins the message once at the pyramid's zoom, then writes that zoom and each
+// one below it. Returns non zero on an error, including one reading the
+// message, so the last tiles are not taken as current. Data outside of the
+// tiles is not an error.
+int render_pyramid(const Settings* settings, MessageSettings* message,
+                   DecodedMessage* decoded, uint64_t fingerprint,
+                   size_t threads) {
+    LogSettings logS = {
+        .verbose = settings->verbose,
+        .logName = message->title,
+    };
+
+    ImageArea area;
+    TileLevel level;
+    double start = clock_ms();
+    int areaErr = message_image_area(decoded, message, &logS, &area);
+    message->metrics.gridTime += clock_ms() - start;
+    if (areaErr) {
+        return 1;
+    }
+    if (!tile_level_cover(message->pyramid.zoom, &area, &level)) {
+        _log(&logS, "Data is outside of the tiles");
+        return 0;
     }
 
-    output.coords.lonL = lonL;
-    output.coords.lonR = lonR;
-    output.coords.latT = latT;
-    output.coords.latB = latB;
+    // The image lines up with the tiles, so each is a block of it
+    MessageSettings levelMessage = *message;
+    levelMessage.imageWidth  = tile_level_width(&level);
+    levelMessage.imageHeight = tile_level_height(&level);
+    levelMessage.customArea  = true;
+    tile_area(level.z, level.x, level.y, level.columns, level.rows,
+              &(levelMessage.area));
+
+    ImageData imData = generate_image_data(&levelMessage, decoded,
+                                           settings->verbose, threads);
+    message->metrics = levelMessage.metrics;
+    if (imData.error) {
+        return 1;
+    }
+    level.data = imData.imageData;
 
-    const double xM = (message->imageWidth - 0.01)  / (lonR - lonL);
-    const double yM = (message->imageHeight - 0.01) / (PROJECT_LAT_Y(latB) - PROJECT_LAT_Y(latT));
-    const double yB = PROJECT_LAT_Y(latT);
+    CompiledColorTable* palette = color_table_compile(message->palette,
+                                                      message->png.indexed);
+    if (palette == NULL) {
+        free(level.data);
+        return 1;
+    }
+
+    _log(&logS, "Rendering Tiles");
+
+    TileIndex* tiles = NULL;
+    size_t tileCount = 0;
+    int err = 0;
+    while (true) {
+        err = write_pyramid_level(message, palette, &level, &tiles, &tileCount,
+                                  &(message->metrics), threads);
+        if (err || level.z <= message->pyramid.minZoom || level.z == 0) {
+            break;
+        }
 
-    double* imageData = NULL;
-    uint32_t* counts   = NULL;
-    imageData = calloc(message->imageWidth * message->imageHeight, sizeof(*imageData));
-    counts    = calloc(message->imageWidth * message->imageHeight, sizeof(*counts));
-    if (imageData == NULL || counts == NULL) {
-        output.error = 1;
-        return output;
+        TileLevel lower;
+        double start = clock_ms();
+        err = tile_level_downsample(&level, message->mode, &lower);
+        message->metrics.binTime += clock_ms() - start;
+        free(level.data);
+        level = lower;
+        if (err) {
+            break;
+        }
     }
+    free(level.data);
+    compiled_color_table_free(palette);
 
-    output.imageData = imageData;
-    output.counts = counts;
+    if (err) {
+        free(tiles);
+        return 1;
+    }
 
-    double lastLat = -10000;
-    double lastY   = 0;
+    free_tile_list(message);
+    message->tiles     = tiles;
+    message->tileCount = tileCount;
+    message->output.topLeftArea = levelMessage.area;
+    message->fingerprint = fingerprint;
+    return 0;
+}
 
-    switch (message->mode) {
-    case Average_Data: {
-        for (size_t i = 0; i < latLonValuesSize; i += 3) {
-            double lat   = latLonValues[i + 0];
-            double lon   = latLonValues[i + 1];
-            double value = latLonValues[i + 2];
+void free_tile_list(MessageSettings* message) {
+    free(message->tiles);
+    message->tiles     = NULL;
+    message->tileCount = 0;
+}
 
-            if (value < message->minimum) {
-                continue;
-            }
+#define FNV_OFFSET 14695981039346656037ULL
+#define FNV_PRIME  1099511628211ULL
 
-            double x = (lon - lonL) * xM;
-            double y;
-            if (lat == lastLat) {
-                y = lastY;
-            } else {
-                y = (PROJECT_LAT_Y(lat) - yB) * yM;
-                lastLat = lat;
-                lastY   = y;
-            }
+uint64_t fnv1a(uint64_t hash, const uint8_t* d, size_t size) {
+    for (size_t i = 0; i < size; i++) {
+        hash = (hash ^ d[i]) * FNV_PRIME;
+    }
+    return hash;
+}
 
-            if (x < 0 || y < 0 ||
-                    x >= message->imageWidth || y >= message->imageHeight) {
-                continue;
-            }
-            size_t iX = (size_t) x;
-            size_t iY = (size_t) y;
-            size_t index = iX + iY * message->imageWidth;
+static inline uint64_t read_big_endian(const uint8_t* d, size_t bytes) {
+    uint64_t value = 0;
+    for (size_t i = 0; i < bytes; i++) {
+        value = (value << 8) | d[i];
+    }
+    return value;
+}
 
-            imageData[index] += value;
-            counts[index]    += 1;
-        }
-        break; }
-    case Nearest_Data: {
-        double* nearestDist = malloc(message->imageWidth * message->imageHeight * sizeof(*nearestDist));
-        if (nearestDist == NULL) {
-            output.error = 1;
-            return output;
-        }
-        for (size_t i = 0; i < message->imageWidth * message->imageHeight; i++) {
-            nearestDist[i] = 1000000;
+// Hashes what decides a message's values. For GRIB2, that is the grid, data
+// representation, bitmap and data sections, so the same data with a new
+// reference time has the same fingerprint. Otherwise it is the whole message.
+// Never 0.
+uint64_t message_fingerprint(const uint8_t* d, size_t size) {
+    uint64_t hash = FNV_OFFSET;
+    if (size >= 16 && memcmp(d, "GRIB", 4) == 0 && d[7] == 2) {
+        uint64_t length = read_big_endian(d + 8, 8);
+        if (length < size) {
+            size = length;
         }
-        for (size_t i = 0; i < latLonValuesSize; i += 3) {
-            double lat   = latLonValues[i + 0];
-            double lon   = latLonValues[i + 1];
-            double value = latLonValues[i + 2];
 
-            if (value < message->minimum) {
-                continue;
-            }
-
-            double x = (lon - lonL) * xM;
-            double y;
-            if (lat == lastLat) {
-                y = lastY;
-            } else {
-                y = (PROJECT_LAT_Y(lat) - yB) * yM;
-                lastLat = lat;
-                lastY   = y;
+        size_t offset = 16;
+        while (offset + 5 <= size && memcmp(d + offset, "7777", 4) != 0) {
+            uint64_t sectionLength = read_big_endian(d + offset, 4);
+            uint8_t section = d[offset + 4];
+            if (sectionLength < 5 || sectionLength > size - offset) {
+                break;
             }
-
-            if (x < 0 || y < 0 ||
-                    x >= message->imageWidth || y >= message->imageHeight) {
-                continue;
+            if (section == 3 || section >= 5) {
+                hash = fnv1a(hash, d + offset, sectionLength);
             }
-            size_t iX = (size_t) x;
-            size_t iY = (size_t) y;
-
-            size_t index;
-            double dx;
-            double dy;
-            double dist;
-
-            #define DO_NEAREST_FOR_POINT(DX, DY) {                      \
-                index = iX + DX + (iY + DY) * message->imageWidth;      \
-                dx = (x - (iX + DX + 0.5));                             \
-                dy = (y - (iY + DY + 0.5));                             \
-                dist = dx * dx + dy * dy;                               \
-                if (nearestDist[index] > dist) {                        \
-                    imageData[index]   = value;                         \
-                    counts[index]      = 1;                             \
-                    nearestDist[index] = dist;                          \
-                }}
-
-            DO_NEAREST_FOR_POINT(0, 0);
-            if (iX >= 1) DO_NEAREST_FOR_POINT(-1, 0);
-            if (iY >= 1) DO_NEAREST_FOR_POINT(0, -1);
-            if (iX >= 1 && iY >= 1) DO_NEAREST_FOR_POINT(-1, -1);
-            if (iX < message->imageWidth - 1) DO_NEAREST_FOR_POINT(1, 0);
-            if (iY < message->imageHeight - 1) DO_NEAREST_FOR_POINT(0, 1);
-            if (iX < message->imageWidth - 1 && iY < message->imageHeight - 1)
-                DO_NEAREST_FOR_POINT(1, 1);
-            if (iX >= 1 && iY < message->imageHeight - 1)
-                DO_NEAREST_FOR_POINT(-1, 1);
-            if (iX < message->imageWidth - 1 && iY >= 1)
-                DO_NEAREST_FOR_POINT(1, -1);
-        }
-        free(nearestDist);
-        break; }
-    case Nearest_Fast_Data: {
-        double* nearestDist = malloc(message->imageWidth * message->imageHeight * sizeof(*nearestDist));
-        if (nearestDist == NULL) {
-            output.error = 1;
-            return output;
-        }
-        for (size_t i = 0; i < message->imageWidth * message->imageHeight; i++) {
-            nearestDist[i] = 3; // distances should be <= 2
+            offset += sectionLength;
         }
-        for (size_t i = 0; i < latLonValuesSize; i += 3) {
-            double lat   = latLonValues[i + 0];
-            double lon   = latLonValues[i + 1];
-            double value = latLonValues[i + 2];
-
-            if (value < message->minimum) {
-                continue;
-            }
+    } else {
+        hash = fnv1a(hash, d, size);
+    }
+    return hash == 0 ? 1 : hash;
+}
 
-            double x = (lon - lonL) * xM;
-            double y;
-            if (lat == lastLat) {
-                y = lastY;
-            } else {
-                y = (PROJECT_LAT_Y(lat) - yB) * yM;
-                lastLat = lat;
-                lastY   = y;
-            }
+// Returns non zero on an error which should stop all rendering
+int render_message(const Settings* settings, MessageSettings* message,
+                   DecodedMessage* decoded, uint64_t fingerprint,
+                   size_t threads) {
+    LogSettings logS = {
+        .verbose = settings->verbose,
+        .logName = message->title,
+    };
 
-            if (x < 0 || y < 0 ||
-                    x >= message->imageWidth || y >= message->imageHeight) {
-                continue;
-            }
-            size_t iX = (size_t) x;
-            size_t iY = (size_t) y;
-            size_t index = iX + iY * message->imageWidth;
-
-            double dx = (x - (iX + 0.5));
-            double dy = (y - (iY + 0.5));
-            double dist = dx * dx + dy * dy;
-
-            if (nearestDist[index] > dist) {
-                imageData[index]   = value;
-                counts[index]      = 1;
-                nearestDist[index] = dist;
-            }
-        }
-        free(nearestDist);
-        break; }
-    case Max_Data: {
-        for (size_t i = 0; i < latLonValuesSize; i += 3) {
-            double lat   = latLonValues[i + 0];
-            double lon   = latLonValues[i + 1];
-            double value = latLonValues[i + 2];
+    // The fingerprint is only replaced once every file of the image has been
+    // written, so one which failed is rendered again next time
+    message->unchanged = fingerprint == message->fingerprint;
+    if (message->unchanged) {
+        _log(&logS, "Data has not changed, keeping the last image");
+        return 0;
+    }
 
-            if (value < message->minimum) {
-                continue;
-            }
+    if (message->pyramid.enabled) {
+        return render_pyramid(settings, message, decoded, fingerprint,
+                              threads);
+    }
 
-            double x = (lon - lonL) * xM;
-            double y;
-            if (lat == lastLat) {
-                y = lastY;
-            } else {
-                y = (PROJECT_LAT_Y(lat) - yB) * yM;
-                lastLat = lat;
-                lastY   = y;
-            }
+    ImageData imData = generate_image_data(message, decoded, settings->verbose,
+                                           threads);
+    if (imData.error) {
+        return 0;
+    }
 
-            if (x < 0 || y < 0 ||
-                    x >= message->imageWidth || y >= message->imageHeight) {
-                continue;
-            }
-            size_t iX = (size_t) x;
-            size_t iY = (size_t) y;
-            size_t index = iX + iY * message->imageWidth;
+    CompiledColorTable* palette = color_table_compile(message->palette,
+                                                      message->png.indexed);
+    if (palette == NULL) {
+        free(imData.imageData);
+        return 1;
+    }
 
-            if (imageData[index] < value || counts[index] == 0) {
-                imageData[index]   = value;
-                counts[index]      = 1;
-            }
+    // Contour data if needed
+    if (message->contour) {
+        _log(&logS, "Contouring Image");
+        double start = clock_ms();
+        if (contour_image_data(message, palette, &imData)) {
+            free(imData.imageData);
+            compiled_color_table_free(palette);
+            return 1;
         }
+        message->metrics.contourTime += clock_ms() - start;
+    }
 
-        break; }
-    case Min_Data: {
-        for (size_t i = 0; i < latLonValuesSize; i += 3) {
-            double lat   = latLonValues[i + 0];
-            double lon   = latLonValues[i + 1];
-            double value = latLonValues[i + 2];
+    float* imageData = imData.imageData;
 
-            if (value < message->minimum) {
-                continue;
-            }
+    _log(&logS, "Rendering Image");
 
-            double x = (lon - lonL) * xM;
-            double y;
-            if (lat == lastLat) {
-                y = lastY;
-            } else {
-                y = (PROJECT_LAT_Y(lat) - yB) * yM;
-                lastLat = lat;
-                lastY   = y;
-            }
+    png_image image;
+    memset(&image, 0, sizeof(image));
+    image.version = PNG_IMAGE_VERSION;
+    image.format = PNG_FORMAT_RGBA;
+    image.width  = message->imageWidth;
+    image.height = message->imageHeight;
+    image.flags = 0;
 
-            if (x < 0 || y < 0 ||
-                    x >= message->imageWidth || y >= message->imageHeight) {
-                continue;
-            }
-            size_t iX = (size_t) x;
-            size_t iY = (size_t) y;
-            size_t index = iX + iY * message->imageWidth;
+    uint8_t* imageBuffer = NULL;
+    imageBuffer = malloc(PNG_IMAGE_SIZE(image));
+    if (imageBuffer == NULL) {
+        free(imageData);
+        compiled_color_table_free(palette);
+        return 1;
+    }
+    png_image_free(&image);
+    double start = clock_ms();
+    colorize_image(palette, imageData,
+                   message->imageWidth * message->imageHeight, imageBuffer);
+    message->metrics.colorizeTime += clock_ms() - start;
 
-            if (imageData[index] > value || counts[index] == 0) {
-                imageData[index]   = value;
-                counts[index]      = 1;
-            }
-        }
+    free(imageData);
+    compiled_color_table_free(palette);
 
-        break; }
+    start = clock_ms();
+    int err = save_image(message, &imData, imageBuffer, threads);
+    free(imageBuffer);
+    if (err) {
+        return 1;
     }
-    free(latLonValues);
+    message->metrics.encodeTime += clock_ms() - start;
+    message->fingerprint = fingerprint;
 
-    return output;
+    return 0;
 }
 
-void contour_image_data(MessageSettings* message, ImageData* input) {
-
-    // This is somewhat inefficent right now. It would be faster to go over the
-    // data twice, once to label, and again to contour
-    for (size_t x = 0; x < message->imageWidth - 1; x++) {
-        for (size_t y = 0; y < message->imageHeight - 1; y++) {
-            size_t is[4];
-            double values[4];
-            ssize_t indexes[4];
-#define GET_INDEX(index, xoff, yoff) { \
-                is[index] = (x + xoff) + (y + yoff) * message->imageWidth; \
-                if (input->counts[is[index]] == 0) { \
-                    values[index] = 0; \
-                    indexes[index] = -1; \
-                } else { \
-                    values[index] = input->imageData[is[index]] / input->counts[is[index]]; \
-                    indexes[index] = color_table_get_index(message->palette, values[index]); \
-                } \
-            }
-            GET_INDEX(0, 0, 0)
-            GET_INDEX(1, 1, 0)
-            GET_INDEX(2, 0, 1)
-            GET_INDEX(3, 1, 1)
-#undef GET_INDEX
-
-            if (indexes[0] == indexes[1] &&
-                indexes[0] == indexes[2] &&
-                indexes[0] == indexes[3]) {
-                input->counts[is[0]] = 0;
-            }
-        }
-    }
+// Renders every image of the GRIB message at d, which is only decoded once for
+// all of them. Returns non zero on an error which should stop all rendering.
+int render_messages(const Settings* settings, MessageSettings** messages,
+                    size_t count, uint8_t* d, size_t size, size_t threads) {
+    uint64_t fingerprint = message_fingerprint(d, size);
+    DecodedMessage decoded;
+    decoded_message_init(&decoded, d, size);
 
-    for (size_t x = 0; x < message->imageWidth; x++) {
-        size_t i = x + (message->imageHeight - 1) * message->imageWidth;
-        input->counts[i] = 0;
-    }
-    for (size_t y = 0; y < message->imageHeight; y++) {
-        size_t i = (message->imageWidth - 1) + (y) * message->imageWidth;
-        input->counts[i] = 0;
+    int err = 0;
+    for (size_t i = 0; i < count && err == 0; i++) {
+        err = render_message(settings, messages[i], &decoded, fingerprint,
+                             threads);
     }
-}
-
 
-int save_image(MessageSettings* message,
-               ImageData* imData,
-               uint8_t* imageBuffer) {
-    if (message->tiled) {
-        size_t leftWidth    = message->imageWidth / 2;
-        size_t rightWidth   = message->imageWidth - leftWidth;
-        size_t topHeight    = message->imageHeight / 2;
-        size_t bottomHeight = message->imageHeight - topHeight;
+    decoded_message_free(&decoded);
+    return err;
+}
 
-        png_image image;
+bool message_wanted(const Settings* settings, const MessageSettings* message,
+                    size_t offset, size_t index) {
+    if (settings->calcOffsets) {
+        return message->offset == index;
+    }
+    return message->offset == offset;
+}
 
-        memset(&image, 0, sizeof(image));
-        image.version = PNG_IMAGE_VERSION;
-        image.format = PNG_FORMAT_RGBA;
-        image.width  = rightWidth; // rightWidth >= leftWidth
-        image.height = bottomHeight; // bottomHeight >= topHeight
-        image.flags = 0;
-        uint8_t* tileBuffer = malloc(PNG_IMAGE_SIZE(image));
-        if (tileBuffer == NULL) {
-            return 1;
+bool keep_streamed_message(void* userp, size_t offset, size_t index) {
+    const Settings* settings = userp;
+    for (size_t i = 0; i < settings->messageCount; i++) {
+        if (message_wanted(settings, settings->messages + i, offset, index)) {
+            return true;
         }
-        png_image_free(&image);
-
-#define WRITE_TILE(WIDTH, HEIGHT, X_OFFSET, Y_OFFSET, PATH)                         \
-        memset(&image, 0, sizeof(image));                                           \
-        image.version = PNG_IMAGE_VERSION;                                          \
-        image.format = PNG_FORMAT_RGBA;                                             \
-        image.width  = WIDTH;                                                       \
-        image.height = HEIGHT;                                                      \
-        image.flags = 0;                                                            \
-        for (size_t y = 0; y < HEIGHT; y++) {                                       \
-            size_t inputI  = ((Y_OFFSET + y) * message->imageWidth + X_OFFSET) * 4; \
-            size_t outputI = y * WIDTH * 4;                                         \
-            memcpy(tileBuffer + outputI, imageBuffer + inputI, WIDTH * 4);          \
-        }                                                                           \
-        if (png_image_write_to_file(&image,                                         \
-                                    PATH,                                           \
-                                    0,                                              \
-                                    tileBuffer,                                     \
-                                    0,                                              \
-                                    NULL) == 0) {                                   \
-            fprintf(stderr, "Did not write image\n");                               \
-        }                                                                           \
-        png_image_free(&image);
-
-        WRITE_TILE(leftWidth,  topHeight,    0,         0,         message->topLeftImageFile);
-        WRITE_TILE(rightWidth, topHeight,    leftWidth, 0,         message->topRightImageFile);
-        WRITE_TILE(leftWidth,  bottomHeight, 0,         topHeight, message->bottomLeftImageFile);
-        WRITE_TILE(rightWidth, bottomHeight, leftWidth, topHeight, message->bottomRightImageFile);
-#undef WRITE_TILE
-        free(tileBuffer);
+    }
+    return false;
+}
 
-        // find middle coords
-        double coef;
-        double cordDiff;
+// Fills in the download's metrics, if they are wanted. start is when the
+// download started, from clock_ms.
+void measure_download(const Settings* settings, const DownloadedData* data,
+                      size_t bytes, double start) {
+    if (settings->metrics == NULL) {
+        return;
+    }
+    settings->metrics->received    = data->received;
+    settings->metrics->bytes       = bytes;
+    settings->metrics->time        = clock_ms() - start;
+    settings->metrics->inflateTime = data->inflateTime;
+}
 
-        coef     = ((double)leftWidth) / ((double)message->imageWidth);
-        cordDiff = imData->coords.lonR - imData->coords.lonL;
-        double middleLon = imData->coords.lonL + coef * cordDiff;
+// Renders each message as soon as it has been downloaded
+int generate_image_streamed(const Settings* settings,
+                            DownloadSettings* downloadS) {
+    downloadS->stream          = true;
+    downloadS->keepMessage     = keep_streamed_message;
+    downloadS->keepMessageData = (void*) settings;
 
-        const double yM = (message->imageHeight - 0.01) / (PROJECT_LAT_Y(imData->coords.latB) - PROJECT_LAT_Y(imData->coords.latT));
-        const double yB = PROJECT_LAT_Y(imData->coords.latT);
-        double dy = ((double)topHeight) / yM + yB;
-        double middleLat = (atan(exp(dy)) - MERCADER_OFFS) / MERCADER_COEF;
+    MessageSettings** wanted = malloc(settings->messageCount *
+                                      sizeof(*wanted));
+    if (settings->messageCount > 0 && wanted == NULL) {
+        return 1;
+    }
 
-        message->output.topLeftArea.latT = imData->coords.latT;
-        message->output.topLeftArea.latB = middleLat;
-        message->output.topLeftArea.lonL = imData->coords.lonL;
-        message->output.topLeftArea.lonR = middleLon;
+    int err = 0;
+    size_t bytes = 0;
+    double start = clock_ms();
+    Download* download = download_start(downloadS);
+    GribMessage grib;
+    while (download_next_message(download, &grib)) {
+        bytes += grib.size;
+        size_t count = 0;
+        for (size_t i = 0; i < settings->messageCount; i++) {
+            MessageSettings* message = settings->messages + i;
+            if (message_wanted(settings, message, grib.offset, grib.index)) {
+                wanted[count++] = message;
+            }
+        }
+        if (err == 0) {
+            err = render_messages(settings, wanted, count, grib.data,
+                                  grib.size, settings->threads);
+        }
+        free(grib.data);
 
-        message->output.topRightArea.latT = imData->coords.latT;
-        message->output.topRightArea.latB = middleLat;
-        message->output.topRightArea.lonL = middleLon;
-        message->output.topRightArea.lonR = imData->coords.lonR;
+        if (err) {
+            download_cancel(download);
+        }
+    }
 
-        message->output.bottomLeftArea.latT = middleLat;
-        message->output.bottomLeftArea.latB = imData->coords.latB;
-        message->output.bottomLeftArea.lonL = imData->coords.lonL;
-        message->output.bottomLeftArea.lonR = middleLon;
+    free(wanted);
 
-        message->output.bottomRightArea.latT = middleLat;
-        message->output.bottomRightArea.latB = imData->coords.latB;
-        message->output.bottomRightArea.lonL = middleLon;
-        message->output.bottomRightArea.lonR = imData->coords.lonR;
+    DownloadedData data = download_finish(download);
+    measure_download(settings, &data, bytes, start);
+    if (data.error) {
+        return 1;
+    }
+    return err;
+}
 
-        return 0;
-    } else {
-        png_image image;
-        memset(&image, 0, sizeof(image));
-        image.version = PNG_IMAGE_VERSION;
-        image.format = PNG_FORMAT_RGBA;
-        image.width  = message->imageWidth;
-        image.height = message->imageHeight;
-        image.flags = 0;
-
-        if (png_image_write_to_file(&image,
-                                    message->topLeftImageFile,
-                                    0,
-                                    imageBuffer,
-                                    0,
-                                    NULL) == 0) {
-            return 1;
-        }
-        png_image_free(&image);
+typedef struct {
+    size_t offset;
+    size_t index;
+} MessageStart;
+
+int message_start_compare(const void* a, const void* b) {
+    const MessageStart* startA = a;
+    const MessageStart* startB = b;
+    if (startA->offset != startB->offset) {
+        return startA->offset < startB->offset ? -1 : 1;
+    }
+    if (startA->index != startB->index) {
+        return startA->index < startB->index ? -1 : 1;
+    }
+    return 0;
+}
 
-        message->output.topLeftArea.latT = imData->coords.latT;
-        message->output.topLeftArea.latB = imData->coords.latB;
-        message->output.topLeftArea.lonL = imData->coords.lonL;
-        message->output.topLeftArea.lonR = imData->coords.lonR;
+// The messages of one download, which are rendered at the same time. Images
+// of the same GRIB message are a group, which share one decode of it.
+typedef struct {
+    const Settings* settings;
+    const DownloadedData* data;
+    MessageStart* starts;       // Sorted, so each group is together
+    MessageSettings** messages; // In the same order as starts
+    size_t* groups;             // Where each group starts in starts, and the end
+    size_t groupCount;
+    int* errors;                // For each group
+    size_t threads;             // For each group
+    atomic_bool stop;
+} MessageRendering;
+
+void render_message_task(void* data, size_t index) {
+    MessageRendering* rendering = data;
+    if (atomic_load(&(rendering->stop))) {
+        return;
+    }
 
-        return 0;
+    size_t first  = rendering->groups[index];
+    size_t offset = rendering->starts[first].offset;
+    int err = render_messages(rendering->settings,
+                              rendering->messages + first,
+                              rendering->groups[index + 1] - first,
+                              rendering->data->gribStart + offset,
+                              rendering->data->totalSize - offset,
+                              rendering->threads);
+    rendering->errors[index] = err;
+    if (err) {
+        // Do not start any more messages
+        atomic_store(&(rendering->stop), true);
     }
 }
 
 int generate_image(const Settings* settings) {
-    int err = 0;
-
     LogSettings logS = {
         .verbose = settings->verbose,
         .logName = settings->logName,
     };
+
+    // Each stage adds its time to the metrics
+    if (settings->metrics != NULL) {
+        memset(settings->metrics, 0, sizeof(*settings->metrics));
+    }
+    for (size_t i = 0; i < settings->messageCount; i++) {
+        memset(&(settings->messages[i].metrics), 0, sizeof(MessageMetrics));
+    }
     DownloadSettings downloadS = {
-        .verbose = settings->verbose,
-        .logName = settings->logName,
-        .gzipped = settings->gzipped,
-        .url     = settings->url,
-        .timeout = settings->timeout,
+        .verbose    = settings->verbose,
+        .logName    = settings->logName,
+        .gzipped    = settings->gzipped,
+        .url        = settings->url,
+        .timeout    = settings->timeout,
+        .ranges     = NULL,
+        .rangeCount = 0,
+        .cacheFile  = settings->cacheFile,
+        .validators = settings->validators,
     };
+
+    ByteRange* ranges = NULL;
+    if (settings->rangeRequest && !settings->gzipped && !settings->calcOffsets
+            && settings->messageCount > 0) {
+        ranges = malloc(settings->messageCount * sizeof(*ranges));
+        if (ranges == NULL) {
+            return 1;
+        }
+        for (size_t i = 0; i < settings->messageCount; i++) {
+            const MessageSettings* message = settings->messages + i;
+            ranges[i].start = message->offset;
+            if (message->length == 0) {
+                ranges[i].end = SIZE_MAX;
+            } else {
+                ranges[i].end = message->offset + message->length;
+            }
+        }
+        downloadS.ranges     = ranges;
+        downloadS.rangeCount = merge_byte_ranges(ranges,
+                                                 settings->messageCount);
+    }
+
+    if (settings->stream) {
+        int err = generate_image_streamed(settings, &downloadS);
+        free(ranges);
+        return err;
+    }
+
+    double start = clock_ms();
     DownloadedData data = download_data(&downloadS);
+    measure_download(settings, &data, data.totalSize, start);
+    if (data.error) {
+        free(ranges);
+        return 1;
+    }
+    if (data.notModified) {
+        // Leave the images from last time alone
+        free(ranges);
+        return 0;
+    }
 
     size_t* offsets = NULL;
     size_t offsetsSize = 0;
@@ -809,7 +1622,7 @@ int generate_image(const Settings* settings) {
             if (!h) {
                 break;
             }
-            size_t msgLen = 0;
+            long msgLen = 0;
             GRIB_CHECK(codes_get_long(h, "totalLength", &msgLen), 0);
             offset += msgLen;
             offsetsSize += 1;
@@ -818,69 +1631,101 @@ int generate_image(const Settings* settings) {
         printf("%zu\n", offsetsSize);
     }
 
+    MessageRendering rendering = {
+        .settings   = settings,
+        .data       = &data,
+        .starts     = malloc(settings->messageCount * sizeof(MessageStart)),
+        .messages   = malloc(settings->messageCount * sizeof(MessageSettings*)),
+        .groups     = malloc((settings->messageCount + 1) * sizeof(size_t)),
+        .groupCount = 0,
+        .errors     = calloc(settings->messageCount, sizeof(int)),
+    };
+    atomic_init(&(rendering.stop), false);
+    if (settings->messageCount > 0 &&
+            (rendering.starts == NULL || rendering.messages == NULL ||
+             rendering.groups == NULL || rendering.errors == NULL)) {
+        free(rendering.starts);
+        free(rendering.messages);
+        free(rendering.groups);
+        free(rendering.errors);
+        free(offsets);
+        free(ranges);
+        free(data.data);
+        return 1;
+    }
+
+    size_t startCount = 0;
     for (size_t messageIndex = 0; messageIndex < settings->messageCount;
             messageIndex++) {
         MessageSettings* message = settings->messages + messageIndex;
-        ImageData imData = generate_image_data(message, data.gribStart,
-                data.totalSize, settings->verbose, offsets, offsetsSize);
-
         logS.logName = message->title;
-        if (imData.error) {
-            continue;
-        }
 
-        // Contour data if needed
-        if (message->contour) {
-            _log(&logS, "Contouring Image");
-            contour_image_data(message, &imData);
+        size_t offset = message->offset;
+        if (settings->calcOffsets) {
+            if (offsetsSize <= offset) {
+                _log(&logS, "Message index is past the end of the file");
+                continue;
+            }
+            offset = offsets[offset];
+        } else if (data.ranged) {
+            // Find where the range holding this message landed in the buffer
+            for (size_t i = 0; i < downloadS.rangeCount; i++) {
+                if (ranges[i].start <= offset && offset < ranges[i].end) {
+                    offset = offset - ranges[i].start + ranges[i].bufferStart;
+                    break;
+                }
+            }
         }
-
-        double*   imageData = imData.imageData;
-        uint32_t* counts    = imData.counts;
-
-        _log(&logS, "Rendering Image");
-
-        png_image image;
-        memset(&image, 0, sizeof(image));
-        image.version = PNG_IMAGE_VERSION;
-        image.format = PNG_FORMAT_RGBA;
-        image.width  = message->imageWidth;
-        image.height = message->imageHeight;
-        image.flags = 0;
-
-        uint8_t* imageBuffer = NULL;
-        imageBuffer = malloc(PNG_IMAGE_SIZE(image));
-        if (imageBuffer == NULL) {
-            return 1;
+        if (offset >= data.totalSize) {
+            _log(&logS, "Message offset is past the end of the data");
+            continue;
         }
-        png_image_free(&image);
-        for (size_t i = 0; i < message->imageWidth * message->imageHeight; i++) {
-            if (counts[i] == 0) {
-                imageBuffer[i * 4 + 0] = 0;
-                imageBuffer[i * 4 + 1] = 0;
-                imageBuffer[i * 4 + 2] = 0;
-                imageBuffer[i * 4 + 3] = 0;
-            } else {
-                double value = imageData[i] / counts[i];
+        rendering.starts[startCount].offset = offset;
+        rendering.starts[startCount].index  = messageIndex;
+        startCount++;
+    }
+    logS.logName = settings->logName;
 
-                color_table_get(message->palette, value, imageBuffer + i * 4);
-            }
+    qsort(rendering.starts, startCount, sizeof(MessageStart),
+          message_start_compare);
+    for (size_t i = 0; i < startCount; i++) {
+        rendering.messages[i] = settings->messages + rendering.starts[i].index;
+        if (i == 0 || rendering.starts[i].offset != rendering.starts[i - 1].offset) {
+            rendering.groups[rendering.groupCount++] = i;
         }
+    }
+    rendering.groups[rendering.groupCount] = startCount;
 
-        free(imageData);
-        free(counts);
-
-        if (save_image(message, &imData, imageBuffer)) {
-            return 1;
-        }
+    // Groups are rendered at the same time, and the threads are shared out
+    // between them
+    size_t threads = settings->threads;
+    if (threads == 0) {
+        threads = parallel_default_threads();
+    }
+    size_t workers = threads;
+    if (workers > rendering.groupCount) {
+        workers = rendering.groupCount;
+    }
+    if (workers > 0) {
+        rendering.threads = threads / workers;
+    }
+    parallel_run(workers, rendering.groupCount, render_message_task,
+                 &rendering);
 
-        free(imageBuffer);
+    int err = 0;
+    for (size_t i = 0; i < rendering.groupCount && err == 0; i++) {
+        err = rendering.errors[i];
     }
-    logS.logName = settings->logName;
 
+    free(rendering.starts);
+    free(rendering.messages);
+    free(rendering.groups);
+    free(rendering.errors);
+    free(offsets);
+    free(ranges);
     free(data.data);
 
-    return 0;
+    return err;
 }
 
 int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
@@ -891,14 +1736,34 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
     };
 
     DownloadSettings downloadS1 = {
-        .verbose = settings->verbose,
-        .logName = settings->title,
-        .gzipped = settings->gzipped,
-        .url     = settings->reflUrl,
-        .timeout = settings->timeout,
+        .verbose    = settings->verbose,
+        .logName    = settings->title,
+        .gzipped    = settings->gzipped,
+        .url        = settings->reflUrl,
+        .timeout    = settings->timeout,
+        .ranges     = NULL,
+        .rangeCount = 0,
+        .cacheFile  = settings->reflCacheFile,
     };
-    DownloadedData data1 = download_data(&downloadS1);
+    DownloadSettings downloadS2 = {
+        .verbose    = settings->verbose,
+        .logName    = settings->title,
+        .gzipped    = settings->gzipped,
+        .url        = settings->typeUrl,
+        .timeout    = settings->timeout,
+        .ranges     = NULL,
+        .rangeCount = 0,
+        .cacheFile  = settings->typeCacheFile,
+    };
+
+    // Both downloads run at once. The reflectivity is decoded while the
+    // precipitation type is still downloading.
+    Download* download1 = download_start(&downloadS1);
+    Download* download2 = download_start(&downloadS2);
+
+    DownloadedData data1 = download_finish(download1);
     if (data1.error) {
+        free(download_finish(download2).data);
         return 1;
     }
     MessageSettings message1 = {
@@ -909,23 +1774,21 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
         .mode        = settings->mode,
         .offset      = 0,
         .minimum     = settings->minimum,
+        .floatValues = settings->floatValues,
         .customArea  = settings->customArea,
         .area        = settings->area,
     };
-    ImageData reflData = generate_image_data(&message1, data1.gribStart,
-            data1.totalSize, settings->verbose, NULL, 0);
+    DecodedMessage decoded1;
+    decoded_message_init(&decoded1, data1.gribStart, data1.totalSize);
+    ImageData reflData = generate_image_data(&message1, &decoded1,
+            settings->verbose, settings->threads);
+    decoded_message_free(&decoded1);
     free(data1.data);
     if (reflData.error) {
+        free(download_finish(download2).data);
         return 1;
     }
 
-    DownloadSettings downloadS2 = {
-        .verbose = settings->verbose,
-        .logName = settings->title,
-        .gzipped = settings->gzipped,
-        .url     = settings->typeUrl,
-        .timeout = settings->timeout,
-    };
     MessageSettings message2 = {
         .palette     = NULL,
         .imageWidth  = settings->imageWidth,
@@ -934,15 +1797,19 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
         .mode        = Nearest_Data,
         .offset      = 0,
         .minimum     = -1,
+        .floatValues = settings->floatValues,
         .customArea  = settings->customArea,
         .area        = settings->area,
     };
-    DownloadedData data2 = download_data(&downloadS2);
+    DownloadedData data2 = download_finish(download2);
     if (data2.error) {
         return 1;
     }
-    ImageData typeData = generate_image_data(&message2, data2.gribStart,
-            data2.totalSize, settings->verbose, NULL, 0);
+    DecodedMessage decoded2;
+    decoded_message_init(&decoded2, data2.gribStart, data2.totalSize);
+    ImageData typeData = generate_image_data(&message2, &decoded2,
+            settings->verbose, settings->threads);
+    decoded_message_free(&decoded2);
     free(data2.data);
     if (typeData.error) {
         return 1;
@@ -972,14 +1839,28 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
     }
     png_image_free(&image);
 
+    CompiledColorTable* rainPalette = color_table_compile(settings->rainPalette,
+                                                          settings->png.indexed);
+    CompiledColorTable* snowPalette = color_table_compile(settings->snowPalette,
+                                                          settings->png.indexed);
+    CompiledColorTable* hailPalette = color_table_compile(settings->hailPalette,
+                                                          settings->png.indexed);
+    if (rainPalette == NULL || snowPalette == NULL || hailPalette == NULL) {
+        compiled_color_table_free(rainPalette);
+        compiled_color_table_free(snowPalette);
+        compiled_color_table_free(hailPalette);
+        free(imageBuffer);
+        return 1;
+    }
+
     for (size_t i = 0; i < settings->imageWidth * settings->imageHeight; i++) {
-        if (reflData.counts[i] == 0 || typeData.counts[i] == 0) {
+        if (isnan(reflData.imageData[i]) || isnan(typeData.imageData[i])) {
             imageBuffer[i * 4 + 0] = 0;
             imageBuffer[i * 4 + 1] = 0;
             imageBuffer[i * 4 + 2] = 0;
             imageBuffer[i * 4 + 3] = 0;
         } else {
-            double value = reflData.imageData[i] / reflData.counts[i];
+            double value = reflData.imageData[i];
             double type  = typeData.imageData[i];
 
             if (type < 0.9) {
@@ -988,7 +1869,7 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                 imageBuffer[i * 4 + 2] = 0;
                 imageBuffer[i * 4 + 3] = 0;
             } else if (type < 1.9) {
-                color_table_get(settings->rainPalette, value,
+                compiled_color_table_get(rainPalette, value,
                                 imageBuffer + i * 4);
             } else if (type < 2.9) {
                 imageBuffer[i * 4 + 0] = 0;
@@ -996,7 +1877,7 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                 imageBuffer[i * 4 + 2] = 0;
                 imageBuffer[i * 4 + 3] = 0;
             } else if (type < 3.9) {
-                color_table_get(settings->snowPalette, value,
+                compiled_color_table_get(snowPalette, value,
                                 imageBuffer + i * 4);
             } else if (type < 5.9) {
                 imageBuffer[i * 4 + 0] = 0;
@@ -1004,10 +1885,10 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                 imageBuffer[i * 4 + 2] = 0;
                 imageBuffer[i * 4 + 3] = 0;
             } else if (type < 6.9) {
-                color_table_get(settings->rainPalette, value,
+                compiled_color_table_get(rainPalette, value,
                                 imageBuffer + i * 4);
             } else if (type < 7.9) {
-                color_table_get(settings->hailPalette, value,
+                compiled_color_table_get(hailPalette, value,
                                 imageBuffer + i * 4);
             } else if (type < 9.9) {
                 imageBuffer[i * 4 + 0] = 0;
@@ -1015,7 +1896,7 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                 imageBuffer[i * 4 + 2] = 0;
                 imageBuffer[i * 4 + 3] = 0;
             } else if (type < 10.9) {
-                color_table_get(settings->rainPalette, value,
+                compiled_color_table_get(rainPalette, value,
                                 imageBuffer + i * 4);
             } else if (type < 90.9) {
                 imageBuffer[i * 4 + 0] = 0;
@@ -1023,7 +1904,7 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                 imageBuffer[i * 4 + 2] = 0;
                 imageBuffer[i * 4 + 3] = 0;
             } else if (type < 91.9) {
-                color_table_get(settings->rainPalette, value,
+                compiled_color_table_get(rainPalette, value,
                                 imageBuffer + i * 4);
             } else if (type < 95.9) {
                 imageBuffer[i * 4 + 0] = 0;
@@ -1031,7 +1912,7 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
                 imageBuffer[i * 4 + 2] = 0;
                 imageBuffer[i * 4 + 3] = 0;
             } else if (type < 96.9) {
-                color_table_get(settings->rainPalette, value,
+                compiled_color_table_get(rainPalette, value,
                                 imageBuffer + i * 4);
             } else {
                 imageBuffer[i * 4 + 0] = 0;
@@ -1043,9 +1924,10 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
     }
 
     free(reflData.imageData);
-    free(reflData.counts);
     free(typeData.imageData);
-    free(typeData.counts);
+    compiled_color_table_free(rainPalette);
+    compiled_color_table_free(snowPalette);
+    compiled_color_table_free(hailPalette);
 
     MessageSettings saveMessage = {
         .tiled                  = settings->tiled,
@@ -1055,9 +1937,10 @@ int generate_mrms_typed_refl(const MRMSTypedReflSettings* settings,
         .bottomRightImageFile   = settings->bottomRightImageFile,
         .imageWidth             = settings->imageWidth,
         .imageHeight            = settings->imageHeight,
+        .png                    = settings->png,
     };
 
-    if (save_image(&saveMessage, &reflData, imageBuffer)) {
+    if (save_image(&saveMessage, &reflData, imageBuffer, settings->threads)) {
         return 1;
     }
     free(imageBuffer);
@@ -0,0 +1,154 @@
+#include <stdlib.h>
+#include <string.h>
+#include <threads.h>
+
+#include "grid_cache.h"
+
+// Upper limit on the memory used by maps which are not in use
+#define GRID_CACHE_SIZE (512 * (1 << 20))
+
+// Maps are kept from most to least recently used. The cache lives for as long
+// as the library is loaded, so it is shared by every message rendered.
+typedef struct {
+    mtx_t lock;
+    GridMap* first;
+    size_t size;
+} GridCache;
+
+static GridCache cache;
+static once_flag cacheOnce = ONCE_FLAG_INIT;
+
+void grid_cache_init(void) {
+    mtx_init(&(cache.lock), mtx_plain);
+    cache.first = NULL;
+    cache.size  = 0;
+}
+
+size_t grid_map_size(const GridMap* map) {
+    if (map->separable) {
+        return sizeof(*map) + map->columns * sizeof(*(map->x)) +
+               map->rows * sizeof(*(map->y));
+    }
+    return sizeof(*map) + map->count * (sizeof(*(map->x)) + sizeof(*(map->y)));
+}
+
+GridMap* grid_map_new(const GridKey* key, size_t rows, size_t columns,
+                      bool separable) {
+    GridMap* map = calloc(1, sizeof(*map));
+    if (map == NULL) {
+        return NULL;
+    }
+    map->key       = *key;
+    map->count     = rows * columns;
+    map->separable = separable;
+    map->rows      = rows;
+    map->columns   = columns;
+    if (separable) {
+        map->x = malloc(columns * sizeof(*(map->x)));
+        map->y = malloc(rows * sizeof(*(map->y)));
+    } else {
+        map->x = malloc(map->count * sizeof(*(map->x)));
+        map->y = malloc(map->count * sizeof(*(map->y)));
+    }
+    map->users = 1;
+    if (map->x == NULL || map->y == NULL) {
+        free(map->x);
+        free(map->y);
+        free(map);
+        return NULL;
+    }
+    return map;
+}
+
+void grid_map_free(GridMap* map) {
+    free(map->x);
+    free(map->y);
+    free(map);
+}
+
+bool grid_key_equal(const GridKey* a, const GridKey* b) {
+    return strcmp(a->grid, b->grid) == 0 &&
+           a->imageWidth  == b->imageWidth &&
+           a->imageHeight == b->imageHeight &&
+           a->customArea  == b->customArea &&
+           (!a->customArea || memcmp(&(a->area), &(b->area), sizeof(a->area)) == 0);
+}
+
+GridMap* grid_cache_get(const GridKey* key) {
+    if (key->grid[0] == '\0') {
+        return NULL;
+    }
+    call_once(&cacheOnce, grid_cache_init);
+
+    mtx_lock(&(cache.lock));
+    GridMap** link = &(cache.first);
+    GridMap* map = NULL;
+    while (*link != NULL) {
+        if (grid_key_equal(&((*link)->key), key)) {
+            map = *link;
+            // Move it to the front
+            *link = map->next;
+            map->next = cache.first;
+            cache.first = map;
+            map->users++;
+            break;
+        }
+        link = &((*link)->next);
+    }
+    mtx_unlock(&(cache.lock));
+
+    return map;
+}
+
+// Drops the least recently used maps which are not in use, until the cache is
+// small enough. Called with the lock held.
+void grid_cache_trim(void) {
+    while (cache.size > GRID_CACHE_SIZE) {
+        GridMap** oldest = NULL;
+        for (GridMap** link = &(cache.first); *link != NULL;
+                link = &((*link)->next)) {
+            if ((*link)->users == 0) {
+                oldest = link;
+            }
+        }
+        if (oldest == NULL) {
+            return;
+        }
+
+        GridMap* map = *oldest;
+        *oldest = map->next;
+        cache.size -= grid_map_size(map);
+        grid_map_free(map);
+    }
+}
+
+void grid_cache_add(GridMap* map) {
+    size_t size = grid_map_size(map);
+    if (map->key.grid[0] == '\0' || size > GRID_CACHE_SIZE) {
+        return;
+    }
+    call_once(&cacheOnce, grid_cache_init);
+
+    mtx_lock(&(cache.lock));
+    map->cached = true;
+    map->next   = cache.first;
+    cache.first = map;
+    cache.size += size;
+    grid_cache_trim();
+    mtx_unlock(&(cache.lock));
+}
+
+void grid_cache_release(GridMap* map) {
+    if (map == NULL) {
+        return;
+    }
+    if (!map->cached) {
+        grid_map_free(map);
+        return;
+    }
+
+    mtx_lock(&(cache.lock));
+    map->users--;
+    grid_cache_trim();
+    mtx_unlock(&(cache.lock));
+}
@@ -0,0 +1,59 @@
+#include <stdio.h>
+#include <stdint.h>
+#include <time.h>
+
+#include "log.h"
+
+#define TIMEFMT "%Y-%m-%d %H:%M:%S"
+
+#ifdef _WIN32
+#include <sys\timeb.h>
+#include <windows.h>
+void _log(const LogSettings* settings, char* message) {
+    if (!settings->verbose) {
+        return;
+    }
+    struct __timeb64 ts;
+    _ftime64(&ts);
+    time_t tm = time(NULL);
+    int32_t frac = ts.millitm;
+
+    char buffer[24];
+    if(strftime(buffer, sizeof(buffer), TIMEFMT, localtime(&tm)) == 0) {
+        buffer[0] = '\0';
+    }
+
+    printf("[%s.%03d] [%s] %s\n", buffer, frac, settings->logName, message);
+}
+
+double clock_ms(void) {
+    LARGE_INTEGER frequency;
+    LARGE_INTEGER counter;
+    QueryPerformanceFrequency(&frequency);
+    QueryPerformanceCounter(&counter);
+    return counter.QuadPart * 1000.0 / frequency.QuadPart;
+}
+#else
+void _log(const LogSettings* settings, char* message) {
+    if (!settings->verbose) {
+        return;
+    }
+    struct timespec ts;
+    clock_gettime(CLOCK_REALTIME, &ts);
+    time_t tm = time(NULL);
+    int32_t frac = ts.tv_nsec / 1000000;
+
+    char buffer[24];
+    if(strftime(buffer, sizeof(buffer), TIMEFMT, localtime(&tm)) == 0) {
+        buffer[0] = '\0';
+    }
+
+    printf("[%s.%03d] [%s] %s\n", buffer, frac, settings->logName, message);
+}
+
+double clock_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000.0 + ts.tv_nsec / 1000000.0;
+}
+#endif
@@ -0,0 +1,81 @@
+#include <stdatomic.h>
+#include <stdlib.h>
+#include <threads.h>
+
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <unistd.h>
+#endif
+
+#include "parallel.h"
+
+typedef struct {
+    ParallelTask task;
+    void* data;
+    size_t count;
+    atomic_size_t next;
+} ParallelJob;
+
+size_t parallel_default_threads(void) {
+#ifdef _WIN32
+    SYSTEM_INFO info;
+    GetSystemInfo(&info);
+    long cores = info.dwNumberOfProcessors;
+#else
+    long cores = sysconf(_SC_NPROCESSORS_ONLN);
+#endif
+    if (cores < 1) {
+        return 1;
+    }
+    return cores;
+}
+
+// Takes pieces until there are none left, so uneven pieces balance out
+int parallel_worker(void* arg) {
+    ParallelJob* job = arg;
+    size_t index;
+    while ((index = atomic_fetch_add(&(job->next), 1)) < job->count) {
+        job->task(job->data, index);
+    }
+    return 0;
+}
+
+void parallel_run(size_t threads, size_t count, ParallelTask task, void* data) {
+    if (threads == 0) {
+        threads = parallel_default_threads();
+    }
+    if (threads > count) {
+        threads = count;
+    }
+
+    ParallelJob job = {
+        .task  = task,
+        .data  = data,
+        .count = count,
+    };
+    atomic_init(&(job.next), 0);
+
+    thrd_t* workers = NULL;
+    size_t started = 0;
+    if (threads > 1) {
+        workers = malloc((threads - 1) * sizeof(*workers));
+    }
+    if (workers != NULL) {
+        // If a thread can not be started, the rest of the work is done by
+        // those which were
+        for (; started < threads - 1; started++) {
+            if (thrd_create(workers + started, parallel_worker, &job) !=
+                    thrd_success) {
+                break;
+            }
+        }
+    }
+
+    parallel_worker(&job);
+
+    for (size_t i = 0; i < started; i++) {
+        thrd_join(workers[i], NULL);
+    }
+    free(workers);
+}
@@ -0,0 +1,191 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <setjmp.h>
+
+#include "png.h"
+#include "png_writer.h"
+
+#define PALETTE_SIZE 256
+// Slots for finding a color's index, kept at most a quarter full
+#define COLOR_HASH_SIZE 1024
+
+typedef struct {
+    uint8_t colors[PALETTE_SIZE][4]; // RGBA
+    size_t count;
+    size_t translucent; // Colors at the start which are not opaque
+} ImagePalette;
+
+// Puts the colors which are not opaque first, so the tRNS chunk only needs to
+// cover them
+void sort_palette(ImagePalette* palette, uint8_t* indexes, size_t count) {
+    uint8_t remap[PALETTE_SIZE];
+    uint8_t colors[PALETTE_SIZE][4];
+    size_t next = 0;
+    for (int opaque = 0; opaque <= 1; opaque++) {
+        for (size_t i = 0; i < palette->count; i++) {
+            if ((palette->colors[i][3] == 255) == opaque) {
+                remap[i] = next;
+                memcpy(colors[next], palette->colors[i], 4);
+                next++;
+            }
+        }
+        if (!opaque) {
+            palette->translucent = next;
+        }
+    }
+    memcpy(palette->colors, colors, palette->count * 4);
+
+    for (size_t i = 0; i < count; i++) {
+        indexes[i] = remap[indexes[i]];
+    }
+}
+
+// Finds each pixel's palette index. Returns NULL if the image needs more than
+// PALETTE_SIZE colors, or if out of memory.
+uint8_t* index_colors(const uint8_t* data, size_t width, size_t height,
+                      size_t stride, ImagePalette* palette) {
+    uint8_t* indexes = malloc(width * height);
+    if (indexes == NULL) {
+        return NULL;
+    }
+
+    uint32_t keys[COLOR_HASH_SIZE];
+    int16_t slots[COLOR_HASH_SIZE]; // Palette index, -1 if empty
+    for (size_t i = 0; i < COLOR_HASH_SIZE; i++) {
+        slots[i] = -1;
+    }
+    palette->count = 0;
+
+    // Most pixels are the same color as the one before them
+    uint32_t lastColor = 0;
+    int16_t lastIndex  = -1;
+    for (size_t y = 0; y < height; y++) {
+        const uint8_t* row = data + y * stride;
+        uint8_t* rowIndexes = indexes + y * width;
+        for (size_t x = 0; x < width; x++) {
+            uint32_t color;
+            memcpy(&color, row + x * 4, sizeof(color));
+            if (color == lastColor && lastIndex >= 0) {
+                rowIndexes[x] = lastIndex;
+                continue;
+            }
+
+            size_t slot = (uint32_t) (color * 2654435761u) >> 22;
+            while (slots[slot] >= 0 && keys[slot] != color) {
+                slot = (slot + 1) % COLOR_HASH_SIZE;
+            }
+            if (slots[slot] < 0) {
+                if (palette->count == PALETTE_SIZE) {
+                    free(indexes);
+                    return NULL;
+                }
+                keys[slot]  = color;
+                slots[slot] = palette->count;
+                memcpy(palette->colors[palette->count], row + x * 4, 4);
+                palette->count++;
+            }
+
+            lastColor     = color;
+            lastIndex     = slots[slot];
+            rowIndexes[x] = lastIndex;
+        }
+    }
+
+    sort_palette(palette, indexes, width * height);
+    return indexes;
+}
+
+int write_png(const char* path, const uint8_t* data, size_t width,
+              size_t height, size_t stride, const PngSettings* settings,
+              size_t* size) {
+    // Falls back to RGBA when there are too many colors
+    ImagePalette palette;
+    // Volatile as it is used after libpng's longjmp
+    uint8_t* volatile indexes = NULL;
+    if (settings->indexed) {
+        indexes = index_colors(data, width, height, stride, &palette);
+    }
+
+    FILE* file = fopen(path, "wb");
+    if (file == NULL) {
+        free(indexes);
+        return 1;
+    }
+
+    png_structp png = png_create_write_struct(PNG_LIBPNG_VER_STRING, NULL,
+                                              NULL, NULL);
+    png_infop info = NULL;
+    if (png != NULL) {
+        info = png_create_info_struct(png);
+    }
+    if (info == NULL) {
+        png_destroy_write_struct(&png, NULL);
+        fclose(file);
+        free(indexes);
+        return 1;
+    }
+
+    // libpng jumps back here on an error
+    if (setjmp(png_jmpbuf(png))) {
+        png_destroy_write_struct(&png, &info);
+        fclose(file);
+        free(indexes);
+        return 1;
+    }
+
+    png_init_io(png, file);
+    if (settings->level >= 0) {
+        png_set_compression_level(png, settings->level);
+    }
+    if (settings->strategy >= 0) {
+        png_set_compression_strategy(png, settings->strategy);
+    }
+    if (settings->filters >= 0) {
+        png_set_filter(png, PNG_FILTER_TYPE_BASE, settings->filters);
+    }
+
+    if (indexes != NULL) {
+        png_set_IHDR(png, info, width, height, 8, PNG_COLOR_TYPE_PALETTE,
+                     PNG_INTERLACE_NONE, PNG_COMPRESSION_TYPE_DEFAULT,
+                     PNG_FILTER_TYPE_DEFAULT);
+
+        png_color colors[PALETTE_SIZE];
+        png_byte alphas[PALETTE_SIZE];
+        for (size_t i = 0; i < palette.count; i++) {
+            colors[i].red   = palette.colors[i][0];
+            colors[i].green = palette.colors[i][1];
+            colors[i].blue  = palette.colors[i][2];
+            alphas[i]       = palette.colors[i][3];
+        }
+        png_set_PLTE(png, info, colors, palette.count);
+        if (palette.translucent > 0) {
+            png_set_tRNS(png, info, alphas, palette.translucent, NULL);
+        }
+    } else {
+        png_set_IHDR(png, info, width, height, 8, PNG_COLOR_TYPE_RGBA,
+                     PNG_INTERLACE_NONE, PNG_COMPRESSION_TYPE_DEFAULT,
+                     PNG_FILTER_TYPE_DEFAULT);
+    }
+    // The same as png_image_write_to_file gives 8 bit images
+    png_set_sRGB(png, info, PNG_sRGB_INTENT_PERCEPTUAL);
+    png_write_info(png, info);
+
+    for (size_t y = 0; y < height; y++) {
+        if (indexes != NULL) {
+            png_write_row(png, indexes + y * width);
+        } else {
+            png_write_row(png, data + y * stride);
+        }
+    }
+
+    png_write_end(png, NULL);
+    png_destroy_write_struct(&png, &info);
+    free(indexes);
+
+    if (size != NULL) {
+        long end = ftell(file);
+        *size = end < 0 ? 0 : (size_t) end;
+    }
+    return fclose(file) != 0;
+}
@@ -0,0 +1,220 @@
+#define _USE_MATH_DEFINES
+#include <errno.h>
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+
+#ifdef _WIN32
+#include <direct.h>
+#define make_directory(path) _mkdir(path)
+#define is_separator(c) ((c) == '/' || (c) == '\\')
+#else
+#define make_directory(path) mkdir(path, 0777)
+#define is_separator(c) ((c) == '/')
+#endif
+
+#ifndef S_ISDIR
+#define S_ISDIR(mode) (((mode) & S_IFMT) == S_IFDIR)
+#endif
+
+#include "tile_pyramid.h"
+
+// Where a longitude or latitude is, in tiles from the top left of the world
+static double tile_x(int z, double lon) {
+    return (lon + 180) / 360 * (double)(1 << z);
+}
+
+static double tile_y(int z, double lat) {
+    if (lat > TILE_MAX_LAT) {
+        lat = TILE_MAX_LAT;
+    } else if (lat < -TILE_MAX_LAT) {
+        lat = -TILE_MAX_LAT;
+    }
+    double y = log(tan(M_PI / 4 + lat * M_PI / 360));
+    return (1 - y / M_PI) / 2 * (double)(1 << z);
+}
+
+static double tile_lat(int z, double y) {
+    return atan(sinh(M_PI * (1 - 2 * y / (double)(1 << z)))) * 180 / M_PI;
+}
+
+bool tile_level_cover(int z, const ImageArea* area, TileLevel* level) {
+    // Tiles go from -180 to 180. Anything past 180 is left off.
+    double lonL = area->lonL - 360 * floor((area->lonL + 180) / 360);
+    double lonR = lonL + (area->lonR - area->lonL);
+    const double tiles = (double)(1 << z);
+
+    double left   = floor(tile_x(z, lonL));
+    double right  = ceil(tile_x(z, lonR));
+    double top    = floor(tile_y(z, area->latT));
+    double bottom = ceil(tile_y(z, area->latB));
+    if (right > tiles) {
+        right = tiles;
+    }
+    if (bottom > tiles) {
+        bottom = tiles;
+    }
+    if (left < 0) {
+        left = 0;
+    }
+    if (top < 0) {
+        top = 0;
+    }
+    if (right <= left || bottom <= top) {
+        return false;
+    }
+
+    level->z       = z;
+    level->x       = left;
+    level->y       = top;
+    level->columns = right - left;
+    level->rows    = bottom - top;
+    level->data    = NULL;
+    return true;
+}
+
+void tile_area(int z, size_t x, size_t y, size_t columns, size_t rows,
+               ImageArea* area) {
+    const double tiles = (double)(1 << z);
+    area->lonL = x / tiles * 360 - 180;
+    area->lonR = (x + columns) / tiles * 360 - 180;
+    area->latT = tile_lat(z, y);
+    area->latB = tile_lat(z, y + rows);
+}
+
+// Combines the values which are not NAN, the same way binning does
+static float combine_values(const float* values, size_t count, int mode) {
+    if (count == 0) {
+        return NAN;
+    }
+    float result = values[0];
+    switch (mode) {
+    case Average_Data:
+        for (size_t i = 1; i < count; i++) {
+            result += values[i];
+        }
+        return result / count;
+    case Max_Data:
+        for (size_t i = 1; i < count; i++) {
+            if (values[i] > result) {
+                result = values[i];
+            }
+        }
+        return result;
+    case Min_Data:
+        for (size_t i = 1; i < count; i++) {
+            if (values[i] < result) {
+                result = values[i];
+            }
+        }
+        return result;
+    default:
+        // Nearest keeps the top left value which has data
+        return result;
+    }
+}
+
+int tile_level_downsample(const TileLevel* level, int mode, TileLevel* lower) {
+    lower->z       = level->z - 1;
+    lower->x       = level->x / 2;
+    lower->y       = level->y / 2;
+    lower->columns = (level->x + level->columns + 1) / 2 - lower->x;
+    lower->rows    = (level->y + level->rows + 1) / 2 - lower->y;
+
+    const size_t width  = tile_level_width(lower);
+    const size_t height = tile_level_height(lower);
+    lower->data = malloc(width * height * sizeof(*(lower->data)));
+    if (lower->data == NULL) {
+        return 1;
+    }
+
+    // A level that starts on an odd tile starts half a tile into the lower one
+    const size_t levelWidth  = tile_level_width(level);
+    const size_t levelHeight = tile_level_height(level);
+    const size_t offsetX = (level->x - lower->x * 2) * TILE_SIZE;
+    const size_t offsetY = (level->y - lower->y * 2) * TILE_SIZE;
+    for (size_t y = 0; y < height; y++) {
+        for (size_t x = 0; x < width; x++) {
+            float values[4];
+            size_t count = 0;
+            for (size_t dy = 0; dy < 2; dy++) {
+                for (size_t dx = 0; dx < 2; dx++) {
+                    size_t sx = x * 2 + dx;
+                    size_t sy = y * 2 + dy;
+                    if (sx < offsetX || sy < offsetY ||
+                            sx - offsetX >= levelWidth ||
+                            sy - offsetY >= levelHeight) {
+                        continue;
+                    }
+                    float value = level->data[(sx - offsetX) +
+                                              (sy - offsetY) * levelWidth];
+                    if (!isnan(value)) {
+                        values[count++] = value;
+                    }
+                }
+            }
+            lower->data[x + y * width] = combine_values(values, count, mode);
+        }
+    }
+    return 0;
+}
+
+bool tile_path(char* path, size_t size, const char* pattern, int z, size_t x,
+               size_t y) {
+    if (size == 0) {
+        return false;
+    }
+    path[0] = '\0';
+    size_t length = 0;
+    while (*pattern != '\0') {
+        int written;
+        if (strncmp(pattern, "{z}", 3) == 0) {
+            written = snprintf(path + length, size - length, "%d", z);
+            pattern += 3;
+        } else if (strncmp(pattern, "{x}", 3) == 0) {
+            written = snprintf(path + length, size - length, "%zu", x);
+            pattern += 3;
+        } else if (strncmp(pattern, "{y}", 3) == 0) {
+            written = snprintf(path + length, size - length, "%zu", y);
+            pattern += 3;
+        } else {
+            written = snprintf(path + length, size - length, "%c", *pattern);
+            pattern++;
+        }
+        if (written < 0 || (size_t)written >= size - length) {
+            return false;
+        }
+        length += written;
+    }
+    return true;
+}
+
+int make_parent_directories(const char* path) {
+    char* directory = strdup(path);
+    if (directory == NULL) {
+        return 1;
+    }
+
+    // The first character is skipped, so an absolute path does not try to
+    // make the root
+    for (char* c = directory + 1; *c != '\0'; c++) {
+        if (!is_separator(*c)) {
+            continue;
+        }
+        char separator = *c;
+        *c = '\0';
+        if (make_directory(directory) != 0 && errno != EEXIST) {
+            struct stat info;
+            if (stat(directory, &info) != 0 || !S_ISDIR(info.st_mode)) {
+                free(directory);
+                return 1;
+            }
+        }
+        *c = separator;
+    }
+
+    free(directory);
+    return 0;
+}
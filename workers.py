@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import threading
+import traceback
+
+# Workers are started with spawn on every platform, as they are started from
+# threads, which does not mix well with fork.
+CONTEXT = multiprocessing.get_context("spawn")
+
+def max_memory():
+    # The most memory this process has used so far, in MiB. 0 if unknown.
+    try:
+        import resource
+    except ImportError:
+        return 0
+
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return maxRss / (1 << 20)
+    return maxRss / (1 << 10)
+
+def worker_main(conn):
+    # The library, parsed palettes and eccodes' definitions stay loaded from
+    # one job to the next
+    while True:
+        try:
+            func, args = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError, KeyboardInterrupt):
+            return
+
+        try:
+            result = (True, func(*args))
+        except Exception:
+            traceback.print_exc()
+            result = (False, None)
+        except KeyboardInterrupt:
+            return
+
+        conn.send(result + (max_memory(),))
+
+class Job:
+    def __init__(self, pool, data, callback):
+        self.pool     = pool
+        self.data     = data
+        self.callback = callback
+
+        self.worker    = None
+        self.cancelled = False
+        self.finished  = threading.Event()
+        self.ok        = False
+        self.result    = None
+
+    def done(self):
+        return self.finished.is_set()
+
+    def cancel(self):
+        # A job which is running is stopped by killing its worker
+        with self.pool.lock:
+            self.cancelled = True
+            if self.worker is not None:
+                self.worker.proc.kill()
+
+class Worker:
+    def __init__(self, pool):
+        self.pool = pool
+        self.proc = None
+        self.conn = None
+        self.jobs = 0
+
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _start(self):
+        conn, childConn = CONTEXT.Pipe()
+        self.proc = CONTEXT.Process(target = worker_main, args = (childConn,),
+                                    daemon = True)
+        self.proc.start()
+        childConn.close()
+        self.conn = conn
+        self.jobs = 0
+
+    def _stop(self):
+        if self.proc is None:
+            return
+
+        # The worker returns once its end of the pipe is closed
+        self.conn.close()
+        self.proc.join(5)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join()
+        self.proc.close()
+        self.proc = None
+        self.conn = None
+
+    def _run(self):
+        while True:
+            job = self.pool.jobs.get()
+
+            with self.pool.lock:
+                if job.cancelled:
+                    job.finished.set()
+                    continue
+                if self.proc is None:
+                    self._start()
+                job.worker = self
+
+            try:
+                self.conn.send_bytes(job.data)
+                ok, result, memory = self.conn.recv()
+            except (EOFError, OSError):
+                # Killed by cancel, or it crashed
+                ok, result, memory = False, None, None
+
+            with self.pool.lock:
+                job.worker = None
+
+            self.jobs += 1
+            if memory is None or \
+                    (self.pool.maxJobs > 0 and self.jobs >= self.pool.maxJobs) or \
+                    (self.pool.maxMemory > 0 and memory > self.pool.maxMemory):
+                self._stop()
+
+            job.ok     = ok
+            job.result = result
+            if ok and job.callback is not None:
+                try:
+                    job.callback(result)
+                except Exception:
+                    traceback.print_exc()
+            job.finished.set()
+
+class WorkerPool:
+    def __init__(self, size = None, maxJobs = 100, maxMemory = 0):
+        if size is None or size < 1:
+            size = os.cpu_count() or 1
+        # Workers are recycled after this many jobs, or once they have used
+        # more than maxMemory MiB. 0 turns either off.
+        self.maxJobs   = maxJobs
+        self.maxMemory = maxMemory
+
+        self.jobs = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        # Each worker's process is started when it gets its first job
+        self.workers = [Worker(self) for _ in range(size)]
+
+    def submit(self, func, *args, callback = None):
+        # The job is pickled now, so anything the caller clears to avoid
+        # pickling can be put back once this returns. callback is given the
+        # result, if the job finished without an exception.
+        job = Job(self, pickle.dumps((func, args)), callback)
+        self.jobs.put(job)
+        return job